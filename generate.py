@@ -2,6 +2,7 @@ from __future__ import division
 from __future__ import print_function
 
 import argparse
+import collections
 from datetime import datetime
 import json
 import os
@@ -9,15 +10,17 @@ import os
 import librosa
 import numpy as np
 import tensorflow as tf
-import midi
 
-from wavenet import WaveNetModel, MidiMapper, mu_law_decode, mu_law_encode, audio_reader
+from wavenet import (WaveNetModel, NumpyGenerator, MidiMapper, load_midi, WavWriter, mu_law_decode_numpy, sample_categorical_numpy,
+					 mu_law_encode, audio_reader)
 
 TEMPERATURE = 1.0
 LOGDIR = './logdir'
 WAVENET_PARAMS = './wavenet_params.json'
 SAVE_EVERY = None
 SILENCE_THRESHOLD = 0.1
+NUM_STREAMS = 1
+BLOCK_SIZE = 1
 
 
 def get_args():
@@ -38,12 +41,25 @@ def get_args():
 	parser.add_argument('--samples',
 		type = int,
 		default = None,
-		help = 'How many waveform samples to generate')
+		help = 'How many waveform samples to generate. With local conditioning the length of the '
+		'longest LC file is generated instead.')
 	
 	parser.add_argument('--temperature',
 		type = _ensure_positive_float,
-		default = TEMPERATURE,
-		help = 'Sampling temperature')
+		nargs = '+',
+		default = [TEMPERATURE],
+		help = 'Sampling temperature. One value, or one per stream.')
+
+	parser.add_argument('--top-k',
+		type = int,
+		default = None,
+		help = 'Only sample from the k most likely values. Default: None. Expecting: int')
+
+	parser.add_argument('--top-p',
+		type = float,
+		default = None,
+		help = 'Only sample from the most likely values that together have probability p '
+		'(nucleus sampling). Default: None. Expecting: float')
 	
 	parser.add_argument('--logdir',
 		type = str,
@@ -63,17 +79,34 @@ def get_args():
 	parser.add_argument('--save-every',
 		type = int,
 		default = SAVE_EVERY,
-		help = 'How many samples before saving in-progress wav')
+		help = 'How many samples before appending to the in-progress wav. Default: sample rate')
 	
 	parser.add_argument('--fast-generation',
 		type = bool,
 		default = True,
 		help = 'Use fast generation')
+
+	parser.add_argument('--numpy-generation',
+		action = 'store_true',
+		help = 'Run fast generation in NumPy instead of one Session call per sample. Default: False')
 	
 	parser.add_argument('--wav-seed',
 		type = str,
+		nargs = '+',
 		default = None,
-		help = 'The wav file to start generation from')
+		help = 'The wav file to start generation from. One file, or one per stream.')
+
+	parser.add_argument('--block-size',
+		type = int,
+		default = BLOCK_SIZE,
+		help = 'Number of samples fast generation produces per Session call, sampling and feeding '
+		'them back inside the graph. Default: ' + str(BLOCK_SIZE) + '. Expecting: int')
+
+	parser.add_argument('--num-streams',
+		type = int,
+		default = NUM_STREAMS,
+		help = 'Number of independent waveforms generated together in one loop. '
+		'Default: ' + str(NUM_STREAMS) + '. Expecting: int')
 	
 	# GC params
 	parser.add_argument('--gc-channels',
@@ -88,8 +121,9 @@ def get_args():
 	
 	parser.add_argument('--gc-id',
 		type = int,
+		nargs = '+',
 		default = None,
-		help = 'ID of category to generate, if globally conditioned.')
+		help = 'ID of category to generate, if globally conditioned. One ID, or one per stream.')
 
 	# LC params
 	parser.add_argument('--initial-lc-channels',
@@ -108,9 +142,11 @@ def get_args():
 		help = "Extension of files being used for local conditioning. Default: None. Expecting: string")
 
 	parser.add_argument('--lc-filepath',
-	    type = str,
-	    default = None,
-	    help = "Path to the file to be used for local condition based generation. Default: None. Expecting: string.")
+		type = str,
+		nargs = '+',
+		default = None,
+		help = "Path to the file to be used for local condition based generation. "
+		"One file, or one per stream. Default: None. Expecting: string.")
 
 	parser.add_argument('--sample-rate',
 		type = int,
@@ -133,6 +169,23 @@ def get_args():
 		if args.lc_filepath is None:
 			raise ValueError("No local conditioning file provided in the LC filepath")
 
+	elif args.samples is None:
+		raise ValueError("The number of samples to generate has to be given without local conditioning.")
+
+	if args.num_streams < 1:
+		raise ValueError("Number of streams must be at least 1.")
+
+	if args.num_streams > 1 and not args.fast_generation:
+		raise ValueError("Generating multiple streams requires fast generation.")
+
+	if args.block_size > 1 and (not args.fast_generation or args.numpy_generation):
+		raise ValueError("Block generation requires fast generation in TensorFlow.")
+
+	args.temperature = per_stream(args.temperature, args.num_streams, 'temperature')
+	args.wav_seed = per_stream(args.wav_seed, args.num_streams, 'wav-seed')
+	args.gc_id = per_stream(args.gc_id, args.num_streams, 'gc-id')
+	args.lc_filepath = per_stream(args.lc_filepath, args.num_streams, 'lc-filepath')
+
 	if args.lc_channels and args.samples:
 		print("WARNING: LC enabled and number of samples to be generated also given.\n",
 			"In this case, the sample number will be ignored. Total number of samples",
@@ -141,10 +194,26 @@ def get_args():
 	return args
 
 
-def write_wav(waveform, sample_rate, filename):
-	y = np.array(waveform)
-	librosa.output.write_wav(filename, y, sample_rate)
-	print('Updated wav file at {}'.format(filename))
+def per_stream(values, num_streams, name):
+	'''Broadcasts a command line option given once, or once per stream, to a
+	list with one value per stream.'''
+	if values is None:
+		return [None] * num_streams
+	if len(values) == 1:
+		return values * num_streams
+	if len(values) != num_streams:
+		raise ValueError("Expected 1 or {} values for --{}, got {}."
+						 .format(num_streams, name, len(values)))
+	return values
+
+
+def stream_path(path, stream, num_streams):
+	'''Returns the output path of a stream, suffixed by its index if more than
+	one stream is generated.'''
+	if num_streams == 1:
+		return path
+	root, ext = os.path.splitext(path)
+	return '{}_{}{}'.format(root, stream, ext)
 
 
 def create_seed(filename,
@@ -165,27 +234,8 @@ def create_seed(filename,
 def get_generation_length_from_midi(sample_rate, midi_filepath):
 	'''Takes in a sample rate and a path to a MIDI file and 
 		returns the lenght of generation WAV file in samples and microseconds'''
-
-	pattern = midi.read_midifile(midi_filepath)
-	resolution = pattern.resolution
-	track = pattern[0]
-
-	total_microseconds = 0
-	curr_tempo = 500000
-
-	for i in range(0, len(track) - 1):
-		curr_event = track[i]
-		if curr_event.name == midi.SetTempoEvent.name:
-			tempo_binary = (format(curr_event.data[0], '08b')+
-							format(curr_event.data[1], '08b')+
-							format(curr_event.data[2], '08b'))
-			curr_tempo = int(tempo_binary, 2)
-		elif curr_event.name == midi.EndOfTrackEvent.name:
-			break
-		else:
-			total_microseconds += ((curr_tempo * curr_event.tick) / resolution)
-
-	samples_to_generate = total_microseconds * sample_rate / int(10e6)
+	total_microseconds = load_midi(midi_filepath).length_microseconds
+	samples_to_generate = total_microseconds * sample_rate / 1e6
 	return samples_to_generate, total_microseconds
 
 
@@ -198,11 +248,14 @@ def main():
 		wavenet_params = json.load(config_file)
 
 	quantization_channels = wavenet_params['quantization_channels']	
+	num_streams = args.num_streams
 
 	sess = tf.Session()
 
+	# every stream is one row of the batch, so the generator queues carry
+	# all streams and each step's matmuls are shared between them
 	net = WaveNetModel(
-		batch_size = 1,
+		batch_size = num_streams,
 		dilations = wavenet_params['dilations'],
 		filter_width = wavenet_params['filter_width'],
 		residual_channels = wavenet_params['residual_channels'],
@@ -220,38 +273,57 @@ def main():
 	# first set bool flags for conditioned generation
 	gc_enabled = args.gc_channels is not None
 	lc_enabled = args.lc_channels is not None
+	gc_ids = args.gc_id if gc_enabled else None
 	
 	# this is a placeholder for the final output
 	samples = tf.placeholder(tf.int32)
 
-	# this placeholder is for
+	# this placeholder is for the LC frame of every stream at the current step
+	lc_batch = tf.placeholder(tf.float32) if lc_enabled else None
+
+	# determine number of samples to be generated
+	# if LC enabled, then it depends on the temporal length of the longest LC file
 	if lc_enabled:
-		lc_batch = tf.placeholder(tf.float32)
+		sample_count = max(int(get_generation_length_from_midi(args.sample_rate, lc_filepath)[0])
+						   for lc_filepath in args.lc_filepath)
+	else:
+		sample_count = int(args.samples)
 	
 	# if LC is enabled, set up for LC conditioned generation
-	# TODO: figure out if this will work without starting the queue runners :/
+	# every stream gets its own LC file, zero padded to the generation length
 	if lc_enabled:
-		midifile = midi.read_midifile(args.lc_filepath)
 		mapper = MidiMapper(sample_rate = args.sample_rate, lc_channels = args.initial_lc_channels)
-		mapper.set_midi(midifile)
-		lc_embeddings = mapper.upsample()
-		print(lc_embeddings[8000])
+		lc_embeddings = np.zeros(
+			shape = (num_streams, sample_count, args.initial_lc_channels),
+			dtype = np.float32)
+		for i, lc_filepath in enumerate(args.lc_filepath):
+			mapper.set_midi(load_midi(lc_filepath))
+			stream_embeddings = mapper.upsample()[:sample_count]
+			lc_embeddings[i, :len(stream_embeddings)] = stream_embeddings
 		print("Shape of embeddings is {}".format(np.shape(lc_embeddings)))
 
-	# determine number of samples to be generated
-	# if LC enabled, then it depends on the temporal length of the LC file
-	# sample_count, microsec = get_generation_length_from_midi(args.sample_rate, args.lc_filepath) \
-	# if lc_enabled else args.samples
-
-	sample_count = args.samples
+	if args.fast_generation:
+		# the seed that primes the generator state in one run of net.prime_ops
+		priming = tf.placeholder(tf.int32)
+		priming_lc = tf.placeholder(tf.float32) if lc_enabled else None
 
-	# TODO: figure out how to give this function each LC embedding incrementally for each sample generation
-	if args.fast_generation and lc_enabled:
 		# for now (and the foreseable future) LC only works with fast generation
-		next_sample = net.predict_proba_incremental(samples, args.gc_id, lc_batch)
+		# the graph samples the next value of every stream, only its id is fetched
+		temperatures = tf.placeholder(tf.float32)
+		next_sample = net.sample_incremental(samples, temperatures, args.top_k, args.top_p,
+											 gc_ids, lc_batch,
+											 priming_waveform = priming,
+											 priming_lc = priming_lc)
+
+		# block generation loops over the same generator state inside the graph
+		if args.block_size > 1:
+			block_size = tf.placeholder(tf.int32, shape = ())
+			block_lc = tf.placeholder(tf.float32) if lc_enabled else None
+			next_block = net.generate_incremental(samples, block_size, temperatures,
+												  args.top_k, args.top_p, gc_ids, block_lc)
 	else:
 		# DEPRECATED
-		next_sample = net.predict_proba(samples, args.gc_id)
+		next_sample = net.predict_proba(samples, gc_ids)
 
 	if args.fast_generation:
 		sess.run(tf.global_variables_initializer())
@@ -269,127 +341,147 @@ def main():
 	print('Restoring model from {}'.format(args.checkpoint))
 	saver.restore(sess, args.checkpoint)
 
-	decode = mu_law_decode(samples, wavenet_params['quantization_channels'])
+	if args.fast_generation and args.numpy_generation:
+		generator = NumpyGenerator.from_session(sess, net)
+		generator.reset(gc_ids)
 
 	# if we are local conditioning then we should not need a seed at the beginning
-	if args.wav_seed:
-		# should not need this for LC
-		seed = create_seed(args.wav_seed,
-						   wavenet_params['sample_rate'],
-						   quantization_channels,
-						   net.receptive_field)
-		waveform = sess.run(seed).tolist()
-	else:
-		# Silence with a single random sample at the end.
-		waveform = [quantization_channels / 2] * (net.receptive_field - 1)
-		waveform.append(np.random.randint(quantization_channels))
-
-	if args.fast_generation and args.wav_seed:
-		# When using the incremental generation, we need to
-		# feed in all priming samples one by one before starting the
-		# actual generation.
-		# This could be done much more efficiently by passing the waveform
-		# to the incremental generator as an optional argument, which would be
-		# used to fill the queues initially.
-		# this is where the new LC samples should be passed in as this is what is called 
-		# for every iteration of the loop
-		outputs = [next_sample]
-		outputs.extend(net.push_ops)
-
+	waveforms = []
+	for wav_seed in args.wav_seed:
+		if wav_seed:
+			# should not need this for LC
+			seed = create_seed(wav_seed,
+							   wavenet_params['sample_rate'],
+							   quantization_channels,
+							   net.receptive_field)
+			waveform = sess.run(seed).tolist()
+		else:
+			# Silence with a single random sample at the end.
+			waveform = [quantization_channels // 2] * (net.receptive_field - 1)
+			waveform.append(np.random.randint(quantization_channels))
+		waveforms.append(waveform)
+
+	# Streams advance in lockstep, so left pad shorter seeds with silence.
+	seed_length = max(len(waveform) for waveform in waveforms)
+	waveforms = [[quantization_channels // 2] * (seed_length - len(waveform)) + waveform
+				 for waveform in waveforms]
+
+	if args.fast_generation and any(args.wav_seed):
+		# When using the incremental generation, the generator state has to
+		# hold all priming samples before starting the actual generation.
+		# The seed precedes the MIDI, so its LC frames are silent.
 		print('Priming generation...')
-		for i, x in enumerate(waveform[-net.receptive_field: -1]):
-			if i % 100 == 0:
-				print('Priming sample {}'.format(i))
-			sess.run(outputs, feed_dict={samples: x})
+		priming_samples = np.array(waveforms)[:, -net.receptive_field: -1]
+		if args.numpy_generation:
+			silence = np.zeros((num_streams, args.initial_lc_channels), dtype = np.float32) if lc_enabled else None
+			for i in range(priming_samples.shape[1]):
+				if i % 100 == 0:
+					print('Priming sample {}'.format(i))
+				generator.step(priming_samples[:, i], silence)
+		else:
+			feed_dict = {priming : priming_samples}
+			if lc_enabled:
+				feed_dict[priming_lc] = np.zeros(priming_samples.shape + (args.initial_lc_channels,), dtype = np.float32)
+			sess.run(net.prime_ops, feed_dict = feed_dict)
 		print('Done.')
 
+	# Stream every stream to its wav file as it is generated. The generator
+	# then only needs the last receptive field of samples in memory.
+	writers = None
+	if args.wav_out_path:
+		writers = [WavWriter(stream_path(args.wav_out_path, stream, num_streams),
+							 wavenet_params['sample_rate'],
+							 quantization_channels,
+							 buffer_size = args.save_every or wavenet_params['sample_rate'])
+				   for stream in range(num_streams)]
+		for writer, waveform in zip(writers, waveforms):
+			writer.write(waveform)
+		waveforms = [collections.deque(waveform, maxlen = net.receptive_field)
+					 for waveform in waveforms]
+
 	last_sample_timestamp = datetime.now()
 
 	# for each sample to be generated do the ops in the loop
 	print(sample_count)
-	for step in range(int(sample_count)):
-		# this is where it should be changed to account for LC?
-		if args.fast_generation:
-			outputs = [next_sample]
-			# push_ops is inside model's create_generator
-			# where push_ops.append(push)
-			# where push = q.enqueue([current_layer])
-			# where current_layer = input_batch of the input to the create_generator function
-			outputs.extend(net.push_ops)
-			window = waveform[-1]
+	step = 0
+	while step < sample_count:
+		if args.block_size > 1:
+			# Run the WaveNet for a whole block, it samples and feeds back internally.
+			count = min(args.block_size, sample_count - step)
+			feed_dict = {samples : [waveform[-1] for waveform in waveforms],
+						 block_size : count,
+						 temperatures : args.temperature}
+			if lc_enabled:
+				feed_dict[block_lc] = lc_embeddings[:, step:step + count, :]
+			sampled = sess.run(next_block, feed_dict = feed_dict)
 		else:
-			if len(waveform) > net.receptive_field:
-				window = waveform[-net.receptive_field:]
+			count = 1
+			# this is where it should be changed to account for LC?
+			if args.fast_generation:
+				outputs = [next_sample]
+				# push_ops is inside model's create_generator
+				# where push_ops.append(push)
+				# where push = q.enqueue([current_layer])
+				# where current_layer = input_batch of the input to the create_generator function
+				outputs.extend(net.push_ops)
+				window = [waveform[-1] for waveform in waveforms]
 			else:
-				window = waveform
-			outputs = [next_sample]
-
-		# Run the WaveNet to predict the next sample.
-		if lc_enabled:
-			prediction = sess.run(
-				outputs,
-				feed_dict = {
-					samples : window,
-					lc_batch : np.reshape(lc_embeddings[step], (1, args.initial_lc_channels))
-				})[0]
-		else:
-			prediction = sess.run(
-				outputs,
-				feed_dict = {
-					samples : window,
-				})[0]
-
-		# this should not need to be changed for LC
-		# Scale prediction distribution using temperature.
-		np.seterr(divide = 'ignore')
-		scaled_prediction = np.log(prediction) / args.temperature
-		scaled_prediction = (scaled_prediction - np.logaddexp.reduce(scaled_prediction))
-		scaled_prediction = np.exp(scaled_prediction)
-		np.seterr(divide = 'warn')
-
-		# Prediction distribution at temperature=1.0 should be unchanged after
-		# scaling.
-		if args.temperature == 1.0:
-			np.testing.assert_allclose(
-					prediction, scaled_prediction, atol = 1e-5,
-					err_msg = 'Prediction scaling at temperature=1.0 '
-							'is not working as intended.')
-
-		sample = np.random.choice(
-			np.arange(quantization_channels), p = scaled_prediction)
-		waveform.append(sample)
+				# naive generation only supports a single stream
+				window = list(waveforms[0])[-net.receptive_field:]
+				outputs = [next_sample]
+
+			# Run the WaveNet to predict the next sample.
+			if args.fast_generation and args.numpy_generation:
+				lc_frame = lc_embeddings[:, step, :] if lc_enabled else None
+				prediction = generator.step(window, lc_frame)
+				sampled = sample_categorical_numpy(prediction, args.temperature, args.top_k, args.top_p)
+			elif args.fast_generation:
+				feed_dict = {samples : window, temperatures : args.temperature}
+				if lc_enabled:
+					feed_dict[lc_batch] = lc_embeddings[:, step, :]
+				sampled = sess.run(outputs, feed_dict = feed_dict)[0]
+			else:
+				prediction = sess.run(outputs, feed_dict = {samples : window})[0]
+				sampled = sample_categorical_numpy(prediction, args.temperature, args.top_k, args.top_p)
+			sampled = np.reshape(sampled, [num_streams, 1])
+
+		for stream in range(num_streams):
+			waveforms[stream].extend(sampled[stream])
+			if writers:
+				writers[stream].write(sampled[stream])
+		step += count
 
 		# Show progress only once per second.
 		current_sample_timestamp = datetime.now()
 		time_since_print = current_sample_timestamp - last_sample_timestamp
 		if time_since_print.total_seconds() > 1.:
-			print('Sample {:3<f}/{:3<f}'.format(step + 1, sample_count),
+			print('Sample {:3<f}/{:3<f}'.format(step, sample_count),
 				  end = '\r')
 			last_sample_timestamp = current_sample_timestamp
 
-		# If we have partial writing, save the result so far.
-		if (args.wav_out_path and args.save_every and
-				(step + 1) % args.save_every == 0):
-			out = sess.run(decode, feed_dict = {samples: waveform})
-			write_wav(out, wavenet_params['sample_rate'], args.wav_out_path)
-
 	# Introduce a newline to clear the carriage return from the progress.
 	print()
 
+	# Save the result as a wav file.
+	if writers:
+		for writer in writers:
+			writer.close()
+		# only the tail is left in memory, the summary reads the result back
+		generated = [librosa.load(writer.filename, sr = None, mono = True)[0] for writer in writers]
+	else:
+		generated = [mu_law_decode_numpy(waveform, quantization_channels) for waveform in waveforms]
+
 	# Save the result as an audio summary.
 	datestring = str(datetime.now()).replace(' ', 'T')
 	writer = tf.summary.FileWriter(logdir)
-	tf.summary.audio('generated', decode, wavenet_params['sample_rate'])
+	audio = tf.placeholder(tf.float32)
+	tf.summary.audio('generated', audio, wavenet_params['sample_rate'],
+					 max_outputs = num_streams)
 	summaries = tf.summary.merge_all()
 	summary_out = sess.run(summaries,
-						   feed_dict={samples: np.reshape(waveform, [-1, 1])})
+						   feed_dict={audio: np.reshape(generated, [num_streams, -1])})
 	writer.add_summary(summary_out)
 
-	# Save the result as a wav file.
-	if args.wav_out_path:
-		out = sess.run(decode, feed_dict={samples: waveform})
-		write_wav(out, wavenet_params['sample_rate'], args.wav_out_path)
-
 	print('Finished generating. The result can be viewed in TensorBoard.')
 
 
@@ -0,0 +1,85 @@
+"""Preprocessing script for the LC WaveNet training data.
+
+Decodes, resamples and silence trims every wav file of the data directory once,
+upsamples the matching MIDI files, and stores both as .npy files in a cache
+directory. Pass the same directory to train.py with --cache-dir to train from
+the cache instead of decoding the files again on every epoch.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+
+from wavenet import build_cache
+
+WAVENET_PARAMS = './wavenet_params.json'
+SILENCE_THRESHOLD = None
+EPSILON = 0.001
+
+
+def get_arguments():
+	parser = argparse.ArgumentParser(description = 'WaveNet dataset preprocessing')
+
+	parser.add_argument('--data-dir',
+		type = str,
+		required = True,
+		help = 'The directory containing training WAV data and any LC files if LC enabled. Expects: path')
+
+	parser.add_argument('--cache-dir',
+		type = str,
+		required = True,
+		help = 'The directory to write the preprocessed dataset to. Expects: path')
+
+	parser.add_argument('--wavenet-params',
+		type = str,
+		default = WAVENET_PARAMS,
+		help = 'JSON file with the network parameters. Default: ' + WAVENET_PARAMS + '. Expects: string')
+
+	parser.add_argument('--silence-threshold',
+		type = float,
+		default = SILENCE_THRESHOLD,
+		help = 'Volume threshold below which to trim the start '
+		'and the end from the training set samples. Default: ' + str(SILENCE_THRESHOLD) + '. Expects: float32')
+
+	parser.add_argument('--initial-lc-channels',
+		type = int,
+		default = None,
+		help = "Number of local conditioning channels. Default: None. Expecting: int")
+
+	parser.add_argument('--lc-fileformat',
+		type = str,
+		default = None,
+		help = "Extension of files being used for local conditioning. Default: None. Expecting: string")
+
+	return parser.parse_args()
+
+
+def main():
+	args = get_arguments()
+
+	with open(args.wavenet_params, 'r') as f:
+		wavenet_params = json.load(f)
+
+	lc_enabled = args.initial_lc_channels is not None
+	if lc_enabled and args.lc_fileformat is None:
+		raise ValueError("LC file format must be specified when local conditioning is enabled.")
+
+	# same convention as train.py, a threshold near zero disables trimming
+	silence_threshold = args.silence_threshold
+	if silence_threshold is not None and silence_threshold <= EPSILON:
+		silence_threshold = None
+
+	entries = build_cache(data_dir = args.data_dir,
+						  cache_dir = args.cache_dir,
+						  sample_rate = wavenet_params['sample_rate'],
+						  lc_enabled = lc_enabled,
+						  lc_channels = args.initial_lc_channels,
+						  lc_fileformat = args.lc_fileformat,
+						  silence_threshold = silence_threshold)
+
+	print("Cached {} files in {}".format(len(entries), args.cache_dir))
+
+
+if __name__ == '__main__':
+	main()
@@ -3,7 +3,12 @@
 import numpy as np
 import tensorflow as tf
 
-from wavenet import time_to_batch, batch_to_time, causal_conv
+from wavenet import (time_to_batch, batch_to_time, causal_conv,
+                     dilated_causal_conv)
+
+BENCHMARK_BATCH_SIZE = 1
+BENCHMARK_WIDTH = 16000
+BENCHMARK_CHANNELS = 32
 
 
 class TestCausalConv(tf.test.TestCase):
@@ -59,6 +64,73 @@ class TestCausalConv(tf.test.TestCase):
         # The output time series should be identical to the input series.
         self.assertAllEqual(result, x)
 
+    def testDilatedCausalConv(self):
+        """Tests that the atrous op matches causal_conv, also for a fused
+        filter and gate."""
+        np.random.seed(0)
+        x = np.random.randn(3, 50, 4).astype(np.float32)
+        filter_ = np.random.randn(2, 4, 5).astype(np.float32)
+        gate = np.random.randn(2, 4, 5).astype(np.float32)
+        fused = np.concatenate([filter_, gate], axis=2)
+
+        outputs = []
+        for dilation in [1, 2, 4, 7, 16]:
+            fused_filter, fused_gate = tf.split(
+                dilated_causal_conv(x, fused, dilation), 2, axis=2)
+            outputs.append((causal_conv(x, filter_, dilation),
+                            causal_conv(x, gate, dilation),
+                            fused_filter, fused_gate))
+
+        with self.test_session() as sess:
+            results = sess.run(outputs)
+
+        for filter_ref, gate_ref, filter_out, gate_out in results:
+            self.assertAllEqual(filter_out.shape, filter_ref.shape)
+            self.assertAllClose(filter_out, filter_ref, atol=1e-5)
+            self.assertAllClose(gate_out, gate_ref, atol=1e-5)
+
+
+class CausalConvBenchmark(tf.test.Benchmark):
+    """Compares the step time of a gated dilated layer with causal_conv, with
+    dilated_causal_conv and with one dilated_causal_conv over the
+    concatenated filter and gate. Run with --benchmarks=CausalConvBenchmark."""
+
+    def _benchmark(self, conv, dilation):
+        with tf.Graph().as_default(), tf.Session() as sess:
+            x = tf.Variable(tf.random_normal(
+                [BENCHMARK_BATCH_SIZE, BENCHMARK_WIDTH, BENCHMARK_CHANNELS]))
+            filter_ = tf.Variable(tf.random_normal(
+                [2, BENCHMARK_CHANNELS, BENCHMARK_CHANNELS]))
+            gate = tf.Variable(tf.random_normal(
+                [2, BENCHMARK_CHANNELS, BENCHMARK_CHANNELS]))
+            if conv == 'fused':
+                conv_filter, conv_gate = tf.split(dilated_causal_conv(
+                    x, tf.concat([filter_, gate], axis=2), dilation),
+                    2, axis=2)
+            elif conv == 'dilated_causal_conv':
+                conv_filter = dilated_causal_conv(x, filter_, dilation)
+                conv_gate = dilated_causal_conv(x, gate, dilation)
+            else:
+                conv_filter = causal_conv(x, filter_, dilation)
+                conv_gate = causal_conv(x, gate, dilation)
+            out = tf.tanh(conv_filter) * tf.sigmoid(conv_gate)
+            sess.run(tf.global_variables_initializer())
+            self.run_op_benchmark(
+                sess, out.op, min_iters=50,
+                name='{}_dilation{}'.format(conv, dilation))
+
+    def benchmarkCausalConv(self):
+        for dilation in [1, 16, 256]:
+            self._benchmark('causal_conv', dilation)
+
+    def benchmarkDilatedCausalConv(self):
+        for dilation in [1, 16, 256]:
+            self._benchmark('dilated_causal_conv', dilation)
+
+    def benchmarkFusedDilatedCausalConv(self):
+        for dilation in [1, 16, 256]:
+            self._benchmark('fused', dilation)
+
 
 if __name__ == '__main__':
     tf.test.main()
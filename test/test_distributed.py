@@ -0,0 +1,191 @@
+"""Unit tests for training with the variables on a parameter server."""
+
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+
+import numpy as np
+import tensorflow as tf
+
+from wavenet import WaveNetModel, optimizer_factory
+
+QUANTIZATION_CHANNELS = 256
+TRAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            os.pardir, 'train.py')
+SAMPLE_RATE = 16000
+NUM_FILES = 4
+NUM_STEPS = 6
+NUM_WORKERS = 2
+TIMEOUT = 300
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def write_wav(filename, audio):
+    wav = wave.open(filename, 'wb')
+    try:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes((audio * 32767).astype('<i2').tobytes())
+    finally:
+        wav.close()
+
+
+class TestDistributed(tf.test.TestCase):
+    """Workers of a local cluster on localhost ports share the variables
+    placed by replica_device_setter."""
+
+    def testWorkersShareVariables(self):
+        workers, _ = tf.test.create_local_cluster(num_workers=2, num_ps=1)
+        with tf.device(tf.train.replica_device_setter(
+                ps_tasks=1, worker_device='/job:worker/task:0')):
+            net = WaveNetModel(batch_size=1,
+                               dilations=[1, 2, 4],
+                               filter_width=2,
+                               residual_channels=8,
+                               dilation_channels=8,
+                               quantization_channels=QUANTIZATION_CHANNELS,
+                               skip_channels=16,
+                               use_biases=True)
+        for variable in tf.global_variables():
+            self.assertEqual(variable.device, '/job:ps/task:0')
+
+        audio = np.random.uniform(-1, 1, (1, 100, 1)).astype(np.float32)
+        loss = net.loss(audio)
+        optimizer = optimizer_factory['sgd'](learning_rate=0.1,
+                                             momentum=0.9)
+        optim = optimizer.minimize(loss)
+        postprocess = net.variables['postprocessing']['postprocess2']
+
+        chief = tf.Session(workers[0].target)
+        other = tf.Session(workers[1].target)
+        chief.run(tf.global_variables_initializer())
+        self.assertEqual(len(other.run(tf.report_uninitialized_variables())),
+                         0)
+        before = other.run(postprocess)
+        chief.run(optim)
+        self.assertFalse(np.allclose(other.run(postprocess), before))
+
+
+class TestDistributedTraining(tf.test.TestCase):
+    """Runs train.py as one parameter server and two workers on localhost
+    ports."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.data_dir = os.path.join(self.directory, 'data')
+        os.makedirs(self.data_dir)
+        for index in range(NUM_FILES):
+            write_wav(os.path.join(self.data_dir,
+                                   'clip{}.wav'.format(index)),
+                      np.random.uniform(-0.5, 0.5, 400))
+        self.params = os.path.join(self.directory, 'params.json')
+        with open(self.params, 'w') as f:
+            json.dump({'filter_width': 2,
+                       'sample_rate': SAMPLE_RATE,
+                       'dilations': [1, 2],
+                       'residual_channels': 4,
+                       'dilation_channels': 4,
+                       'quantization_channels': QUANTIZATION_CHANNELS,
+                       'skip_channels': 8,
+                       'use_biases': True,
+                       'scalar_input': False,
+                       'initial_filter_width': 2}, f)
+        self.processes = []
+
+    def tearDown(self):
+        for process, output in self.processes:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+            output.close()
+        shutil.rmtree(self.directory)
+
+    def start(self, job_name, task_index, cluster):
+        '''Starts train.py in the background, its output goes to a file so
+        that it never blocks on a full pipe.'''
+        output = open(os.path.join(self.directory, '{}{}.log'.format(
+            job_name, task_index)), 'w')
+        process = subprocess.Popen(
+            [sys.executable, '-u', TRAIN_SCRIPT,
+             '--job-name', job_name,
+             '--task-index', str(task_index),
+             '--data-dir', self.data_dir,
+             '--logdir', os.path.join(self.directory,
+                                      '{}{}'.format(job_name, task_index)),
+             '--wavenet-params', self.params,
+             '--sample-size', '100',
+             '--num-steps', str(NUM_STEPS),
+             '--checkpoint-every', '2'] + cluster,
+            stdout=output, stderr=subprocess.STDOUT)
+        self.processes.append((process, output))
+        return process
+
+    def output(self, job_name, task_index):
+        with open(os.path.join(self.directory, '{}{}.log'.format(
+                job_name, task_index))) as f:
+            return f.read()
+
+    def testTrainScriptOnLocalhost(self):
+        cluster = ['--ps-hosts', 'localhost:{}'.format(free_port()),
+                   '--worker-hosts', ','.join(
+                       'localhost:{}'.format(free_port())
+                       for _ in range(NUM_WORKERS))]
+        self.start('ps', 0, cluster)
+
+        # The other worker waits for the chief, which is not running yet.
+        other = self.start('worker', 1, cluster)
+        deadline = time.time() + TIMEOUT
+        while 'Waiting for the chief' not in self.output('worker', 1):
+            self.assertIsNone(other.poll(), self.output('worker', 1))
+            self.assertLess(time.time(), deadline)
+            time.sleep(1)
+
+        chief = self.start('worker', 0, cluster)
+        chief.wait(timeout=TIMEOUT)
+        other.wait(timeout=TIMEOUT)
+        chief_output = self.output('worker', 0)
+        other_output = self.output('worker', 1)
+        self.assertEqual(chief.returncode, 0, chief_output)
+        self.assertEqual(other.returncode, 0, other_output)
+
+        # The workers share the global step, so together they run
+        # --num-steps updates, and one more for every worker that read the
+        # last step at the same time as another.
+        steps = [int(step) for step in re.findall(
+            r'^step (\d+) - loss', chief_output + other_output, re.M)]
+        self.assertGreaterEqual(len(steps), NUM_STEPS)
+        self.assertLessEqual(len(steps), NUM_STEPS + NUM_WORKERS - 1)
+        self.assertLess(max(steps), NUM_STEPS)
+
+        # Only the chief saves checkpoints.
+        self.assertIsNotNone(tf.train.latest_checkpoint(
+            os.path.join(self.directory, 'worker0')))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.directory, 'worker1')))
+
+        # Every worker only reads its own shard of the sorted files.
+        for task_index, output in enumerate([chief_output, other_output]):
+            read = set(re.findall(r'clip\d+\.wav', output))
+            self.assertTrue(read)
+            self.assertLessEqual(read, set(
+                'clip{}.wav'.format(index)
+                for index in range(task_index, NUM_FILES, NUM_WORKERS)))
+
+
+if __name__ == '__main__':
+    tf.test.main()
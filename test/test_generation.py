@@ -2,7 +2,7 @@ import numpy as np
 
 import tensorflow as tf
 
-from wavenet import WaveNetModel
+from wavenet import WaveNetModel, NumpyGenerator
 
 
 class TestGeneration(tf.test.TestCase):
@@ -71,6 +71,70 @@ class TestGeneration(tf.test.TestCase):
             proba_ = sess.run(proba, feed_dict={waveform: data})
             self.assertAllClose(proba_, proba_fast_)
 
+    def testCompareNumpyFast(self):
+        '''The NumPy generator must track the queue based generator.'''
+        waveform = tf.placeholder(tf.int32)
+        np.random.seed(0)
+        data = np.random.randint(128, size=600)
+        proba_fast = self.net.predict_proba_incremental(waveform)
+        with self.test_session() as sess:
+            sess.run(tf.global_variables_initializer())
+            sess.run(self.net.init_ops)
+            generator = NumpyGenerator.from_session(sess, self.net)
+            for x in data:
+                proba_fast_ = sess.run(
+                    [proba_fast, self.net.push_ops],
+                    feed_dict={waveform: x})[0]
+                proba_numpy_ = generator.step(x)
+                self.assertAllClose(proba_fast_, proba_numpy_[0], atol=1e-5)
+
+    def testComparePrimedSimple(self):
+        '''Priming in one run leaves the same state as pushing every
+        sample.'''
+        waveform = tf.placeholder(tf.int32)
+        priming = tf.placeholder(tf.int32)
+        np.random.seed(0)
+        data = np.random.randint(128, size=1000)
+        proba = self.net.predict_proba(waveform)
+        proba_fast = self.net.predict_proba_incremental(
+            waveform, priming_waveform=priming)
+        with self.test_session() as sess:
+            sess.run(tf.global_variables_initializer())
+            sess.run(self.net.prime_ops, feed_dict={priming: data[:-1]})
+            proba_fast_ = sess.run(proba_fast,
+                                   feed_dict={waveform: data[-1]})
+            proba_ = sess.run(proba, feed_dict={waveform: data})
+            self.assertAllClose(proba_, proba_fast_, atol=1e-5)
+
+    def testCompareBlockFast(self):
+        '''A block generated in the graph continues like single steps.'''
+        waveform = tf.placeholder(tf.int32)
+        priming = tf.placeholder(tf.int32)
+        num_samples = tf.placeholder(tf.int32, shape=())
+        # A tiny temperature makes sampling deterministic.
+        temperature = 1e-4
+        next_sample = self.net.sample_incremental(
+            waveform, temperature, priming_waveform=priming)
+        next_block = self.net.generate_incremental(waveform, num_samples,
+                                                   temperature)
+        with self.test_session() as sess:
+            sess.run(tf.global_variables_initializer())
+            sess.run(self.net.prime_ops, feed_dict={priming: [3]})
+            sample = 5
+            single = []
+            for _ in range(20):
+                sample = sess.run([next_sample, self.net.push_ops],
+                                  feed_dict={waveform: sample})[0][0]
+                single.append(sample)
+
+            sess.run(self.net.prime_ops, feed_dict={priming: [3]})
+            first = sess.run(next_block, feed_dict={waveform: 5,
+                                                    num_samples: 10})
+            second = sess.run(next_block, feed_dict={waveform: first[0, -1],
+                                                     num_samples: 10})
+
+        self.assertAllEqual(np.concatenate([first[0], second[0]]), single)
+
 
 class TestGenerationBiases(TestGeneration):
 
@@ -85,5 +149,105 @@ class TestGenerationBiases(TestGeneration):
                                 skip_channels=32)
 
 
+class TestGenerationStreams(tf.test.TestCase):
+
+    def setUp(self):
+        self.net = WaveNetModel(batch_size=3,
+                                dilations=[1, 2, 4, 8, 16, 32],
+                                filter_width=2,
+                                use_biases=True,
+                                residual_channels=16,
+                                dilation_channels=16,
+                                quantization_channels=128,
+                                skip_channels=32)
+
+    def testStreamsAreIndependent(self):
+        '''Each batch row of the incremental generator is its own stream.'''
+        waveform = tf.placeholder(tf.int32)
+        np.random.seed(0)
+        data = np.random.randint(128, size=(200, 3))
+        proba_fast = self.net.predict_proba_incremental(waveform)
+        with self.test_session() as sess:
+            sess.run(tf.global_variables_initializer())
+            sess.run(self.net.init_ops)
+            single = NumpyGenerator.from_session(sess, self.net, batch_size=1)
+            for x in data:
+                proba_fast_ = sess.run(
+                    [proba_fast, self.net.push_ops],
+                    feed_dict={waveform: x})[0]
+                proba_single_ = single.step(x[1:2])
+                self.assertAllEqual(proba_fast_.shape, [3, 128])
+                self.assertAllClose(proba_fast_[1], proba_single_[0],
+                                    atol=1e-5)
+
+
+class TestGenerationLC(tf.test.TestCase):
+
+    def setUp(self):
+        self.net = WaveNetModel(batch_size=1,
+                                dilations=[1, 2, 4, 8, 16, 32, 64],
+                                filter_width=2,
+                                use_biases=True,
+                                residual_channels=16,
+                                dilation_channels=16,
+                                quantization_channels=128,
+                                skip_channels=32,
+                                initial_lc_channels=8,
+                                lc_channels=4)
+
+    def testCompareSimpleFast(self):
+        '''The incremental generators see the same LC history as the
+        parallel network.'''
+        waveform = tf.placeholder(tf.int32)
+        local_condition = tf.placeholder(tf.float32)
+        np.random.seed(0)
+        data = np.random.randint(128, size=400)
+        lc = np.random.randint(0, 2, size=(400, 8)).astype(np.float32)
+        proba = self.net.predict_proba(
+            waveform, local_condition=tf.reshape(local_condition, [1, -1, 8]))
+        proba_fast = self.net.predict_proba_incremental(
+            waveform, lc_embedding=tf.reshape(local_condition, [1, 8]))
+        with self.test_session() as sess:
+            sess.run(tf.global_variables_initializer())
+            sess.run(self.net.init_ops)
+            generator = NumpyGenerator.from_session(sess, self.net)
+            for x, frame in zip(data, lc):
+                proba_fast_ = sess.run(
+                    [proba_fast, self.net.push_ops],
+                    feed_dict={waveform: x, local_condition: frame})[0]
+                proba_numpy_ = generator.step(x, frame)
+                self.assertAllClose(proba_fast_, proba_numpy_[0], atol=1e-5)
+
+            proba_ = sess.run(proba, feed_dict={waveform: data,
+                                                local_condition: lc})
+            self.assertAllClose(proba_, proba_fast_, atol=1e-5)
+
+    def testComparePrimedFast(self):
+        '''Priming with LC in one run leaves the same state as pushing every
+        sample and frame.'''
+        waveform = tf.placeholder(tf.int32)
+        local_condition = tf.placeholder(tf.float32)
+        priming = tf.placeholder(tf.int32)
+        priming_lc = tf.placeholder(tf.float32)
+        np.random.seed(0)
+        data = np.random.randint(128, size=50)
+        lc = np.random.randint(0, 2, size=(50, 8)).astype(np.float32)
+        proba_fast = self.net.predict_proba_incremental(
+            waveform, lc_embedding=tf.reshape(local_condition, [1, 8]),
+            priming_waveform=priming, priming_lc=priming_lc)
+        with self.test_session() as sess:
+            sess.run(tf.global_variables_initializer())
+            generator = NumpyGenerator.from_session(sess, self.net)
+            for x, frame in zip(data[:-1], lc[:-1]):
+                generator.step(x, frame)
+            sess.run(self.net.prime_ops,
+                     feed_dict={priming: data[:-1], priming_lc: lc[:-1]})
+            proba_fast_ = sess.run(
+                proba_fast,
+                feed_dict={waveform: data[-1], local_condition: lc[-1]})
+            proba_numpy_ = generator.step(data[-1], lc[-1])
+            self.assertAllClose(proba_fast_, proba_numpy_[0], atol=1e-5)
+
+
 if __name__ == '__main__':
     tf.test.main()
@@ -0,0 +1,45 @@
+"""Unit tests for gradient accumulation."""
+
+import numpy as np
+import tensorflow as tf
+
+from wavenet import accumulate_gradients
+
+
+class TestGradientAccumulation(tf.test.TestCase):
+
+    def testMeanOfMicrobatches(self):
+        '''Two accumulated batches update like one step on their mean
+        gradient, and the buffers start over after the update.'''
+        weights = tf.Variable([1.0, 2.0])
+        batch = tf.placeholder(tf.float32, [2])
+        loss = tf.reduce_sum(weights * batch)
+        optimizer = tf.train.GradientDescentOptimizer(learning_rate=0.5)
+        accumulate, apply_op = accumulate_gradients(
+            optimizer, optimizer.compute_gradients(loss), num_steps=2)
+
+        with self.test_session() as sess:
+            sess.run([tf.global_variables_initializer(),
+                      tf.local_variables_initializer()])
+            sess.run(accumulate, feed_dict={batch: [1.0, 3.0]})
+            sess.run(accumulate, feed_dict={batch: [3.0, 5.0]})
+            sess.run(apply_op)
+            self.assertAllClose(sess.run(weights), [0.0, 0.0])
+
+            sess.run(accumulate, feed_dict={batch: [2.0, 2.0]})
+            sess.run(accumulate, feed_dict={batch: [2.0, 2.0]})
+            sess.run(apply_op)
+            self.assertAllClose(sess.run(weights), [-1.0, -1.0])
+
+    def testBuffersAreNotSaved(self):
+        weights = tf.Variable([1.0])
+        loss = tf.reduce_sum(weights)
+        optimizer = tf.train.GradientDescentOptimizer(learning_rate=0.5)
+        accumulate_gradients(optimizer, optimizer.compute_gradients(loss),
+                             num_steps=2)
+        self.assertEqual(tf.global_variables(), [weights])
+        self.assertEqual(len(tf.local_variables()), 1)
+
+
+if __name__ == '__main__':
+    tf.test.main()
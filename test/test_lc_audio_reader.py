@@ -0,0 +1,205 @@
+"""Unit tests for the queue based reader."""
+
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+
+from wavenet import LCAudioReader
+from wavenet.lc_audio_reader import (build_chunk_index, read_cache_index,
+                                     ChunkSampler, ReaderTimings, build_cache,
+                                     read_cache)
+
+RECEPTIVE_FIELD = 5
+SAMPLE_SIZE = 10
+NUM_SAMPLES = 25
+LC_CHANNELS = 4
+
+
+def write_cache(data_dir, cache_dir, audio, roll):
+    '''Writes a valid cache for one wav and midi pair, so nothing has to be
+    decoded.'''
+    filename = os.path.join(data_dir, 'clip.wav')
+    midi_name = os.path.join(data_dir, 'clip.mid')
+    for name in (filename, midi_name):
+        open(name, 'w').close()
+    np.save(os.path.join(cache_dir, 'clip.audio.npy'), audio)
+    np.save(os.path.join(cache_dir, 'clip.lc.npy'), roll)
+    index = {'settings': {'sample_rate': 16000,
+                          'lc_channels': LC_CHANNELS,
+                          'silence_threshold': None},
+             'entries': [{'filename': filename,
+                          'mtimes': [os.path.getmtime(filename),
+                                     os.path.getmtime(midi_name)],
+                          'audio': 'clip.audio.npy',
+                          'lc': 'clip.lc.npy'}]}
+    with open(os.path.join(cache_dir, 'index.json'), 'w') as f:
+        json.dump(index, f)
+
+
+class TestLCAudioReader(tf.test.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+        # Sample k has the value k + 1 and plays note k % LC_CHANNELS.
+        audio = np.arange(1, NUM_SAMPLES + 1, dtype=np.float32)
+        roll = np.zeros((NUM_SAMPLES, LC_CHANNELS), dtype=np.uint8)
+        roll[np.arange(NUM_SAMPLES), np.arange(NUM_SAMPLES) % LC_CHANNELS] = 1
+        write_cache(self.data_dir, self.cache_dir, audio.reshape(-1, 1), roll)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+        shutil.rmtree(self.cache_dir)
+
+    def checkAligned(self, lc_transport, chunk_sampling='sequential'):
+        '''Every dequeued LC row belongs to the audio sample next to it.'''
+        with self.test_session() as sess:
+            reader = LCAudioReader(data_dir=self.data_dir,
+                                   coord=tf.train.Coordinator(),
+                                   receptive_field=RECEPTIVE_FIELD,
+                                   lc_enabled=True,
+                                   lc_channels=LC_CHANNELS,
+                                   lc_fileformat='*.mid',
+                                   sample_size=SAMPLE_SIZE,
+                                   sess=sess,
+                                   lc_transport=lc_transport,
+                                   cache_dir=self.cache_dir,
+                                   enqueue_batch=2,
+                                   chunk_sampling=chunk_sampling)
+            audio_batch = reader.dq_audio(2)
+            lc_batch = reader.dq_lc(2)
+            reader.start_threads(n_threads=2)
+            batches = [sess.run([audio_batch, lc_batch]) for _ in range(3)]
+            sess.run(reader.queue.close(cancel_pending_enqueues=True))
+
+        for audio, lc in batches:
+            for piece, rows in zip(audio, lc):
+                for value, row in zip(piece[:, 0], rows):
+                    expected = np.zeros(LC_CHANNELS)
+                    if value > 0:
+                        expected[int(value - 1) % LC_CHANNELS] = 1
+                    self.assertAllEqual(row, expected)
+
+    def testDense(self):
+        self.checkAligned('dense')
+
+    def testIntervals(self):
+        self.checkAligned('intervals')
+
+    def testUniformSampling(self):
+        self.checkAligned('dense', 'uniform')
+
+    def testStratifiedIntervals(self):
+        self.checkAligned('intervals', 'stratified')
+
+    def testLengthBuckets(self):
+        '''A batch only holds chunks of one bucket, with their lengths.'''
+        with self.test_session() as sess:
+            reader = LCAudioReader(data_dir=self.data_dir,
+                                   coord=tf.train.Coordinator(),
+                                   receptive_field=RECEPTIVE_FIELD,
+                                   lc_enabled=True,
+                                   lc_channels=LC_CHANNELS,
+                                   lc_fileformat='*.mid',
+                                   sample_size=SAMPLE_SIZE,
+                                   sess=sess,
+                                   cache_dir=self.cache_dir,
+                                   length_buckets=[10, 15])
+            audio_batch = reader.dq_audio(2)
+            length_batch = reader.dq_length(2)
+            reader.start_threads(n_threads=1)
+            batches = [sess.run([audio_batch, length_batch])
+                       for _ in range(3)]
+            sess.run(reader.queue.close(cancel_pending_enqueues=True))
+
+        for audio, lengths in batches:
+            self.assertEqual(lengths[0], lengths[1])
+            self.assertEqual(audio.shape[1], lengths[0])
+
+    def testStats(self):
+        '''The reader reports its queue, dequeue and stage statistics.'''
+        with self.test_session() as sess:
+            reader = LCAudioReader(data_dir=self.data_dir,
+                                   coord=tf.train.Coordinator(),
+                                   receptive_field=RECEPTIVE_FIELD,
+                                   lc_enabled=True,
+                                   lc_channels=LC_CHANNELS,
+                                   lc_fileformat='*.mid',
+                                   sample_size=SAMPLE_SIZE,
+                                   sess=sess,
+                                   cache_dir=self.cache_dir)
+            reader.dq_audio(1)
+            reader.start_threads(n_threads=1)
+            stats = [sess.run(reader.stats) for _ in range(3)]
+            sess.run(reader.queue.close(cancel_pending_enqueues=True))
+
+        for values in stats:
+            self.assertGreaterEqual(values['queue_size'], 0)
+            self.assertGreaterEqual(values['dequeue_wait'], 0)
+        timings = reader.timings.collect()
+        for name in ['decode_ms', 'upsample_ms', 'enqueue_ms',
+                     'files_per_sec']:
+            self.assertIn(name, timings)
+        self.assertGreater(timings['files_per_sec'], 0)
+
+    def testTimings(self):
+        timings = ReaderTimings()
+        timings.add('decode', 0.5)
+        timings.add('decode', 1.5)
+        list(timings.timed(range(3), 'chunk'))
+        stats = timings.collect()
+        self.assertEqual(stats['decode_ms'], 1000)
+        self.assertIn('chunk_ms', stats)
+        self.assertEqual(timings.collect(), {'files_per_sec': 0})
+
+    def testEmptyShard(self):
+        '''A worker without files of its own fails early.'''
+        with self.assertRaises(ValueError):
+            LCAudioReader(data_dir=self.data_dir,
+                          coord=tf.train.Coordinator(),
+                          receptive_field=RECEPTIVE_FIELD,
+                          lc_enabled=True,
+                          lc_channels=LC_CHANNELS,
+                          lc_fileformat='*.mid',
+                          sample_size=SAMPLE_SIZE,
+                          cache_dir=self.cache_dir,
+                          shard_index=1,
+                          num_shards=2)
+
+    def testUpToDateCacheIsOnlyRead(self):
+        '''An up to date index is not rewritten, and a stale one is not
+        served to readers that only read the cache.'''
+        index_path = os.path.join(self.cache_dir, 'index.json')
+        os.utime(index_path, (0, 0))
+        args = (self.data_dir, self.cache_dir, 16000, True, LC_CHANNELS,
+                '*.mid')
+        entries = build_cache(*args)
+        self.assertEqual(os.path.getmtime(index_path), 0)
+        self.assertEqual(read_cache(*args), entries)
+
+        wav = os.path.join(self.data_dir, 'clip.wav')
+        os.utime(wav, (1, 1))
+        self.assertIsNone(read_cache(*args))
+
+    def testChunkIndex(self):
+        '''The index lists the chunks of the sequential walk.'''
+        entries = read_cache_index(self.cache_dir)['entries']
+        files, starts = build_chunk_index(self.cache_dir, entries,
+                                          RECEPTIVE_FIELD, SAMPLE_SIZE)
+        self.assertAllEqual(files, [0, 0, 0])
+        self.assertAllEqual(starts, [-5, 5, 15])
+
+    def testStratifiedSampler(self):
+        '''Every file is drawn equally often, however many chunks it has.'''
+        files = np.array([0] * 9 + [1])
+        sampler = ChunkSampler(files, np.arange(10), stratified=True, seed=0)
+        draws = [sampler.sample()[0] for _ in range(2000)]
+        self.assertNear(np.mean(draws), 0.5, 0.05)
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -0,0 +1,70 @@
+"""Unit tests for the tf.data based reader."""
+
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+
+from wavenet import LCDatasetReader
+
+RECEPTIVE_FIELD = 5
+SAMPLE_SIZE = 10
+NUM_SAMPLES = 25
+
+
+def write_cache(data_dir, cache_dir, audio):
+    '''Writes a valid cache for one wav file, so nothing has to be decoded.'''
+    filename = os.path.join(data_dir, 'clip.wav')
+    open(filename, 'w').close()
+    np.save(os.path.join(cache_dir, 'clip.audio.npy'), audio)
+    index = {'settings': {'sample_rate': 16000,
+                          'lc_channels': None,
+                          'silence_threshold': None},
+             'entries': [{'filename': filename,
+                          'mtimes': [os.path.getmtime(filename)],
+                          'audio': 'clip.audio.npy',
+                          'lc': None}]}
+    with open(os.path.join(cache_dir, 'index.json'), 'w') as f:
+        json.dump(index, f)
+
+
+class TestLCDatasetReader(tf.test.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.audio = np.arange(1, NUM_SAMPLES + 1, dtype=np.float32)
+        write_cache(self.data_dir, self.cache_dir,
+                    self.audio.reshape(-1, 1))
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+        shutil.rmtree(self.cache_dir)
+
+    def testChunks(self):
+        '''Windows overlap by the receptive field and advance by
+        sample_size, like the queue reader.'''
+        with self.test_session() as sess:
+            reader = LCDatasetReader(data_dir=self.data_dir,
+                                     coord=tf.train.Coordinator(),
+                                     receptive_field=RECEPTIVE_FIELD,
+                                     sample_size=SAMPLE_SIZE,
+                                     q_size=1,
+                                     sess=sess,
+                                     cache_dir=self.cache_dir)
+            audio_batch = reader.dq_audio(1)
+            reader.start_threads()
+            pieces = [sess.run(audio_batch) for _ in range(3)]
+
+        padded = np.pad(self.audio, [RECEPTIVE_FIELD, 0], 'constant')
+        for index, piece in enumerate(pieces):
+            start = index * SAMPLE_SIZE
+            expected = padded[start:start + RECEPTIVE_FIELD + SAMPLE_SIZE]
+            self.assertAllEqual(piece, expected.reshape(1, -1, 1))
+
+
+if __name__ == '__main__':
+    tf.test.main()
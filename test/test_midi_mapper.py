@@ -0,0 +1,165 @@
+"""Unit tests for the MIDI to piano roll upsampling."""
+
+import os
+import shutil
+import tempfile
+
+import midi
+import numpy as np
+import tensorflow as tf
+
+from wavenet import MidiMapper, ParsedMidi, load_midi, expand_lc_intervals
+from wavenet import lc_audio_reader
+from wavenet.lc_audio_reader import CachedPianoRoll
+
+SAMPLE_RATE = 16000
+LC_CHANNELS = 128
+# At 120 BPM and 100 ticks per beat one tick is 5000 us, i.e. 80 samples.
+RESOLUTION = 100
+SAMPLES_PER_TICK = 80
+
+
+def make_pattern():
+    track = midi.Track()
+    track.append(midi.SetTempoEvent(tick=0, bpm=120))
+    track.append(midi.NoteOnEvent(tick=0, pitch=60, velocity=100))
+    track.append(midi.NoteOnEvent(tick=5, pitch=64, velocity=100))
+    track.append(midi.NoteOffEvent(tick=5, pitch=60))
+    # A note on with zero velocity ends the note.
+    track.append(midi.NoteOnEvent(tick=10, pitch=64, velocity=0))
+    track.append(midi.EndOfTrackEvent(tick=5))
+    pattern = midi.Pattern(resolution=RESOLUTION)
+    pattern.append(track)
+    return pattern
+
+
+def manual_piano_roll(num_samples):
+    roll = np.zeros((num_samples, LC_CHANNELS), dtype=np.float32)
+    roll[0:10 * SAMPLES_PER_TICK, 60] = 1
+    roll[5 * SAMPLES_PER_TICK:20 * SAMPLES_PER_TICK, 64] = 1
+    return roll
+
+
+class TestMidiMapper(tf.test.TestCase):
+
+    def setUp(self):
+        self.mapper = MidiMapper(sample_rate=SAMPLE_RATE,
+                                 lc_channels=LC_CHANNELS)
+        self.mapper.set_midi(make_pattern())
+
+    def testWholeFile(self):
+        roll = self.mapper.upsample()
+        self.assertAllEqual(roll, manual_piano_roll(25 * SAMPLES_PER_TICK))
+
+    def testRangeWithPadding(self):
+        roll = self.mapper.upsample(start_sample=-10, end_sample=500)
+        expected = np.concatenate(
+            [np.zeros((10, LC_CHANNELS), dtype=np.float32),
+             manual_piano_roll(2000)[:500]])
+        self.assertAllEqual(roll, expected)
+
+    def testRangeInside(self):
+        roll = self.mapper.upsample(start_sample=700, end_sample=900)
+        self.assertAllEqual(roll, manual_piano_roll(2000)[700:900])
+
+    def testWindow(self):
+        '''Windows match the rows of the whole piano roll.'''
+        roll = np.concatenate([np.zeros((10, LC_CHANNELS), dtype=np.float32),
+                               manual_piano_roll(2000),
+                               np.zeros((200, LC_CHANNELS), dtype=np.float32)])
+        for start in range(-10, 2000, 300):
+            window = self.mapper.window(start, start + 400)
+            self.assertAllEqual(window, roll[start + 10:start + 410])
+
+    def testExpandIntervals(self):
+        '''The in-graph expansion matches the dense piano roll.'''
+        ranges = [(-10, 500), (700, 900)]
+        intervals = [self.mapper.clip_intervals(start, end)
+                     for start, end in ranges]
+        lengths = [end - start for start, end in ranges]
+        # Pad like a PaddingFIFOQueue would.
+        padded = np.zeros((len(ranges), max(len(i) for i in intervals), 3),
+                          dtype=np.int32)
+        for index, interval in enumerate(intervals):
+            padded[index, :len(interval)] = interval
+        roll = expand_lc_intervals(padded, lengths, LC_CHANNELS)
+
+        with self.test_session() as sess:
+            result = sess.run(roll)
+
+        self.assertAllEqual(result.shape, [2, 510, LC_CHANNELS])
+        for index, (start, end) in enumerate(ranges):
+            width = end - start
+            self.assertAllEqual(result[index, :width],
+                                self.mapper.upsample(start, end))
+            self.assertAllEqual(result[index, width:],
+                                np.zeros((510 - width, LC_CHANNELS)))
+
+    def testCachedPianoRoll(self):
+        '''A cached piano roll serves the same rows and notes as the MIDI.'''
+        cached = CachedPianoRoll(self.mapper.upsample().astype(np.uint8))
+        for start, end in [(-10, 500), (700, 900), (1900, 2100)]:
+            self.assertAllEqual(cached.upsample(start, end),
+                                self.mapper.upsample(start, end))
+            self.assertEqual(
+                sorted(map(tuple, cached.clip_intervals(start, end))),
+                sorted(map(tuple, self.mapper.clip_intervals(start, end))))
+
+
+class TestParsedMidi(tf.test.TestCase):
+
+    def testTempoMap(self):
+        '''A tempo change applies from its tick on.'''
+        pattern = make_pattern()
+        # Double the tempo after the first note off, at tick 10.
+        pattern[0].insert(4, midi.SetTempoEvent(tick=0, bpm=240))
+        parsed = ParsedMidi(pattern)
+        self.assertAllEqual(parsed.tempo_ticks, [0, 10])
+        self.assertEqual(parsed.ticks_to_microseconds(10), 50000)
+        self.assertEqual(parsed.ticks_to_microseconds(20), 75000)
+        self.assertEqual(parsed.length_microseconds, 87500)
+
+        mapper = MidiMapper(sample_rate=SAMPLE_RATE, lc_channels=LC_CHANNELS)
+        mapper.set_midi(parsed)
+        roll = np.zeros((1400, LC_CHANNELS), dtype=np.float32)
+        roll[0:800, 60] = 1
+        roll[400:1200, 64] = 1
+        self.assertAllEqual(mapper.upsample(), roll)
+
+    def testLoadMidiIsCached(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'clip.mid')
+            midi.write_midifile(filename, make_pattern())
+            parsed = load_midi(filename)
+            self.assertIs(load_midi(filename), parsed)
+            self.assertEqual(parsed.length_microseconds,
+                             25 * SAMPLES_PER_TICK * 1e6 / SAMPLE_RATE)
+        finally:
+            shutil.rmtree(directory)
+
+    def testLoadMidiDropsLeastRecentlyUsed(self):
+        directory = tempfile.mkdtemp()
+        cache_size = lc_audio_reader.MIDI_CACHE_SIZE
+        lc_audio_reader.MIDI_CACHE_SIZE = 2
+        try:
+            filenames = []
+            for index in range(3):
+                filename = os.path.join(directory, 'clip{}.mid'.format(index))
+                midi.write_midifile(filename, make_pattern())
+                filenames.append(filename)
+            first = load_midi(filenames[0])
+            second = load_midi(filenames[1])
+            # Using the first file again makes the second the oldest entry.
+            self.assertIs(load_midi(filenames[0]), first)
+            load_midi(filenames[2])
+            self.assertIs(load_midi(filenames[0]), first)
+            self.assertIsNot(load_midi(filenames[1]), second)
+            self.assertLessEqual(len(lc_audio_reader.MIDI_CACHE), 2)
+        finally:
+            lc_audio_reader.MIDI_CACHE_SIZE = cache_size
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -5,6 +5,7 @@ import sys
 import tensorflow as tf
 import random
 import os
+import time
 
 from wavenet import (WaveNetModel, time_to_batch, batch_to_time, causal_conv,
                      optimizer_factory, mu_law_decode)
@@ -392,5 +393,267 @@ class TestNetWithGlobalConditioning(TestNet):
                                 global_condition_cardinality=NUM_SPEAKERS)
 
 
+class TestNetVariants(tf.test.TestCase):
+    """The fused and batched LC layer variants compute the same loss from
+    the same variables."""
+
+    def testVariantsMatch(self):
+        np.random.seed(0)
+        net = WaveNetModel(batch_size=2,
+                           dilations=[1, 2, 4, 8, 1, 2, 4, 8],
+                           filter_width=2,
+                           residual_channels=16,
+                           dilation_channels=16,
+                           quantization_channels=QUANTIZATION_CHANNELS,
+                           skip_channels=32,
+                           use_biases=True,
+                           initial_lc_channels=8,
+                           lc_channels=4)
+        audio = np.random.uniform(-1, 1, (2, 200, 1)).astype(np.float32)
+        lc = np.random.randint(0, 2, (2, 200, 8)).astype(np.float32)
+
+        losses = []
+        for fused_conv, batched_lc in [(False, False), (True, False),
+                                       (False, True), (True, True)]:
+            net.fused_conv = fused_conv
+            net.batched_lc = batched_lc
+            losses.append(net.loss(audio, lc_encoded_batch=lc,
+                                   name='variant{}'.format(len(losses))))
+
+        with self.test_session() as sess:
+            sess.run(tf.global_variables_initializer())
+            results = sess.run(losses)
+
+        for result in results[1:]:
+            self.assertAllClose(result, results[0], rtol=1e-5)
+
+
+class TestLossMask(tf.test.TestCase):
+    """Padded samples after the length of an example do not change the
+    loss."""
+
+    def testPaddingIsMasked(self):
+        np.random.seed(0)
+        net = WaveNetModel(batch_size=2,
+                           dilations=[1, 2, 4, 8],
+                           filter_width=2,
+                           residual_channels=16,
+                           dilation_channels=16,
+                           quantization_channels=QUANTIZATION_CHANNELS,
+                           skip_channels=32)
+        audio = np.random.uniform(-1, 1, (2, 200, 1)).astype(np.float32)
+        noisy = audio.copy()
+        audio[1, 150:] = 0
+        noisy[1, 150:] = np.random.uniform(-1, 1, (50, 1))
+
+        lengths = [200, 150]
+        masked = net.loss(audio, lengths=lengths, name='masked')
+        masked_noisy = net.loss(noisy, lengths=lengths, name='masked_noisy')
+        full = net.loss(audio, name='full')
+        full_lengths = net.loss(audio, lengths=[200, 200],
+                                name='full_lengths')
+
+        with self.test_session() as sess:
+            sess.run(tf.global_variables_initializer())
+            results = sess.run([masked, masked_noisy, full, full_lengths])
+
+        self.assertAllClose(results[0], results[1], rtol=1e-5)
+        self.assertAllClose(results[2], results[3], rtol=1e-5)
+        self.assertNotAlmostEqual(results[0], results[2], places=4)
+
+
+class TestMixedPrecision(tf.test.TestCase):
+    """A float16 network on the same float32 variables gives about the same
+    float32 loss and float32 gradients."""
+
+    def testFloat16MatchesFloat32(self):
+        np.random.seed(0)
+        net = WaveNetModel(batch_size=2,
+                           dilations=[1, 2, 4, 8],
+                           filter_width=2,
+                           residual_channels=16,
+                           dilation_channels=16,
+                           quantization_channels=QUANTIZATION_CHANNELS,
+                           skip_channels=32,
+                           use_biases=True,
+                           initial_lc_channels=8,
+                           lc_channels=4)
+        audio = np.random.uniform(-1, 1, (2, 200, 1)).astype(np.float32)
+        lc = np.random.randint(0, 2, (2, 200, 8)).astype(np.float32)
+        trainable = tf.trainable_variables()
+
+        loss = net.loss(audio, lc_encoded_batch=lc, name='float32')
+        net.compute_dtype = tf.float16
+        half_loss = net.loss(audio, lc_encoded_batch=lc, name='float16')
+        self.assertEqual(half_loss.dtype, tf.float32)
+
+        grads = tf.gradients(half_loss * 128.0, trainable)
+        for grad in grads:
+            self.assertEqual(grad.dtype, tf.float32)
+
+        with self.test_session() as sess:
+            sess.run(tf.global_variables_initializer())
+            loss_value, half_loss_value = sess.run([loss, half_loss])
+
+        self.assertAllClose(loss_value, half_loss_value, rtol=1e-2)
+
+
+class TestGradientCheckpointing(tf.test.TestCase):
+    """Recomputing the layers in the backward pass gives the same loss and
+    gradients."""
+
+    def testGradientsMatch(self):
+        np.random.seed(0)
+        net = WaveNetModel(batch_size=2,
+                           dilations=[1, 2, 4, 8, 1, 2, 4, 8],
+                           filter_width=2,
+                           residual_channels=16,
+                           dilation_channels=16,
+                           quantization_channels=QUANTIZATION_CHANNELS,
+                           skip_channels=32,
+                           use_biases=True,
+                           initial_lc_channels=8,
+                           lc_channels=4)
+        audio = np.random.uniform(-1, 1, (2, 200, 1)).astype(np.float32)
+        lc = np.random.randint(0, 2, (2, 200, 8)).astype(np.float32)
+        trainable = tf.trainable_variables()
+
+        results = []
+        for checkpointing in [False, True]:
+            net.gradient_checkpointing = checkpointing
+            loss = net.loss(audio, lc_encoded_batch=lc,
+                            name='checkpointing{}'.format(checkpointing))
+            results.append([loss] + tf.gradients(loss, trainable))
+
+        with self.test_session() as sess:
+            sess.run(tf.global_variables_initializer())
+            plain, checkpointed = sess.run(results)
+
+        for expected, result in zip(plain, checkpointed):
+            self.assertAllClose(expected, result, rtol=1e-4, atol=1e-6)
+
+
+class CheckpointingBenchmark(tf.test.Benchmark):
+    """Reports the peak memory of a training step with and without gradient
+    checkpointing for growing sample sizes, on the device the step runs on.
+    Run with --benchmarks=CheckpointingBenchmark, preferably on a GPU."""
+
+    def _benchmark(self, checkpointing, sample_size):
+        with tf.Graph().as_default():
+            net = WaveNetModel(batch_size=1,
+                               dilations=[2 ** i for i in range(10)] * 3,
+                               filter_width=2,
+                               residual_channels=32,
+                               dilation_channels=32,
+                               quantization_channels=QUANTIZATION_CHANNELS,
+                               skip_channels=512,
+                               use_biases=True,
+                               gradient_checkpointing=checkpointing)
+            audio = tf.random_uniform([1, net.receptive_field + sample_size,
+                                       1], -1, 1)
+            optimizer = optimizer_factory['adam'](learning_rate=1e-3,
+                                                  momentum=None)
+            optim = optimizer.minimize(net.loss(audio))
+
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                run_metadata = tf.RunMetadata()
+                start = time.time()
+                sess.run(optim, options=tf.RunOptions(
+                             trace_level=tf.RunOptions.FULL_TRACE),
+                         run_metadata=run_metadata)
+                wall_time = time.time() - start
+
+        peak_bytes = max(memory.peak_bytes
+                         for device in run_metadata.step_stats.dev_stats
+                         for node in device.node_stats
+                         for memory in node.memory)
+        self.report_benchmark(
+            name='{}_sample_size{}'.format(
+                'checkpointed' if checkpointing else 'plain', sample_size),
+            iters=1, wall_time=wall_time,
+            extras={'peak_bytes': peak_bytes})
+
+    def benchmarkPeakMemory(self):
+        for sample_size in [16000, 32000, 64000]:
+            for checkpointing in [False, True]:
+                self._benchmark(checkpointing, sample_size)
+
+
+def make_tower_net(batch_size):
+    return WaveNetModel(batch_size=batch_size,
+                        dilations=[1, 2, 4, 8, 1, 2, 4, 8],
+                        filter_width=2,
+                        residual_channels=16,
+                        dilation_channels=16,
+                        quantization_channels=QUANTIZATION_CHANNELS,
+                        skip_channels=32,
+                        use_biases=True)
+
+
+class TestTowers(tf.test.TestCase):
+    """Towers on virtual CPU devices average to the gradients of the whole
+    batch."""
+
+    def testTowersMatchSingle(self):
+        np.random.seed(0)
+        net = make_tower_net(batch_size=4)
+        audio = np.random.uniform(-1, 1, (4, 200, 1)).astype(np.float32)
+        optimizer = optimizer_factory['sgd'](learning_rate=0.1,
+                                             momentum=0.9)
+        trainable = tf.trainable_variables()
+
+        loss = net.loss(audio, name='single')
+        grads = tf.gradients(loss, trainable)
+
+        net.batch_size = 2
+        tower_loss, tower_grads = net.tower_gradients(
+            optimizer, ['/cpu:0', '/cpu:1'], audio, var_list=trainable)
+
+        config = tf.ConfigProto(device_count={'CPU': 2})
+        with self.test_session(config=config) as sess:
+            sess.run(tf.global_variables_initializer())
+            results = sess.run([loss, tower_loss, grads,
+                                [grad for grad, _ in tower_grads]])
+
+        self.assertAllClose(results[0], results[1], rtol=1e-5)
+        for single, averaged in zip(results[2], results[3]):
+            self.assertAllClose(single, averaged, rtol=1e-4, atol=1e-6)
+
+
+class TowerBenchmark(tf.test.Benchmark):
+    """Reports the training samples per second of 1, 2 and 4 towers on
+    virtual CPU devices, each with the same batch per tower.
+    Run with --benchmarks=TowerBenchmark."""
+
+    def _benchmark(self, num_towers, batch_size=2, width=4000):
+        with tf.Graph().as_default():
+            net = make_tower_net(batch_size=batch_size)
+            audio = tf.random_uniform([num_towers * batch_size, width, 1],
+                                      -1, 1)
+            optimizer = optimizer_factory['adam'](learning_rate=1e-3,
+                                                  momentum=None)
+            devices = ['/cpu:{}'.format(i) for i in range(num_towers)]
+            _, grads_and_vars = net.tower_gradients(optimizer, devices, audio)
+            optim = optimizer.apply_gradients(grads_and_vars)
+
+            config = tf.ConfigProto(device_count={'CPU': num_towers},
+                                    inter_op_parallelism_threads=num_towers)
+            with tf.Session(config=config) as sess:
+                sess.run(tf.global_variables_initializer())
+                result = self.run_op_benchmark(
+                    sess, optim, min_iters=10,
+                    name='towers{}'.format(num_towers))
+        samples = num_towers * batch_size * width
+        self.report_benchmark(
+            name='towers{}_samples_per_sec'.format(num_towers),
+            iters=1, wall_time=result['wall_time'],
+            extras={'samples_per_sec': samples / result['wall_time']})
+
+    def benchmarkTowers(self):
+        for num_towers in [1, 2, 4]:
+            self._benchmark(num_towers)
+
+
 if __name__ == '__main__':
     tf.test.main()
@@ -0,0 +1,52 @@
+"""Unit tests for the in-graph and NumPy samplers."""
+
+import numpy as np
+import tensorflow as tf
+
+from wavenet import sample_categorical, sample_categorical_numpy
+
+NUM_DRAWS = 20000
+PROBA = np.array([0.5, 0.3, 0.15, 0.05], dtype=np.float32)
+
+
+def frequencies(samples):
+    return np.bincount(samples, minlength=len(PROBA)) / float(len(samples))
+
+
+class TestSampling(tf.test.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.proba = np.tile(PROBA, [NUM_DRAWS, 1])
+
+    def draw(self, **kwargs):
+        samples = sample_categorical(np.log(self.proba), **kwargs)
+        with self.test_session() as sess:
+            result = sess.run(samples)
+        self.assertEqual(result.dtype, np.int32)
+        self.assertAllEqual(result.shape, [NUM_DRAWS])
+        return result, sample_categorical_numpy(self.proba, **kwargs)
+
+    def testDistribution(self):
+        for samples in self.draw():
+            self.assertAllClose(frequencies(samples), PROBA, atol=0.02)
+
+    def testTemperature(self):
+        '''A low temperature concentrates on the most likely value.'''
+        for samples in self.draw(temperature=0.01):
+            self.assertTrue(np.all(samples == 0))
+
+    def testTopK(self):
+        expected = np.array([0.625, 0.375, 0, 0])
+        for samples in self.draw(top_k=2):
+            self.assertAllClose(frequencies(samples), expected, atol=0.02)
+
+    def testTopP(self):
+        '''The nucleus of 0.9 is the first three values.'''
+        expected = np.array([0.5, 0.3, 0.15, 0]) / 0.95
+        for samples in self.draw(top_p=0.9):
+            self.assertAllClose(frequencies(samples), expected, atol=0.02)
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -0,0 +1,61 @@
+"""Unit tests for the streaming WAV writer."""
+
+import os
+import shutil
+import tempfile
+import wave
+
+import numpy as np
+import tensorflow as tf
+
+from wavenet import WavWriter, mu_law_decode, mu_law_decode_numpy
+
+QUANT_LEVELS = 256
+SAMPLE_RATE = 16000
+
+
+def read_frames(filename):
+    wav = wave.open(filename, 'rb')
+    try:
+        frames = wav.readframes(wav.getnframes())
+    finally:
+        wav.close()
+    return np.frombuffer(frames, dtype='<i2')
+
+
+class TestWavWriter(tf.test.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'out.wav')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testDecodeMatchesGraph(self):
+        x = np.arange(QUANT_LEVELS)
+        with self.test_session() as sess:
+            expected = sess.run(mu_law_decode(x, QUANT_LEVELS))
+        self.assertAllClose(mu_law_decode_numpy(x, QUANT_LEVELS), expected)
+
+    def testStreaming(self):
+        '''The file is valid after every flush and holds all samples.'''
+        np.random.seed(0)
+        samples = np.random.randint(QUANT_LEVELS, size=1000)
+        writer = WavWriter(self.filename, SAMPLE_RATE, QUANT_LEVELS,
+                           buffer_size=300)
+        for sample in samples[:700]:
+            writer.write([sample])
+        # Two blocks of 300 were flushed, 100 samples are pending.
+        self.assertEqual(len(read_frames(self.filename)), 600)
+
+        writer.write(samples[700:])
+        writer.close()
+
+        expected = mu_law_decode_numpy(samples, QUANT_LEVELS)
+        self.assertAllClose(read_frames(self.filename) / 32767.0, expected,
+                            atol=1e-4)
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -26,7 +26,8 @@ import time
 import tensorflow as tf
 from tensorflow.python.client import timeline
 
-from wavenet import WaveNetModel,LCAudioReader, optimizer_factory
+from wavenet import (WaveNetModel, LCAudioReader, LCDatasetReader, optimizer_factory,
+					 unscale_gradients, accumulate_gradients)
 
 
 BATCH_SIZE = 1
@@ -44,6 +45,19 @@ EPSILON = 0.001
 MOMENTUM = 0.9
 MAX_TO_KEEP = 5
 METADATA = False
+LC_TRANSPORT = 'dense'
+READER = 'queue'
+READER_THREADS = 1
+READER_WORKERS = 0
+ENQUEUE_BATCH = 1
+CHUNK_SAMPLING = 'sequential'
+PIPELINE_STATS_EVERY = 50
+NUM_TOWERS = 1
+TOWER_DEVICE = 'gpu'
+JOB_NAME = 'worker'
+PRECISION = 'float32'
+LOSS_SCALE = 128.0
+ACCUMULATE_STEPS = 1
 
 
 def get_arguments():
@@ -99,7 +113,8 @@ def get_arguments():
 	parser.add_argument('--num-steps',
 		type = int,
 		default = NUM_STEPS,
-		help = 'Number of training steps. Default: ' + str(NUM_STEPS) + '. Expects: int')
+		help = 'Number of training steps. In a distributed training the steps of all workers count '
+		'towards it. Default: ' + str(NUM_STEPS) + '. Expects: int')
 	
 	parser.add_argument('--learning-rate',
 		type = float,
@@ -135,6 +150,52 @@ def get_arguments():
 		choices = optimizer_factory.keys(),
 		help = 'Select the optimizer specified by this option. Default: adam. Expects: string')
 	
+	parser.add_argument('--accumulate-steps',
+		type = int,
+		default = ACCUMULATE_STEPS,
+		help = 'Number of batches whose gradients are summed before one optimizer update, which then '
+		'applies their mean. Gives the statistics of a batch this many times larger at the memory '
+		'of one. A step is one update. Default: ' + str(ACCUMULATE_STEPS) + '. Expecting: int')
+
+	parser.add_argument('--num-towers',
+		type = int,
+		default = NUM_TOWERS,
+		help = 'Number of replicas of the network the batch is split between. Their gradients are '
+		'averaged into one optimizer update. --batch-size is the total over all towers and must be '
+		'divisible by it. Default: ' + str(NUM_TOWERS) + '. Expecting: int')
+
+	parser.add_argument('--tower-device',
+		type = str,
+		default = TOWER_DEVICE,
+		choices = ['gpu', 'cpu'],
+		help = "Device type of the towers, one device of it per tower. 'cpu' splits the CPU into "
+		"--num-towers virtual devices. Default: " + TOWER_DEVICE + ". Expecting: string")
+
+	parser.add_argument('--ps-hosts',
+		type = str,
+		default = None,
+		help = 'Comma separated host:port list of the parameter servers of a distributed training. '
+		'Requires --worker-hosts. Default: None. Expecting: string')
+
+	parser.add_argument('--worker-hosts',
+		type = str,
+		default = None,
+		help = 'Comma separated host:port list of the workers of a distributed training. Every worker '
+		'trains on its own shard of the files and the variables live on the parameter servers. '
+		'Only the first worker restores, saves checkpoints, writes summaries and updates the '
+		'--cache-dir, the other workers wait for it. Default: None. Expecting: string')
+
+	parser.add_argument('--job-name',
+		type = str,
+		default = JOB_NAME,
+		choices = ['ps', 'worker'],
+		help = 'Job of this process in a distributed training. Default: ' + JOB_NAME + '. Expecting: string')
+
+	parser.add_argument('--task-index',
+		type = int,
+		default = 0,
+		help = 'Index of this process in its job of a distributed training. Default: 0. Expecting: int')
+
 	parser.add_argument('--momentum',
 		type = float,
 		default = MOMENTUM,
@@ -145,6 +206,36 @@ def get_arguments():
 	parser.add_argument('--histograms',
 		action = 'store_true',
 		help = 'Whether to store histogram summaries. Default: False')
+
+	parser.add_argument('--fused-conv',
+		action = 'store_true',
+		help = 'Whether to compute the filter and gate of each dilated layer with a single '
+		'atrous convolution. Default: False')
+
+	parser.add_argument('--batched-lc',
+		action = 'store_true',
+		help = 'Whether to compute the LC projections of all dilated layers in a single '
+		'convolution before the stack. Default: False')
+
+	parser.add_argument('--gradient-checkpointing',
+		action = 'store_true',
+		help = 'Whether to recompute the activations of every dilated layer in the backward pass '
+		'instead of keeping them, to fit a larger --sample-size or --batch-size in memory at the '
+		'cost of a second forward pass. Default: False')
+
+	parser.add_argument('--precision',
+		type = str,
+		default = PRECISION,
+		choices = ['float32', 'float16'],
+		help = 'Type of the convolutions and activations of the network. float16 keeps float32 '
+		'master weights and a float32 softmax. Default: ' + PRECISION + '. Expecting: string')
+
+	parser.add_argument('--loss-scale',
+		type = float,
+		default = LOSS_SCALE,
+		help = 'Factor the loss is multiplied by before the gradients are taken with --precision float16, '
+		'and the gradients are divided by after. Lower it if the loss turns into NaN. '
+		'Default: ' + str(LOSS_SCALE) + '. Expecting: float')
 	
 	parser.add_argument('--gc-channels',
 		type = int,
@@ -166,6 +257,71 @@ def get_arguments():
 		default = None,
 		help = "Extension of files being used for local conditioning. Default: None. Expecting: string")
 
+	parser.add_argument('--lc-transport',
+		type = str,
+		default = LC_TRANSPORT,
+		choices = ['dense', 'intervals'],
+		help = "How LC is carried through the reader queue: 'dense' piano roll matrices, "
+		"or 'intervals' of notes expanded in-graph. Default: " + LC_TRANSPORT + ". Expecting: string")
+
+	parser.add_argument('--cache-dir',
+		type = str,
+		default = None,
+		help = 'Directory of the preprocessed dataset cache written by preprocess.py. '
+		'It is brought up to date with --data-dir before training. Default: None. Expects: path')
+
+	parser.add_argument('--reader',
+		type = str,
+		default = READER,
+		choices = ['queue', 'dataset'],
+		help = "Input pipeline: 'queue' feeds padding queues from Python threads, "
+		"'dataset' uses a tf.data pipeline. Default: " + READER + ". Expecting: string")
+
+	parser.add_argument('--reader-threads',
+		type = int,
+		default = READER_THREADS,
+		help = 'Number of files decoded in parallel by the input pipeline. For the queue reader '
+		'this is the number of threads feeding the queues. '
+		'Default: ' + str(READER_THREADS) + '. Expecting: int')
+
+	parser.add_argument('--reader-workers',
+		type = int,
+		default = READER_WORKERS,
+		help = 'Number of processes decoding the audio and MIDI for the queue reader. '
+		'0 decodes in the reader threads. Requires --sample-size. '
+		'Default: ' + str(READER_WORKERS) + '. Expecting: int')
+
+	parser.add_argument('--enqueue-batch',
+		type = int,
+		default = ENQUEUE_BATCH,
+		help = 'Number of chunks the queue reader threads enqueue per Session call. '
+		'Default: ' + str(ENQUEUE_BATCH) + '. Expecting: int')
+
+	parser.add_argument('--chunk-sampling',
+		type = str,
+		default = CHUNK_SAMPLING,
+		choices = ['sequential', 'uniform', 'stratified'],
+		help = "How the queue reader picks chunks: 'sequential' walks randomly drawn files, "
+		"'uniform' draws random chunks of the whole dataset and 'stratified' draws a random file "
+		"and then a random chunk of it. Random sampling requires --cache-dir and --sample-size. "
+		"Default: " + CHUNK_SAMPLING + ". Expecting: string")
+
+	parser.add_argument('--length-buckets',
+		type = int,
+		nargs = '+',
+		default = None,
+		help = 'Upper bounds in samples of the length buckets. A batch only holds chunks of one bucket, '
+		'so it is only padded to the longest chunk of that bucket. Useful without --sample-size or '
+		'for the short last chunks of the files. Default: no buckets. Expecting: list of ints')
+
+	parser.add_argument('--pipeline-stats-every',
+		type = int,
+		default = PIPELINE_STATS_EVERY,
+		help = 'How many steps between input pipeline reports. A report logs and writes to TensorBoard '
+		'the mean queue fill level, time blocked in dequeue, reader decode, LC and enqueue times and '
+		'files per second. Decoding worker processes only report the enqueue time. 0 disables the '
+		'reports. Default: ' + str(PIPELINE_STATS_EVERY) + '. Expecting: int')
+
 	parser.add_argument('--max-checkpoints',
 		type = int,
 		default = MAX_TO_KEEP,
@@ -206,6 +362,21 @@ def load(saver, sess, logdir):
 		return None
 
 
+def report_pipeline_stats(writer, step, reader, step_stats):
+	'''Logs and writes to TensorBoard the means of the per step reader stats since the
+	last report, together with the timings collected by the reader threads.
+	Only logs without a writer.'''
+	stats = reader.timings.collect()
+	for name in step_stats[0]:
+		stats[name] = sum(values[name] for values in step_stats) / len(step_stats)
+
+	if writer is not None:
+		writer.add_summary(tf.Summary(value = [tf.Summary.Value(tag = 'reader/' + name, simple_value = value)
+											   for name, value in sorted(stats.items())]), step)
+	print('pipeline: ' + ', '.join('{} = {:.3f}'.format(name, value)
+								   for name, value in sorted(stats.items())))
+
+
 def get_default_logdir(logdir_root):
 	logdir = os.path.join(logdir_root, 'train', STARTED_DATESTRING)
 	return logdir
@@ -275,8 +446,44 @@ def main():
 	# Create coordinator.
 	coord = tf.train.Coordinator()
 
+	if args.batch_size % args.num_towers != 0:
+		raise ValueError("The batch size {} cannot be split evenly between {} towers."
+						 .format(args.batch_size, args.num_towers))
+
+	# one device per tower, the variables stay on the CPU when there are several
+	tower_devices = ['/{}:{}'.format(args.tower_device, index) for index in range(args.num_towers)]
+	device_count = {'CPU' : args.num_towers} if args.tower_device == 'cpu' else None
+
+	config = tf.ConfigProto(log_device_placement = False,
+							allow_soft_placement = True,
+							device_count = device_count)
+
+	# distributed training, the variables live on the parameter servers and the workers
+	# each train on their own shard of the files
+	cluster = None
+	is_chief = True
+	shard_index = 0
+	num_shards = 1
+	target = ''
+	if args.worker_hosts is not None:
+		if args.ps_hosts is None:
+			raise ValueError("Distributed training needs --ps-hosts as well as --worker-hosts.")
+
+		cluster = tf.train.ClusterSpec({'ps' : args.ps_hosts.split(','),
+										'worker' : args.worker_hosts.split(',')})
+		server = tf.train.Server(cluster, job_name = args.job_name, task_index = args.task_index,
+								 config = config)
+		if args.job_name == 'ps':
+			server.join()
+			return
+
+		is_chief = args.task_index == 0
+		shard_index = args.task_index
+		num_shards = cluster.num_tasks('worker')
+		target = server.target
+
 	# create session
-	sess = tf.Session(config = tf.ConfigProto(log_device_placement = False))
+	sess = tf.Session(target, config = config)
 
 	# Load raw waveform from VCTK corpus.
 	with tf.name_scope('create_inputs'):
@@ -308,24 +515,57 @@ def main():
 		if args.lc_fileformat is not None and not lc_enabled:
 			raise ValueError("LC channels have to be set when a LC file format is specified.")
 		
-		reader = LCAudioReader(data_dir = args.data_dir,
-							   coord = coord,
-							   receptive_field = WaveNetModel.calculate_receptive_field(
-									wavenet_params["filter_width"],
-									wavenet_params["dilations"],
-									wavenet_params["scalar_input"],
-									wavenet_params["initial_filter_width"]),
-							   gc_enabled = gc_enabled,
-							   lc_enabled = lc_enabled,
-							   lc_channels = initial_lc_channels,
-							   lc_fileformat = args.lc_fileformat,
-							   sample_rate = wavenet_params['sample_rate'],
-							   sample_size = args.sample_size,
-							   silence_threshold = silence_threshold,
-							   sess = sess)
+		receptive_field = WaveNetModel.calculate_receptive_field(
+			wavenet_params["filter_width"],
+			wavenet_params["dilations"],
+			wavenet_params["scalar_input"],
+			wavenet_params["initial_filter_width"])
+
+		if args.reader == 'dataset':
+			reader = LCDatasetReader(data_dir = args.data_dir,
+									 coord = coord,
+									 receptive_field = receptive_field,
+									 gc_enabled = gc_enabled,
+									 lc_enabled = lc_enabled,
+									 lc_channels = initial_lc_channels,
+									 lc_fileformat = args.lc_fileformat,
+									 sample_rate = wavenet_params['sample_rate'],
+									 sample_size = args.sample_size,
+									 silence_threshold = silence_threshold,
+									 sess = sess,
+									 cache_dir = args.cache_dir,
+									 num_parallel_calls = args.reader_threads,
+									 length_buckets = args.length_buckets,
+									 shard_index = shard_index,
+									 num_shards = num_shards,
+									 update_cache = is_chief)
+		else:
+			reader = LCAudioReader(data_dir = args.data_dir,
+								   coord = coord,
+								   receptive_field = receptive_field,
+								   gc_enabled = gc_enabled,
+								   lc_enabled = lc_enabled,
+								   lc_channels = initial_lc_channels,
+								   lc_fileformat = args.lc_fileformat,
+								   sample_rate = wavenet_params['sample_rate'],
+								   sample_size = args.sample_size,
+								   silence_threshold = silence_threshold,
+								   sess = sess,
+								   lc_transport = args.lc_transport,
+								   cache_dir = args.cache_dir,
+								   num_workers = args.reader_workers,
+								   enqueue_batch = args.enqueue_batch,
+								   chunk_sampling = args.chunk_sampling,
+								   length_buckets = args.length_buckets,
+								   shard_index = shard_index,
+								   num_shards = num_shards,
+								   update_cache = is_chief)
 		# dequeue audio samples
 		audio_batch = reader.dq_audio(args.batch_size)
 
+		# unpadded lengths, the padding of shorter chunks is masked out of the loss
+		length_batch = reader.dq_length(args.batch_size)
+
 		# dequeue gc embeddings
 		if gc_enabled:
 			gc_id_batch = reader.dq_gc(args.batch_size)
@@ -340,33 +580,52 @@ def main():
 		
 
 	# Create network.
-	net = WaveNetModel(
-		batch_size = args.batch_size,
-		dilations = wavenet_params["dilations"],
-		filter_width = wavenet_params["filter_width"],
-		residual_channels = wavenet_params["residual_channels"],
-		dilation_channels = wavenet_params["dilation_channels"],
-		skip_channels = wavenet_params["skip_channels"],
-		quantization_channels = wavenet_params["quantization_channels"],
-		use_biases = wavenet_params["use_biases"],
-		scalar_input = wavenet_params["scalar_input"],
-		initial_filter_width = wavenet_params["initial_filter_width"],
-		histograms = args.histograms,
-		gc_channels = args.gc_channels,
-		gc_cardinality = reader.get_gc_cardinality(),
-		initial_lc_channels = initial_lc_channels,
-		lc_channels = lc_channels)
+	# the batch size of the network is that of one tower
+	if cluster is not None:
+		variable_device = tf.train.replica_device_setter(
+			cluster = cluster, worker_device = '/job:worker/task:{}'.format(args.task_index))
+	else:
+		variable_device = '/cpu:0' if args.num_towers > 1 else None
+	with tf.device(variable_device):
+		net = WaveNetModel(
+			batch_size = args.batch_size // args.num_towers,
+			dilations = wavenet_params["dilations"],
+			filter_width = wavenet_params["filter_width"],
+			residual_channels = wavenet_params["residual_channels"],
+			dilation_channels = wavenet_params["dilation_channels"],
+			skip_channels = wavenet_params["skip_channels"],
+			quantization_channels = wavenet_params["quantization_channels"],
+			use_biases = wavenet_params["use_biases"],
+			scalar_input = wavenet_params["scalar_input"],
+			initial_filter_width = wavenet_params["initial_filter_width"],
+			histograms = args.histograms,
+			gc_channels = args.gc_channels,
+			gc_cardinality = reader.get_gc_cardinality(),
+			initial_lc_channels = initial_lc_channels,
+			lc_channels = lc_channels,
+			fused_conv = args.fused_conv,
+			batched_lc = args.batched_lc,
+			compute_dtype = tf.as_dtype(args.precision),
+			gradient_checkpointing = args.gradient_checkpointing)
+
+		# set by the chief once the shared variables are initialized and restored, it is not
+		# part of the checkpoints
+		chief_ready = tf.Variable(False, trainable = False, name = 'chief_ready')
+		set_chief_ready = chief_ready.assign(True)
+
+		# the number of updates applied by all workers, every worker trains until it reaches
+		# --num-steps. The checkpoints keep the step in their name instead, like before
+		global_step = tf.train.get_or_create_global_step()
+		restored_step = tf.placeholder(global_step.dtype.base_dtype, shape = [])
+		set_global_step = global_step.assign(restored_step)
+
+	# float16 gradients need loss scaling
+	loss_scale = args.loss_scale if args.precision == 'float16' else None
 
 
 	if args.l2_regularization_strength == 0:
 		args.l2_regularization_strength = None
 
-	# create loss
-	loss = net.loss(input_batch = audio_batch,
-					gc_batch = gc_id_batch,
-					lc_encoded_batch = lc_encoded_batch,
-					l2_regularization_strength = args.l2_regularization_strength)
-
 	# create optimizer
 	optimizer = optimizer_factory[args.optimizer](
 					learning_rate = args.learning_rate,
@@ -374,30 +633,70 @@ def main():
 
 	# set up optimizer with trainable vars
 	trainable = tf.trainable_variables()
-	optim = optimizer.minimize(loss, var_list = trainable)
 
-	# set up logging for TensorBoard.
-	writer = tf.summary.FileWriter(logdir)
-	writer.add_graph(tf.get_default_graph())
+	if args.num_towers == 1:
+		# create loss
+		loss = net.loss(input_batch = audio_batch,
+						gc_batch = gc_id_batch,
+						lc_encoded_batch = lc_encoded_batch,
+						l2_regularization_strength = args.l2_regularization_strength,
+						lengths = length_batch)
+
+		scaled_loss = loss * loss_scale if loss_scale else loss
+		grads_and_vars = optimizer.compute_gradients(scaled_loss, var_list = trainable)
+		if loss_scale:
+			grads_and_vars = unscale_gradients(grads_and_vars, loss_scale)
+	else:
+		# every tower computes the gradients of its share of the batch, one update applies their mean
+		loss, grads_and_vars = net.tower_gradients(optimizer, tower_devices,
+												   input_batch = audio_batch,
+												   gc_batch = gc_id_batch,
+												   lc_encoded_batch = lc_encoded_batch,
+												   l2_regularization_strength = args.l2_regularization_strength,
+												   lengths = length_batch,
+												   var_list = trainable,
+												   loss_scale = loss_scale)
+
+	if args.accumulate_steps > 1:
+		# every batch adds to the gradient buffers, optim applies their mean and clears them
+		accumulate, optim = accumulate_gradients(optimizer, grads_and_vars, args.accumulate_steps,
+												 global_step = global_step)
+		train_op = accumulate
+	else:
+		optim = optimizer.apply_gradients(grads_and_vars, global_step = global_step)
+		train_op = optim
+
+	# set up logging for TensorBoard, only the chief writes summaries
+	writer = None
+	if is_chief:
+		writer = tf.summary.FileWriter(logdir)
+		writer.add_graph(tf.get_default_graph())
 	run_metadata = tf.RunMetadata()
 	summaries = tf.summary.merge_all()
 
 	# set up session initial state
 	init = tf.global_variables_initializer()
+	# the chief's flag and the global step are not part of the checkpoints
+	saved_variables = [v for v in tf.global_variables() if v is not chief_ready and v is not global_step]
+	uninitialized = tf.report_uninitialized_variables()
 #	with memory_util.capture_stderr() as stderr:
-	sess.run(init)
-	saved_vars = [v.name for v in tf.global_variables()]
-	json.dump(saved_vars, open(os.path.join(logdir, 'saved_vars.txt'), 'w'))
+	# local variables such as the gradient buffers belong to each worker
+	sess.run(tf.local_variables_initializer())
+	if is_chief:
+		sess.run(init)
+		saved_vars = [v.name for v in saved_variables]
+		json.dump(saved_vars, open(os.path.join(logdir, 'saved_vars.txt'), 'w'))
 
 #	memory_util.print_memory_timeline(stderr, ignore_less_than_bytes=1000)
 
 	# saver for storing checkpoints of the model.
 	# saver = tf.train.Saver(var_list = tf.trainable_variables(), max_to_keep = args.max_checkpoints)
-	saver = tf.train.Saver( max_to_keep = args.max_checkpoints)
+	saver = tf.train.Saver(var_list = saved_variables,
+						   max_to_keep = args.max_checkpoints)
 
 	# try loading pre-existing model
 	try:
-		saved_global_step = load(saver, sess, restore_from)
+		saved_global_step = load(saver, sess, restore_from) if is_chief else None
 		if is_overwritten_training or saved_global_step is None:
 			# The first training step will be saved_global_step + 1,
 			# therefore we put -1 here for new or overwritten trainings.
@@ -408,24 +707,49 @@ def main():
 			  "the previous model.")
 		raise
 
+	# the other workers wait until the chief has initialized the shared variables and
+	# restored the checkpoint into them
+	if is_chief:
+		sess.run(set_global_step, feed_dict = {restored_step : saved_global_step + 1})
+		sess.run(set_chief_ready)
+	while len(sess.run(uninitialized)) or not sess.run(chief_ready):
+		print("Waiting for the chief to initialize and restore the variables ...")
+		time.sleep(1)
+
 	# start audio reader threads
 	threads = tf.train.start_queue_runners(sess = sess, coord = coord)
-	reader.start_threads()
+	reader.start_threads(args.reader_threads)
 
 	
 	step = None
 	last_saved_step = saved_global_step
+	# queue fill levels and dequeue waits of the steps since the last pipeline report
+	step_stats = []
+	last_report_step = -1
 	try:
-		for step in range(saved_global_step + 1, args.num_steps):
+		# the step is the number of updates applied by all workers before this one, so
+		# with several workers a worker does not see every step
+		next_step = sess.run(global_step)
+		while next_step < args.num_steps:
+			step = next_step
 			start_time = time.time()
-			if args.store_metadata and step % 50 == 0:
+
+			# all but the last batch of an accumulated step only add their gradients
+			losses = []
+			for _ in range(args.accumulate_steps - 1):
+				loss_value, _, reader_stats = sess.run([loss, train_op, reader.stats])
+				losses.append(loss_value)
+				if args.pipeline_stats_every:
+					step_stats.append(reader_stats)
+
+			if args.store_metadata and is_chief and step % 50 == 0:
 				# Slow run that stores extra information for debugging.
 				print('Storing metadata')
 				run_options = tf.RunOptions(
 					trace_level = tf.RunOptions.FULL_TRACE)
 
-				summary, loss_value, _ = sess.run(
-					[summaries, loss, optim],
+				summary, loss_value, _, reader_stats = sess.run(
+					[summaries, loss, train_op, reader.stats],
 					options = run_options,
 					run_metadata = run_metadata)
 
@@ -437,24 +761,40 @@ def main():
 				with open(timeline_path, 'w') as f:
 					f.write(tl.generate_chrome_trace_format(show_memory = True))
 			else:
-				summary, loss_value, _ = sess.run([summaries, loss, optim])
+				summary, loss_value, _, reader_stats = sess.run([summaries, loss, train_op, reader.stats])
 
-				writer.add_summary(summary, step)
+				if is_chief:
+					writer.add_summary(summary, step)
+
+			if args.accumulate_steps > 1:
+				# the update itself does not dequeue a batch
+				sess.run(optim)
+				losses.append(loss_value)
+				loss_value = sum(losses) / len(losses)
 
 			duration = time.time() - start_time
 			print('step {:d} - loss = {:.3f}, ({:.3f} sec/step)'
 				  .format(step, loss_value, duration))
 
-			if step % args.checkpoint_every == 0:
+			if args.pipeline_stats_every:
+				step_stats.append(reader_stats)
+				if step // args.pipeline_stats_every > last_report_step // args.pipeline_stats_every:
+					report_pipeline_stats(writer, step, reader, step_stats)
+					step_stats = []
+					last_report_step = step
+
+			if is_chief and step // args.checkpoint_every > last_saved_step // args.checkpoint_every:
 				save(saver, sess, logdir, step)
 				last_saved_step = step
 
+			next_step = sess.run(global_step)
+
 	except KeyboardInterrupt:
 		# Introduce a line break after ^C is displayed so save message
 		# is on its own line.
 		print()
 	finally:
-		if step > last_saved_step:
+		if is_chief and step is not None and step > last_saved_step:
 			save(saver, sess, logdir, step)
 
 		coord.request_stop()
@@ -1,4 +1,9 @@
 from .model import WaveNetModel
-from .lc_audio_reader import LCAudioReader, MidiMapper, load_files, find_files, clean_midi_files, trim_silence
+from .numpy_generator import NumpyGenerator, sample_categorical_numpy
+from .wav_writer import WavWriter, mu_law_decode_numpy
+from .lc_audio_reader import LCAudioReader, MidiMapper, ParsedMidi, load_midi, load_files, find_files, clean_midi_files, trim_silence, build_cache
+from .lc_dataset_reader import LCDatasetReader
 from .ops import (mu_law_encode, mu_law_decode, time_to_batch,
-                  batch_to_time, causal_conv, optimizer_factory)
+                  batch_to_time, causal_conv, dilated_causal_conv,
+                  optimizer_factory, expand_lc_intervals, sample_categorical,
+                  average_gradients, unscale_gradients, accumulate_gradients)
@@ -1,17 +1,27 @@
 import os
 import re
+import json
 import midi
+import hashlib
 import random
 import librosa
 import fnmatch
 import threading
+import multiprocessing
+import queue
 import numpy as np
 import tensorflow as tf
 import time
-import queue
+from contextlib import contextmanager
+from collections import OrderedDict
+
+from .ops import expand_lc_intervals
 
 # TODO: make sure that set tempo evnets cannot have a tick delta associated with them
 
+# name of the index file of a preprocessed dataset cache
+CACHE_INDEX = 'index.json'
+
 def find_files(directory, pattern):
 	'''Recursively finds all files matching the pattern.'''
 	files = []
@@ -21,18 +31,19 @@ def find_files(directory, pattern):
 	return files
 
 
-def load_files(data_dir, sample_rate, gc_enabled, lc_enabled, lc_fileformat):
-	# get all audio files and print their number
-	audio_files = find_files(data_dir, '*.wav')
-	print("Number of audio files is {}".format(len(audio_files)))
+def load_files(data_dir, sample_rate, gc_enabled, lc_enabled, lc_fileformat, audio_files = None):
+	# get all audio files and print their number, unless we were given our share of them
+	if audio_files is None:
+		audio_files = find_files(data_dir, '*.wav')
+		print("Number of audio files is {}".format(len(audio_files)))
 
-	if lc_enabled:
-		lc_files = find_files(data_dir, lc_fileformat)
-		print("Number of midi files is {}".format(len(lc_files)))
+		if lc_enabled:
+			lc_files = find_files(data_dir, lc_fileformat)
+			print("Number of midi files is {}".format(len(lc_files)))
 
-		# Now make sure the files correspond and are in the same order
-		audio_files, lc_files = clean_midi_files(audio_files, lc_files)
-		print("File clean up done. Final file count is {}".format(len(audio_files) + len(lc_files)))
+			# Now make sure the files correspond and are in the same order
+			audio_files, lc_files = clean_midi_files(audio_files, lc_files)
+			print("File clean up done. Final file count is {}".format(len(audio_files) + len(lc_files)))
 
 	# Returns a generator
 	randomized_files = randomize_files(audio_files)
@@ -62,7 +73,7 @@ def load_files(data_dir, sample_rate, gc_enabled, lc_enabled, lc_fileformat):
 			# entire path name
 			midi_name = os.path.splitext(filename)[0] + ".mid"
 			# This is the entire midi pattern, including the track
-			lc_timeseries = midi.read_midifile(midi_name)
+			lc_timeseries = load_midi(midi_name)
 		else:
 			lc_timeseries = None
 
@@ -108,6 +119,13 @@ def randomize_files(files):
 
 def trim_silence(audio, threshold, frame_length = 2048):
 	'''Removes silence at the beginning and end of a sample.'''
+	start, end = silence_bounds(audio, threshold, frame_length)
+	return audio[start:end]
+
+
+def silence_bounds(audio, threshold, frame_length = 2048):
+	'''Returns the (start, end) sample range of the audio between the leading
+	and trailing silence.'''
 	if audio.size < frame_length:
 		frame_length = audio.size
 	energy = librosa.feature.rmse(audio, frame_length=frame_length)
@@ -115,7 +133,484 @@ def trim_silence(audio, threshold, frame_length = 2048):
 	indices = librosa.core.frames_to_samples(frames)[1]
 
 	# Note: indices can be an empty array, if the whole audio was silence.
-	return audio[indices[0]:indices[-1]] if indices.size else audio[0:0]
+	return (indices[0], indices[-1]) if indices.size else (0, 0)
+
+
+def read_cache_index(cache_dir):
+	'''loads the index of a preprocessed dataset cache, or None if there is none'''
+	index_path = os.path.join(cache_dir, CACHE_INDEX)
+	if not os.path.exists(index_path):
+		return None
+	with open(index_path, 'r') as f:
+		return json.load(f)
+
+
+def cache_sources(data_dir, lc_enabled, lc_fileformat):
+	'''returns the sorted (wav file, midi file or None) pairs a cache of data_dir holds'''
+	audio_files = find_files(data_dir, '*.wav')
+	if lc_enabled:
+		audio_files, _ = clean_midi_files(audio_files, find_files(data_dir, lc_fileformat))
+	return [(filename, os.path.splitext(filename)[0] + ".mid" if lc_enabled else None)
+			for filename in sorted(audio_files)]
+
+
+def cached_entries(cache_dir, settings):
+	'''returns the entries of the cache index by file name, or an empty dict if there
+		is no index or it was built with other settings'''
+	index = read_cache_index(cache_dir)
+	if index is None or index['settings'] != settings:
+		return {}
+	return {entry['filename'] : entry for entry in index['entries']}
+
+
+def valid_entry(cache_dir, entry, mtimes):
+	'''whether a cache entry is still up to date with its source files'''
+	return (entry is not None and entry['mtimes'] == mtimes and
+			all(os.path.exists(os.path.join(cache_dir, entry[key]))
+				for key in ('audio', 'lc') if entry[key] is not None))
+
+
+def read_cache(data_dir, cache_dir, sample_rate, lc_enabled, lc_channels, lc_fileformat,
+			   silence_threshold = None):
+	'''returns the index entries of the files of data_dir like build_cache, but only reads
+		the cache. Returns None if the cache is missing or out of date'''
+	settings = {'sample_rate' : sample_rate,
+				'lc_channels' : lc_channels if lc_enabled else None,
+				'silence_threshold' : silence_threshold}
+	entries_by_file = cached_entries(cache_dir, settings)
+
+	entries = []
+	for filename, midi_name in cache_sources(data_dir, lc_enabled, lc_fileformat):
+		mtimes = [os.path.getmtime(name) for name in (filename, midi_name) if name is not None]
+		entry = entries_by_file.get(filename)
+		if not valid_entry(cache_dir, entry, mtimes):
+			return None
+		entries.append(entry)
+
+	return [entry for entry in entries if entry['audio'] is not None]
+
+
+def wait_for_cache(data_dir, cache_dir, sample_rate, lc_enabled, lc_channels, lc_fileformat,
+				   silence_threshold = None):
+	'''returns the entries of read_cache once another process brought the cache up to date'''
+	while True:
+		entries = read_cache(data_dir, cache_dir, sample_rate, lc_enabled, lc_channels, lc_fileformat,
+							 silence_threshold)
+		if entries is not None:
+			return entries
+		print("Waiting for the cache in {} to be updated ...".format(cache_dir))
+		time.sleep(5)
+
+
+def build_cache(data_dir, cache_dir, sample_rate, lc_enabled, lc_channels, lc_fileformat,
+				silence_threshold = None):
+	'''resamples and silence trims every wav file in data_dir once, upsamples its midi,
+		and saves both as .npy files in cache_dir along with an index.
+		Files whose entry is still valid are skipped. An entry is invalidated by a change in the
+		mtime of its wav or midi file, or by a change in sample_rate, lc_channels or silence_threshold.
+		The index is only rewritten if an entry changed. Only one process should build a cache,
+		the others can wait_for_cache.
+		Returns the list of index entries'''
+	if not os.path.exists(cache_dir):
+		os.makedirs(cache_dir)
+
+	settings = {'sample_rate' : sample_rate,
+				'lc_channels' : lc_channels if lc_enabled else None,
+				'silence_threshold' : silence_threshold}
+
+	entries_by_file = cached_entries(cache_dir, settings)
+	sources = cache_sources(data_dir, lc_enabled, lc_fileformat)
+	if lc_enabled:
+		mapper = MidiMapper(sample_rate = sample_rate, lc_channels = lc_channels)
+
+	# files that were removed from data_dir also change the index
+	changed = set(entries_by_file) != set(filename for filename, _ in sources)
+
+	entries = []
+	for filename, midi_name in sources:
+		mtimes = [os.path.getmtime(name) for name in (filename, midi_name) if name is not None]
+
+		entry = entries_by_file.get(filename)
+		if valid_entry(cache_dir, entry, mtimes):
+			entries.append(entry)
+			continue
+
+		changed = True
+
+		print("Caching {}".format(filename))
+		entry = {'filename' : filename, 'mtimes' : mtimes, 'audio' : None, 'lc' : None}
+		entries.append(entry)
+
+		audio, _ = librosa.load(filename, sr = sample_rate, mono = True)
+		start, end = 0, len(audio)
+		if silence_threshold is not None:
+			start, end = silence_bounds(audio, silence_threshold)
+		if end <= start:
+			print("Warning: {} was ignored as it contains only "
+				  "silence. Consider decreasing trim_silence "
+				  "threshold, or adjust volume of the audio."
+				  .format(filename))
+			continue
+
+		# shard names only depend on the source path so that entries can be reused
+		shard = hashlib.md5(filename.encode('utf-8')).hexdigest()
+		entry['audio'] = shard + '.audio.npy'
+		np.save(os.path.join(cache_dir, entry['audio']),
+				audio[start:end].reshape(-1, 1).astype(np.float32))
+
+		if lc_enabled:
+			# the piano roll is cut to the same samples as the trimmed audio and stored as
+			# one byte per note, without building a float32 roll of the whole file first
+			mapper.set_midi(load_midi(midi_name))
+			entry['lc'] = shard + '.lc.npy'
+			np.save(os.path.join(cache_dir, entry['lc']),
+					mapper.upsample(start, end, dtype = np.uint8))
+
+	# write the index last and atomically so an interrupted run leaves no stale index behind.
+	# The temporary name is per process, so concurrent builds cannot truncate each other's file
+	if changed:
+		index_path = os.path.join(cache_dir, CACHE_INDEX)
+		tmp_path = '{}.{}.tmp'.format(index_path, os.getpid())
+		with open(tmp_path, 'w') as f:
+			json.dump({'settings' : settings, 'entries' : entries}, f)
+		os.rename(tmp_path, index_path)
+
+	return [entry for entry in entries if entry['audio'] is not None]
+
+
+def load_cached_files(cache_dir, entries):
+	'''same as load_files, but memory maps the audio and piano rolls of the cache
+		instead of decoding the source files'''
+	for entry in randomize_files(entries):
+		audio = np.load(os.path.join(cache_dir, entry['audio']), mmap_mode = 'r')
+
+		gc_id = None
+
+		if entry['lc'] is not None:
+			lc_timeseries = CachedPianoRoll(np.load(os.path.join(cache_dir, entry['lc']), mmap_mode = 'r'))
+		else:
+			lc_timeseries = None
+
+		yield audio, entry['filename'], gc_id, lc_timeseries
+
+
+class ReaderTimings():
+	'''Thread safe totals of the time the reader spends in each stage, decoding a file,
+		building the LC of a chunk and enqueueing, and of the number of files decoded.
+		collect returns the averages since the last call, to tell whether the input
+		pipeline or the model is the bottleneck'''
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.reset()
+
+
+	def reset(self):
+		self.totals = {}
+		self.counts = {}
+		self.since = time.time()
+
+
+	def add(self, stage, seconds):
+		with self.lock:
+			self.totals[stage] = self.totals.get(stage, 0.0) + seconds
+			self.counts[stage] = self.counts.get(stage, 0) + 1
+
+
+	@contextmanager
+	def time(self, stage):
+		start = time.time()
+		yield
+		self.add(stage, time.time() - start)
+
+
+	def timed(self, iterable, stage):
+		'''yields the items of iterable, adding the time spent producing each one to stage'''
+		iterator = iter(iterable)
+		while True:
+			start = time.time()
+			try:
+				item = next(iterator)
+			except StopIteration:
+				return
+			self.add(stage, time.time() - start)
+			yield item
+
+
+	def collect(self):
+		'''returns the mean milliseconds per stage and the files decoded per second
+			since the last call, and starts over'''
+		with self.lock:
+			elapsed = max(time.time() - self.since, 1e-6)
+			stats = {stage + '_ms' : 1000 * total / self.counts[stage]
+					 for stage, total in self.totals.items()}
+			stats['files_per_sec'] = self.counts.get('decode', 0) / elapsed
+			self.reset()
+		return stats
+
+
+def timestamp():
+	'''an op returning the wall time in seconds when it runs'''
+	return tf.py_func(time.time, [], tf.float64, stateful = True)
+
+
+def iterate_chunks(examples, receptive_field, sample_size, silence_threshold, lc_channels, lc_transport, sample_rate,
+				   timings = None):
+	'''pre-processes the files yielded by load_files or load_cached_files (silence trimming,
+		LC upsampling and receptive field padding) and yields (piece, gc_id, lc_chunk) for every
+		chunk that goes into the queues. lc_chunk is the dense piano roll of the piece, its note
+		intervals if lc_transport is 'intervals', or None without LC.
+		Decoding and LC times are added to timings'''
+	if timings is None:
+		timings = ReaderTimings()
+
+	# ADAPT:
+	# for MiDi LoCo, instatiate MidiMapper()
+	if lc_channels is not None:
+		mapper = MidiMapper(sample_rate = sample_rate,
+							lc_channels = lc_channels)
+
+	for audio, filename, gc_id, lc_timeseries in timings.timed(examples, 'decode'):
+		print(filename)
+		# TODO: If we remove this silence trimming we can use the randomised queue
+		# instead of the padding queue so that we dont have to take care of midi with silence
+		# the midi keeps the timing of the untrimmed file, like the cache does,
+		# so the LC of the trimmed audio starts at the first sample that was kept
+		trim_start = 0
+		if silence_threshold is not None:
+			trim_start, trim_end = silence_bounds(audio[:, 0], silence_threshold)
+			audio = audio[trim_start:trim_end]
+
+			# now check if the whole audio was trimmed away
+			if audio.size == 0:
+				print("Warning: {} was ignored as it contains only "
+					  "silence. Consider decreasing trim_silence "
+					  "threshold, or adjust volume of the audio."
+					  .format(filename))
+				continue
+
+		# lc_source serves the piano roll rows and note intervals of this file,
+		# either upsampled from the midi or read from the cache
+		if lc_timeseries is None or isinstance(lc_timeseries, CachedPianoRoll):
+			lc_source = lc_timeseries
+		else:
+			mapper.set_midi(lc_timeseries)
+			lc_source = mapper
+
+		# now pad beginning of samples with n = receptive_ field number of 0s 
+		# TODO: figure out why we are padding this ???
+		audio = np.pad(audio, [[receptive_field, 0], [0, 0]], 'constant')
+
+		# the midi sample of the first sample of the padded audio
+		piece_start = trim_start - receptive_field
+
+		# CHOP UP AUDIO
+		if sample_size:
+			# TODO: understand the reason for this piece voodoo from the original reader
+			while len(audio) > receptive_field:
+				piece = audio[:(receptive_field + sample_size), :]
+
+				if lc_source is None:
+					lc_chunk = None
+
+				elif lc_transport == 'intervals':
+					with timings.time('upsample'):
+						lc_chunk = lc_source.clip_intervals(piece_start, piece_start + len(piece))
+
+				else:
+					# only the rows of this piece are built, zero padded where the midi does not reach
+					with timings.time('upsample'):
+						lc_chunk = lc_source.window(piece_start, piece_start + len(piece))
+
+				yield piece, gc_id, lc_chunk
+
+				# after queueing, shift audio frame to the next one
+				audio = audio[sample_size:, :]
+				piece_start += sample_size
+
+		# DONT CHOP UP AUDIO
+		else:
+			# otherwise feed the whole audio sample in its entireity
+			# the rows for the padding before the midi starts are zero
+			if lc_source is None:
+				lc_chunk = None
+			elif lc_transport == 'intervals':
+				with timings.time('upsample'):
+					lc_chunk = lc_source.clip_intervals(piece_start, piece_start + len(audio))
+			else:
+				with timings.time('upsample'):
+					lc_chunk = lc_source.upsample(start_sample = piece_start, end_sample = piece_start + len(audio))
+
+			yield audio, gc_id, lc_chunk
+
+
+def read_rows(array, start, end):
+	'''returns rows [start, end) of a 2D, usually memory mapped, array as float32,
+		with zero rows where the range is outside of it. Only these rows are read'''
+	rows = np.zeros(shape = (max(0, end - start), array.shape[1]), dtype = np.float32)
+
+	first = max(0, start)
+	last = min(end, len(array))
+	if first < last:
+		rows[first - start:last - start] = array[first:last]
+
+	return rows
+
+
+def build_chunk_index(cache_dir, entries, receptive_field, sample_size):
+	'''lists every chunk iterate_chunks would cut from the cached files as two arrays,
+		the index of its entry and the sample its receptive field starts at. Only the
+		headers of the memory maps are read, so this is cheap even for large datasets'''
+	files = []
+	starts = []
+	for index, entry in enumerate(entries):
+		length = len(np.load(os.path.join(cache_dir, entry['audio']), mmap_mode = 'r'))
+		# same offsets as the sequential walk over the receptive field padded audio
+		chunk_starts = np.arange(0, length, sample_size) - receptive_field
+		files.append(np.full(len(chunk_starts), index, dtype = np.int64))
+		starts.append(chunk_starts.astype(np.int64))
+	return np.concatenate(files), np.concatenate(starts)
+
+
+class ChunkSampler():
+	'''Draws random chunks from a chunk index built by build_chunk_index.
+		Uniform sampling gives every chunk the same chance, so long files are seen
+		in proportion to their length. Stratified sampling first draws a file and
+		then a chunk of it, so every file is seen equally often'''
+
+	def __init__(self, files, starts, stratified = False, seed = None):
+		self.files = files
+		self.starts = starts
+		self.stratified = stratified
+		self.random = np.random.RandomState(seed)
+
+		# the index is ordered by file, so the chunks of a file are a contiguous range
+		num_files = files[-1] + 1
+		self.file_first = np.searchsorted(files, np.arange(num_files))
+		self.file_count = np.diff(np.append(self.file_first, len(files)))
+
+
+	def sample(self):
+		'''returns the (file index, start sample) of a random chunk'''
+		if self.stratified:
+			file = self.random.randint(len(self.file_first))
+			chunk = self.file_first[file] + self.random.randint(self.file_count[file])
+		else:
+			chunk = self.random.randint(len(self.starts))
+		return self.files[chunk], self.starts[chunk]
+
+
+def sample_chunks(cache_dir, entries, sampler, receptive_field, sample_size, lc_transport, timings = None):
+	'''yields (piece, gc_id, lc_chunk) like iterate_chunks, for an endless stream of
+		chunks drawn by the sampler. Every chunk is a slice of the memory mapped cache'''
+	if timings is None:
+		timings = ReaderTimings()
+
+	audio_maps = {}
+	lc_maps = {}
+	while True:
+		file, start = sampler.sample()
+		if file not in audio_maps:
+			entry = entries[file]
+			audio_maps[file] = np.load(os.path.join(cache_dir, entry['audio']), mmap_mode = 'r')
+			if entry['lc'] is not None:
+				lc_maps[file] = CachedPianoRoll(np.load(os.path.join(cache_dir, entry['lc']), mmap_mode = 'r'))
+
+		audio = audio_maps[file]
+		# the last chunk of a file is shorter, the one before the start is zero padded
+		end = min(start + receptive_field + sample_size, len(audio))
+		piece = read_rows(audio, start, end)
+
+		gc_id = None
+
+		lc_source = lc_maps.get(file)
+		if lc_source is None:
+			lc_chunk = None
+		elif lc_transport == 'intervals':
+			with timings.time('upsample'):
+				lc_chunk = lc_source.clip_intervals(start, end)
+		else:
+			with timings.time('upsample'):
+				lc_chunk = lc_source.window(start, end)
+
+		yield piece, gc_id, lc_chunk
+
+
+class SharedChunkSlots():
+	'''A fixed pool of shared memory buffers that each hold one chunk of audio and its
+		dense LC. Decoding processes fill free slots and the reader threads copy the chunks
+		out of filled slots and free them again, without pickling the arrays'''
+
+	def __init__(self, num_slots, max_samples, lc_channels = None):
+		self.max_samples = max_samples
+		self.lc_channels = lc_channels
+
+		self.audio = multiprocessing.RawArray('f', num_slots * max_samples)
+		if lc_channels is not None:
+			self.lc = multiprocessing.RawArray('f', num_slots * max_samples * lc_channels)
+		else:
+			self.lc = None
+
+		self.free = multiprocessing.Queue()
+		self.filled = multiprocessing.Queue()
+		for slot in range(num_slots):
+			self.free.put(slot)
+
+
+	def audio_rows(self, slot):
+		buffer = np.frombuffer(self.audio, dtype = np.float32)
+		return buffer[slot * self.max_samples:(slot + 1) * self.max_samples].reshape(-1, 1)
+
+
+	def lc_rows(self, slot):
+		size = self.max_samples * self.lc_channels
+		buffer = np.frombuffer(self.lc, dtype = np.float32)
+		return buffer[slot * size:(slot + 1) * size].reshape(-1, self.lc_channels)
+
+
+	def put(self, piece, gc_id, lc_chunk):
+		'''called by the decoding processes, blocks until a slot is free'''
+		slot = self.free.get()
+		num_samples = len(piece)
+		self.audio_rows(slot)[:num_samples] = piece
+
+		# dense LC goes through shared memory, note intervals are small enough to be pickled
+		if self.lc is not None:
+			self.lc_rows(slot)[:num_samples] = lc_chunk
+			lc_chunk = None
+
+		self.filled.put((slot, num_samples, gc_id, lc_chunk))
+
+
+	def get(self, timeout = None):
+		'''called by the reader threads, returns a copy of the chunk in a filled slot
+			and frees the slot. The queue may keep a fed array without copying it,
+			so it must not point into a slot a decoding process can refill'''
+		slot, num_samples, gc_id, lc_chunk = self.filled.get(timeout = timeout)
+		piece = np.array(self.audio_rows(slot)[:num_samples])
+		if self.lc is not None:
+			lc_chunk = np.array(self.lc_rows(slot)[:num_samples])
+		self.free.put(slot)
+		return piece, gc_id, lc_chunk
+
+
+def decode_worker(files, slots, cache_dir, data_dir, sample_rate, gc_enabled, lc_enabled,
+				  lc_fileformat, receptive_field, sample_size, silence_threshold, lc_channels,
+				  lc_transport):
+	'''main loop of a decoding process. Decodes its share of the files over and over
+		and hands the chunks to the reader through the shared memory slots'''
+	while True:
+		if cache_dir is not None:
+			examples = load_cached_files(cache_dir, files)
+			# the cache is already trimmed
+			silence_threshold = None
+		else:
+			examples = load_files(data_dir, sample_rate, gc_enabled, lc_enabled, lc_fileformat, audio_files = files)
+
+		for piece, gc_id, lc_chunk in iterate_chunks(examples, receptive_field, sample_size, silence_threshold,
+													 lc_channels if lc_enabled else None, lc_transport, sample_rate):
+			slots.put(piece, gc_id, lc_chunk)
+
 
 class LCAudioReader():
 	def __init__(self,
@@ -130,7 +625,16 @@ class LCAudioReader():
 				sample_size = None,
 				silence_threshold = None,
 				q_size = 32,
-				sess = None):
+				sess = None,
+				lc_transport = 'dense',
+				cache_dir = None,
+				num_workers = 0,
+				enqueue_batch = 1,
+				chunk_sampling = 'sequential',
+				length_buckets = None,
+				shard_index = 0,
+				num_shards = 1,
+				update_cache = True):
 		# Input member vars initialiations
 		self.data_dir = data_dir
 		self.coord = coord
@@ -144,28 +648,91 @@ class LCAudioReader():
 		self.silence_threshold = silence_threshold
 		self.q_size = q_size
 		self.sess = sess
+		self.lc_transport = lc_transport
+		self.cache_dir = cache_dir
+		self.num_workers = num_workers
+		self.enqueue_batch = enqueue_batch
+		self.chunk_sampling = chunk_sampling
+		self.length_buckets = sorted(length_buckets) if length_buckets else None
+		self.shard_index = shard_index
+		self.num_shards = num_shards
+		self.update_cache = update_cache
+
+		if self.lc_transport not in ('dense', 'intervals'):
+			raise ValueError("Unknown LC transport '{}'. Expected 'dense' or 'intervals'.".format(self.lc_transport))
+
+		if self.num_workers and not self.sample_size:
+			raise ValueError("Decoding worker processes need a sample size to size their shared memory.")
+
+		if self.chunk_sampling not in ('sequential', 'uniform', 'stratified'):
+			raise ValueError("Unknown chunk sampling '{}'. Expected 'sequential', 'uniform' "
+							 "or 'stratified'.".format(self.chunk_sampling))
+
+		# random chunks are slices of the memory mapped cache, there is nothing left to decode
+		if self.chunk_sampling != 'sequential' and (self.cache_dir is None or not self.sample_size or self.num_workers):
+			raise ValueError("Random chunk sampling needs a cache dir and a sample size, "
+							 "and no decoding worker processes.")
+
+		# the worker processes enqueue chunk by chunk and cannot keep the batches of a bucket together
+		if self.length_buckets is not None and self.num_workers:
+			raise ValueError("Length buckets cannot be used with decoding worker processes.")
 
 		# Non-input member vars initialization
 		self.threads = []
+		self.processes = []
+
+		# stage timings of the reader threads, see pipeline_stats
+		self.timings = ReaderTimings()
 		
-		# DATA QUEUES
+		# DATA QUEUE
 
+		# A single queue carries the audio, GC and LC of a chunk as one element,
+		# so a dequeue_many always returns matching components no matter
+		# how many threads are enqueueing
 		# Audio samples are float32s that have not yet been encoded into one hots
-		self.audio_placeholder = tf.placeholder(dtype = tf.float32, shape = None)
-		self.q_audio = tf.PaddingFIFOQueue(capacity = q_size, dtypes = [tf.float32], shapes = [(None, 1)])
-		self.enq_audio = self.q_audio.enqueue([self.audio_placeholder])
+		self.components = ['audio']
+		dtypes = [tf.float32]
+		shapes = [(None, 1)]
 
 		if self.gc_enabled:
-			# GC samples are embedding vectors with the shape of 1 X GC_channels
-			self.gc_placeholder = tf.placeholder(dtype = tf.int32, shape = ())
-			self.q_gc = tf.PaddingFIFOQueue(capacity = q_size, dtypes = [tf.int32], shapes = [(None, 1)])
-			self.enq_gc = self.q_gc.enqueue([self.gc_placeholder])
-
-		if self.lc_enabled:	
+			# GC samples are the category id of the chunk
+			self.components.append('gc')
+			dtypes.append(tf.int32)
+			shapes.append((1,))
+
+		if self.lc_enabled and self.lc_transport == 'intervals':
+			# LC samples are the (start, end, note) intervals of the chunk.
+			# This is a few bytes per note instead of lc_channels float32s per sample,
+			# and dq_lc expands them back to the dense piano roll in-graph
+			self.components.append('lc')
+			dtypes.append(tf.int32)
+			shapes.append((None, 3))
+
+		elif self.lc_enabled:
 			# LC samples are embedding vectors with the shape of 1 X LC_channels
-			self.lc_placeholder = tf.placeholder(dtype = tf.float32, shape = (None, self.lc_channels))
-			self.q_lc = tf.PaddingFIFOQueue(capacity = q_size, dtypes = [tf.float32], shapes = [(None, self.lc_channels)])
-			self.enq_lc = self.q_lc.enqueue([self.lc_placeholder])
+			self.components.append('lc')
+			dtypes.append(tf.float32)
+			shapes.append((None, self.lc_channels))
+
+		# the unpadded length of the chunk in samples, for the loss mask and the LC expansion
+		self.components.append('length')
+		dtypes.append(tf.int32)
+		shapes.append(())
+
+		self.queue = tf.PaddingFIFOQueue(capacity = q_size, dtypes = dtypes, shapes = shapes)
+
+		# one placeholder per component for single chunks, and a batched one for enqueue_many
+		self.placeholders = [tf.placeholder(dtype = dtype, shape = shape)
+							 for dtype, shape in zip(dtypes, shapes)]
+		self.enq = self.queue.enqueue(self.placeholders)
+		self.batch_placeholders = [tf.placeholder(dtype = dtype, shape = (None,) + shape)
+								   for dtype, shape in zip(dtypes, shapes)]
+		self.enq_many = self.queue.enqueue_many(self.batch_placeholders)
+
+		# the dequeued batch, shared by dq_audio, dq_gc and dq_lc
+		self.batch = None
+		self.batch_size = None
+		self.stats = None
 
 		# now load in the files and see if they exist
 		audio_files = find_files(self.data_dir, '*.wav')
@@ -178,6 +745,32 @@ class LCAudioReader():
 			if not lc_files:
 				raise ValueError("No MIDI files found in '{}'".format(self.data_dir))
 
+			# Now make sure the files correspond and are in the same order
+			audio_files, lc_files = clean_midi_files(audio_files, lc_files)
+
+		# bring the preprocessed cache up to date, this only decodes new or changed files.
+		# Readers that share the cache with one that updates it only wait for it
+		# self.files is what gets split between the reader threads or processes
+		if self.cache_dir is not None:
+			load_cache = build_cache if self.update_cache else wait_for_cache
+			self.files = load_cache(self.data_dir, self.cache_dir, self.sample_rate,
+									self.lc_enabled, self.lc_channels, self.lc_fileformat,
+									self.silence_threshold)
+		else:
+			# sorted, so that every worker splits the files the same way
+			self.files = sorted(audio_files)
+
+		# in distributed training every worker only reads its own shard of the dataset
+		self.files = self.files[self.shard_index::self.num_shards]
+		if not self.files:
+			raise ValueError("Shard {} of {} has no files.".format(self.shard_index, self.num_shards))
+
+		# every (file, offset) chunk position, built once so that random chunks are O(1) to find
+		self.chunk_index = None
+		if self.chunk_sampling != 'sequential':
+			self.chunk_index = build_chunk_index(self.cache_dir, self.files, self.receptive_field, self.sample_size)
+			print("Number of chunks is {}".format(len(self.chunk_index[0])))
+
 
 	def get_gc_cardinality(self):
 		'''ADAPT:
@@ -188,156 +781,351 @@ class LCAudioReader():
 
 	def dq_audio(self, num_elements):
 		'''Deques audio samples. Each element is an entire sample batch'''
-		return self.q_audio.dequeue_many(num_elements)
+		return self.dequeue(num_elements)['audio']
 
 
 	def dq_gc(self, num_elements):
-		'''Deques corresponding GC embeddings samples. Each element is an entire sample batch'''
-		return self.q_gc.dequeue_many(num_elements)
+		'''Returns the GC ids of the batch returned by dq_audio'''
+		return self.dequeue(num_elements)['gc']
 
 	
 	def dq_lc(self, num_elements):
-		'''Deques corresponding LC embeddings samples. Each element is an entire sample batch'''
-		return self.q_lc.dequeue_many(num_elements)
+		'''Returns the LC embeddings of the batch returned by dq_audio'''
+		batch = self.dequeue(num_elements)
+		if self.lc_transport == 'intervals':
+			return expand_lc_intervals(batch['lc'], batch['length'], self.lc_channels)
+		return batch['lc']
+
+
+	def dq_length(self, num_elements):
+		'''Returns the unpadded lengths of the batch returned by dq_audio'''
+		return self.dequeue(num_elements)['length']
+
+
+	def dequeue(self, num_elements):
+		'''Creates the single dequeue_many op on first use and returns its components by name.
+			The fill level of the queue before the dequeue and the seconds the dequeue waited
+			go into self.stats and the summaries'''
+		if self.batch is None:
+			self.batch_size = num_elements
+			with tf.name_scope('reader'):
+				start = timestamp()
+				queue_size = self.queue.size()
+				with tf.control_dependencies([start, queue_size]):
+					components = self.queue.dequeue_many(num_elements)
+				with tf.control_dependencies(components):
+					dequeue_wait = timestamp() - start
+				self.stats = {'queue_size' : queue_size, 'dequeue_wait' : dequeue_wait}
+				for name, value in self.stats.items():
+					tf.summary.scalar(name, value)
+			self.batch = dict(zip(self.components, components))
+		elif num_elements != self.batch_size:
+			raise ValueError("All dequeues of a LCAudioReader must use the same batch size, "
+							 "got {} and {}.".format(self.batch_size, num_elements))
+		return self.batch
+
+
+	def chunk_values(self, piece, gc_id, lc_chunk):
+		'''lays out a chunk from iterate_chunks in the order of the queue components'''
+		values = [piece]
+		# ADAPT: This is where we get the GC ID mapping from audio
+		if self.gc_enabled:
+			values.append(np.reshape(gc_id, [1]))
+		if self.lc_enabled:
+			values.append(lc_chunk)
+		values.append(len(piece))
+		return values
+
+
+	def enqueue_chunk(self, piece, gc_id, lc_chunk):
+		'''feeds one chunk from iterate_chunks to the queue in a single Session call'''
+		values = self.chunk_values(piece, gc_id, lc_chunk)
+		with self.timings.time('enqueue'):
+			self.sess.run(self.enq, feed_dict = dict(zip(self.placeholders, values)))
+
+
+	def enqueue_chunks(self, chunks):
+		'''feeds a list of chunks to the queue in a single Session call. Chunks of different
+			lengths are zero padded to the longest one and note intervals are padded with
+			empty (0, 0, 0) intervals, like the padding queue does'''
+		columns = list(zip(*[self.chunk_values(*chunk) for chunk in chunks]))
+		batch = []
+		for name, column in zip(self.components, columns):
+			if name in ('audio', 'lc'):
+				column = [np.asarray(value) for value in column]
+				padded = np.zeros((len(column), max(len(value) for value in column)) + column[0].shape[1:],
+								  dtype = column[0].dtype)
+				for index, value in enumerate(column):
+					padded[index, :len(value)] = value
+				batch.append(padded)
+			else:
+				batch.append(np.stack(column))
+		with self.timings.time('enqueue'):
+			self.sess.run(self.enq_many, feed_dict = dict(zip(self.batch_placeholders, batch)))
 
-	
-	def input_stream(self):
+
+	def input_stream(self, shard = 0, num_shards = 1):
 		'''this is the main thread which gets the file names and GC embedding 
 			and LC file name from the load_files
 			and then pre-processes the audio for silence trimming (if enabled)
-			and then up samples the local conditioning feeds them to the queues'''
+			and then up samples the local conditioning feeds them to the queues.
+			Each thread only reads its own shard of the files'''
+		if self.chunk_sampling != 'sequential':
+			# every thread draws from all of the files with its own random state
+			sampler = ChunkSampler(*self.chunk_index, stratified = self.chunk_sampling == 'stratified')
+			self.feed_chunks(sample_chunks(self.cache_dir, self.files, sampler, self.receptive_field,
+										   self.sample_size, self.lc_transport, self.timings), {})
+			return
+
+		files = self.files[shard::num_shards]
+		if not files:
+			return
+
+		# the cache is already trimmed
+		silence_threshold = self.silence_threshold if self.cache_dir is None else None
+
 		stop = False
 
+		# chunks waiting for their length bucket to fill up a batch, kept across passes over the files
+		buckets = {}
+
 		# keep looping until training is done
 		while not stop:
 			# get the list of files and related data
-			iterator = load_files(self.data_dir, self.sample_rate, self.gc_enabled, self.lc_enabled, self.lc_fileformat)
+			# the cache is already resampled, trimmed and upsampled
+			if self.cache_dir is not None:
+				iterator = load_cached_files(self.cache_dir, files)
+			else:
+				iterator = load_files(self.data_dir, self.sample_rate, self.gc_enabled, self.lc_enabled, self.lc_fileformat,
+									  audio_files = files)
+
+			stop = self.feed_chunks(iterate_chunks(iterator, self.receptive_field, self.sample_size, silence_threshold,
+												   self.lc_channels if self.lc_enabled else None,
+												   self.lc_transport, self.sample_rate, self.timings), buckets)
+
+
+	def bucket_of(self, length):
+		'''index of the smallest length bucket that holds a chunk of this length'''
+		return int(np.searchsorted(self.length_buckets, length))
 
-			# ADAPT:
-			# for MiDi LoCo, instatiate MidiMapper()
-			if self.lc_enabled:
-				mapper = MidiMapper(sample_rate = self.sample_rate,
-									lc_channels = self.lc_channels)
 
-			for audio, filename, gc_id, lc_timeseries in iterator:
+	def feed_chunks(self, chunks, buckets):
+		'''enqueues the chunks in batches of up to enqueue_batch. Returns True if it stopped
+			because training is done.
+			With length buckets, chunks are instead collected per bucket in buckets and every
+			full training batch is enqueued at once. dequeue_many then takes exactly one of them,
+			so a batch is only padded to the longest chunk of its bucket'''
+		if self.length_buckets is not None:
+			for chunk in chunks:
 				if self.coord.should_stop():
-					stop = True
-					break
-
-				print(filename)
-				# TODO: If we remove this silence trimming we can use the randomised queue
-				# instead of the padding queue so that we dont have to take care of midi with silence
-				if self.silence_threshold is not None:
-					audio = trim_silence(audio[:, 0], self.silence_threshold)
-					audio = audio.reshape(-1, 1)
-
-					# now check if the whole audio was trimmed away
-					if audio.size == 0:
-						print("Warning: {} was ignored as it contains only "
-							  "silence. Consider decreasing trim_silence "
-							  "threshold, or adjust volume of the audio."
-							  .format(filename))
-						continue
-
-				len_audio_prepad = len(audio)
-				# now pad beginning of samples with n = receptive_ field number of 0s 
-				# TODO: figure out why we are padding this ???
-				audio = np.pad(audio, [[self.receptive_field, 0], [0, 0]], 'constant')
-				len_audio_postpad = len(audio)
-
-				# CHOP UP AUDIO
-				if self.sample_size:
-					#first_loop = True
-					# TODO: sample size has been disabled for now. adapt to support in the future
-					if self.lc_enabled:
-						# ADAPT:
-						# setup parametrs for MidiMapper
-						previous_end = 0
-						new_end = self.sample_size + self.receptive_field - 1
-						mapper.set_midi(lc_timeseries)
-						#np.zeros(shape = (len_audio_postpad - len_audio_prepad, self.lc_channels), dtype = np.float32)
-						
-					# TODO: understand the reason for this piece voodoo from the original reader
-						lc_embeddings = mapper.upsample(start_sample = - self.receptive_field)
-
-					while len(audio) > self.receptive_field:
-						piece = audio[:(self.receptive_field + self.sample_size), :]
-						self.sess.run(self.enq_audio, feed_dict = {self.audio_placeholder : piece})
-
-						# add GC mapping to q if enabled
-						if self.gc_enabled:
-							self.sess.run(self.enq_gc, feed_dict = {self.gc_placeholder : gc_id})
-
-						# add LC mapping to queue if enabled
-						if self.lc_enabled:
-							# TODO: sanity check the following four lines
-							# mapper.set_sample_range(start_sample = previous_end - self.receptive_field, end_sample = new_end)
-							# lc_encode = mapper.upsample(start_sample = previous_end - self.receptive_field, end_sample = new_end)
-							# if (first_loop):
-							#	first_pad = np.zeros(shape = (len_audio_postpad - len_audio_prepad, self.lc_channels), dtype = np.float32)
-							#	lc_encode = np.concatenate((first_pad, lc_encode), axis = 0)
-							#	first_loop = False
-							lc_embeddings_chunk = lc_embeddings[:(self.receptive_field + self.sample_size), :]
-
-							# now pad the embeddings to match size
-							delta_len = len(piece) - len(lc_embeddings_chunk)
-							if (delta_len > 0):
-								lc_encode_postpad = np.zeros(shape = (delta_len, self.lc_channels), dtype = np.float32)
-								lc_embeddings_chunk = np.concatenate((lc_embeddings_chunk, lc_encode_postpad), axis = 0)
-							elif (delta_len < 0):
-								lc_embeddings_chunk = lc_embeddings_chunk[0:len(lc_embeddings_chunk) + delta_len :1]
-							
-							self.sess.run(self.enq_lc, feed_dict = {self.lc_placeholder : lc_embeddings_chunk})
-							# after queueing, shift audio frame to the next one
-							previous_end = new_end
-							new_end = new_end + self.sample_size
-							
-							print(delta_len)
-							
-						audio = audio[self.sample_size:, :]
-						lc_embeddings = lc_embeddings[self.sample_size:, :]
-							
-						
-						
-				# DONT CHOP UP AUDIO
-				else:
-					# otherwise feed the whole audio sample in its entireity
-					self.sess.run(self.enq_audio, feed_dict = {self.audio_placeholder : audio})
-
-					# add GC mapping to q if enabled
-					if self.gc_enabled:
-						self.sess.run(self.enq_gc, feed_dict = {self.gc_placeholder : gc_id})
-					
-					# add LC mapping to queue if enabled
-					if self.lc_enabled:
-						# first we include the zero embeddings to compensate for the padding of the audio
-						lc_encode_prepad = np.zeros(shape = (len_audio_postpad - len_audio_prepad, self.lc_channels), dtype = np.float32)
-						# ADAPT:
-						# first we pass the get the metadata to pass to the midi mapper
-						mapper.set_sample_range(start_sample = 0, end_sample = len(audio))
-						mapper.set_midi(lc_timeseries)
-						lc_encode = mapper.upsample()
-						lc_encode = np.concatenate((lc_encode_prepad, lc_encode), axis = 0)
-
-						delta_len = len(audio) - len(lc_encode)
-						if (delta_len > 0):
-							lc_encode_postpad = np.zeros(shape = (delta_len, self.lc_channels), dtype = np.float32)  
-							lc_encode = np.concatenate((lc_encode, lc_encode_postpad), axis = 0)
-						elif (delta_len < 0):
-							lc_encode = lc_encode[0:len(lc_encode) + delta_len - 1:1]
-						
-						
-						self.sess.run(self.enq_lc, feed_dict = {self.lc_placeholder : lc_encode})
+					return True
+
+				bucket = buckets.setdefault(self.bucket_of(len(chunk[0])), [])
+				bucket.append(chunk)
+				if len(bucket) == self.batch_size:
+					self.enqueue_chunks(bucket)
+					del bucket[:]
+			return False
+
+		batch = []
+		for chunk in chunks:
+			if self.coord.should_stop():
+				return True
+
+			# enqueue_many needs chunks of one length, the last chunk of a file is shorter
+			if batch and len(chunk[0]) != len(batch[0][0]):
+				self.enqueue_chunks(batch)
+				batch = []
+
+			batch.append(chunk)
+			if len(batch) == self.enqueue_batch:
+				self.enqueue_chunks(batch)
+				batch = []
+
+		if batch:
+			self.enqueue_chunks(batch)
+		return False
+
+
+	def feed_stream(self):
+		'''reader thread used with decoding processes. It only moves the chunks the
+			processes left in shared memory into the queues, enqueue_batch at a time'''
+		self.feed_chunks(self.slot_chunks(), {})
+
+
+	def slot_chunks(self):
+		'''yields the chunks of the decoding processes until training is done'''
+		while not self.coord.should_stop():
+			try:
+				yield self.slots.get(timeout = 1)
+			except queue.Empty:
+				continue
 
 
 	def start_threads(self, n_threads = 1):
+		if self.length_buckets is not None and self.batch_size is None:
+			raise ValueError("Length buckets enqueue whole batches, dequeue a batch before starting the threads.")
+
+		if self.num_workers:
+			return self.start_processes(n_threads)
+
+		for shard in range(n_threads):
+			thread = threading.Thread(target = self.input_stream, args = (shard, n_threads))
+			thread.daemon = True  # Thread will close when parent quits.
+			thread.start()
+			self.threads.append(thread)
+		return self.threads
+
+
+	def start_processes(self, n_threads = 1):
+		'''splits the files between num_workers processes that decode, resample and upsample
+			in parallel, and starts n_threads reader threads that feed their chunks to the queues'''
+		dense_lc = self.lc_enabled and self.lc_transport == 'dense'
+		self.slots = SharedChunkSlots(num_slots = 2 * self.num_workers,
+									  max_samples = self.receptive_field + self.sample_size,
+									  lc_channels = self.lc_channels if dense_lc else None)
+
+		for shard in range(self.num_workers):
+			process = multiprocessing.Process(
+				target = decode_worker,
+				kwargs = dict(files = self.files[shard::self.num_workers],
+							  slots = self.slots,
+							  cache_dir = self.cache_dir,
+							  data_dir = self.data_dir,
+							  sample_rate = self.sample_rate,
+							  gc_enabled = self.gc_enabled,
+							  lc_enabled = self.lc_enabled,
+							  lc_fileformat = self.lc_fileformat,
+							  receptive_field = self.receptive_field,
+							  sample_size = self.sample_size,
+							  silence_threshold = self.silence_threshold,
+							  lc_channels = self.lc_channels,
+							  lc_transport = self.lc_transport))
+			process.daemon = True  # Process will close when parent quits.
+			process.start()
+			self.processes.append(process)
+
 		for _ in range(n_threads):
-			thread = threading.Thread(target = self.input_stream, args = ())
+			thread = threading.Thread(target = self.feed_stream, args = ())
 			thread.daemon = True  # Thread will close when parent quits.
 			thread.start()
 			self.threads.append(thread)
 		return self.threads
 
+# parsed midi files by (path, mtime), see load_midi. Beyond MIDI_CACHE_SIZE
+# files the least recently used one is dropped
+MIDI_CACHE_SIZE = 256
+MIDI_CACHE = OrderedDict()
+MIDI_CACHE_LOCK = threading.Lock()
+
+# default is 120 BPM until the first set tempo event
+DEFAULT_TEMPO = 500000
+
+
+def load_midi(filename):
+	'''reads and parses a midi file, or returns the ParsedMidi of an earlier call
+		if the file did not change since'''
+	key = (filename, os.path.getmtime(filename))
+	with MIDI_CACHE_LOCK:
+		parsed = MIDI_CACHE.pop(key, None)
+		if parsed is not None:
+			# reinsert as the most recently used
+			MIDI_CACHE[key] = parsed
+			return parsed
+
+	parsed = ParsedMidi(midi.read_midifile(filename))
+	with MIDI_CACHE_LOCK:
+		MIDI_CACHE[key] = parsed
+		while len(MIDI_CACHE) > MIDI_CACHE_SIZE:
+			MIDI_CACHE.popitem(last = False)
+	return parsed
+
+
+class ParsedMidi():
+	'''The first track of a midi pattern, walked once into a tempo map and
+	note intervals so that times can be looked up with a binary search'''
+
+	def __init__(self, pattern):
+		# this is the PPQ (pulses per quarter note, aka ticks per beat). Constant.
+		self.resolution = pattern.resolution
+		track = pattern[0]
+
+		# tempo map: tempos[i] microseconds per beat from absolute tick tempo_ticks[i] on,
+		# which is tempo_microseconds[i] into the song
+		tempo_ticks = [0]
+		tempos = [DEFAULT_TEMPO]
+
+		# this is the index in the track and the tempo of the first note of the midi
+		self.first_note_index = None
+		self.first_tempo = None
+
+		# maps each sounding note to the tick it started at
+		active = {}
+		starts = []
+		ends = []
+		notes = []
+
+		tick = 0
+		for index, event in enumerate(track):
+			tick += event.tick
+
+			if event.name == midi.NoteOnEvent.name and event.data[1] > 0:
+				if self.first_note_index is None:
+					self.first_note_index = index
+					self.first_tempo = tempos[-1]
+				note = event.data[0]
+				if note not in active:
+					active[note] = tick
+
+			elif event.name in (midi.NoteOnEvent.name, midi.NoteOffEvent.name):
+				# a note on with zero velocity is a note off
+				note = event.data[0]
+				if note in active:
+					starts.append(active.pop(note))
+					ends.append(tick)
+					notes.append(note)
+
+			elif event.name == midi.SetTempoEvent.name:
+				# tempo is represented in microseconds per beat as tt tt tt - 24-bit (3-byte) hex
+				tempo = (event.data[0] << 16) | (event.data[1] << 8) | event.data[2]
+				if tempo_ticks[-1] == tick:
+					tempos[-1] = tempo
+				else:
+					tempo_ticks.append(tick)
+					tempos.append(tempo)
+
+			elif event.name == midi.EndOfTrackEvent.name:
+				break
+
+		self.end_tick = tick
+
+		# notes still sounding at the end of the track are cut there
+		for note, start in active.items():
+			starts.append(start)
+			ends.append(tick)
+			notes.append(note)
+
+		self.tempo_ticks = np.array(tempo_ticks, dtype = np.int64)
+		self.tempos = np.array(tempos, dtype = np.float64)
+		segment_microseconds = np.diff(self.tempo_ticks) * self.tempos[:-1] / self.resolution
+		self.tempo_microseconds = np.concatenate([[0.0], np.cumsum(segment_microseconds)])
+
+		# note intervals in ticks, sorted by start
+		order = np.argsort(starts, kind = 'mergesort')
+		self.start_ticks = np.array(starts, dtype = np.int64)[order]
+		self.end_ticks = np.array(ends, dtype = np.int64)[order]
+		self.notes = np.array(notes, dtype = np.int64)[order]
+
+		self.length_microseconds = self.ticks_to_microseconds(self.end_tick)
+
+
+	def ticks_to_microseconds(self, ticks):
+		'''converts absolute ticks to microseconds into the song with a binary search of the tempo map'''
+		segment = np.searchsorted(self.tempo_ticks, ticks, side = 'right') - 1
+		return (self.tempo_microseconds[segment] +
+				(ticks - self.tempo_ticks[segment]) * self.tempos[segment] / self.resolution)
+
+
 # Template for the midi mapper
 class MidiMapper():
 	
@@ -356,9 +1144,7 @@ class MidiMapper():
 		self.PPQN = None
 		self.first_note_index = None
 		self.midi = None
-
-		# mapper just holds a queue of numpy arrays, shape of the overall queue is (1, lc_channels)
-		self.mapper_lc_q = queue.Queue()
+		self.intervals = None
 
 	def set_sample_range(self, start_sample, end_sample):
 		'''Allow the sample range to change at runtime so new MidiMappers'''
@@ -369,9 +1155,13 @@ class MidiMapper():
 
 	def set_midi(self, midi):
 		'''Allow midi file to be reassigned at runtime so that new MidiMappers
-		   do not have to be instantiated for the each new midi file'''
+		   do not have to be instantiated for the each new midi file.
+		   Takes a midi pattern or a ParsedMidi, e.g. from load_midi'''
+		if not isinstance(midi, ParsedMidi):
+			midi = ParsedMidi(midi)
 		self.midi = midi
 		self.update_midi_metadata()
+		self.intervals = self.note_intervals()
 
 
 	def sample_to_microseconds(self, sample_num):
@@ -391,177 +1181,117 @@ class MidiMapper():
 	
 	
 	def update_midi_metadata(self):
-		'''gets all the metadata here from the midi file header'''
-		tempo = None
-		track = self.midi[0]
-		event_name = track[0].name
-		first_note_index = 0
-		
-		# we want the tempo in microsec/beat - the set tempo events set the tempo as tt tt tt - 
-		# 24-bit binary representing microseconds (time) per beat 
-		# (instead of beat per time/BPM)
-
-		# this is getting the index of first note event in the midi to ignore all other BS
-		# and also the tempo hehe
-		event_name = track[first_note_index].name
-		while event_name is not midi.NoteOnEvent.name:
-			if event_name is midi.SetTempoEvent.name:
-				# indicating a tempo is set before the first note as initial tempo
-				# get the 24-bit binary as a string
-				tempo_binary = (format(track[first_note_index].data[0], '08b')+
-								format(track[first_note_index].data[1], '08b')+
-								format(track[first_note_index].data[2], '08b'))
-				
-				# convert the index string to microsec/beat
-				tempo = int(tempo_binary, 2)
-				
-			first_note_index += 1
-			event_name = track[first_note_index].name
-
- 		# this the tempo for the first note of the midi
-		self.tempo = tempo if tempo is not None else 500000
+		'''gets all the metadata here from the parsed midi'''
+		# this the tempo for the first note of the midi
+		self.tempo = self.midi.first_tempo if self.midi.first_tempo is not None else DEFAULT_TEMPO
 
 		# this is the PPQ (pulses per quarter note, aka ticks per beat). Constant.
 		self.PPQN = self.midi.resolution
 
 		# this is the index in the track for the first note of midi
-		self.first_note_index = first_note_index
+		self.first_note_index = self.midi.first_note_index
 
-		
-		
-	def enq_embeddings(self, delta_ticks, note_state):
-		'''takes in the notes to be upsampled as a state array and the time to be upsampled for 
-		and then upsamples the notes according to the wav sampling rate, makes embeddings and adds them  
-		to the tf queue''' 
-		upsample_time = self.tick_delta_to_microseconds(delta_ticks)
-
-		# TODO: figure out if batching all  inserts from the loops into a giant block
-		# of inserts will be more efficient if used with enqueue_many
-		num_embeddings = upsample_time * self.sample_rate / 1000000
-
-		for i in range(num_embeddings - 1):
-			# an empty embedding which is the intialzation for each elemnt of the mapper queue
-			# we cannot use a single empty variable and assign 1s to it as all array variables are handles and not literals
-			embedding = np.zeros(shape = (self.lc_channels), dtype = np.float32)
-
-			# single line for loop that encodes the embedding according the state vector of the notes
-			for j in range(len(note_state)):
-				embedding[note_state[j - 1]] = 1
-			
-			# embeddign made, now enqueue
-			self.mapper_lc_q.put(embedding)
+
+	def note_intervals(self):
+		'''converts the note intervals of the parsed midi into (start_sample, end_sample, note)
+			intervals at the wav sampling rate, sorted by start.
+			Returns three int arrays and the length of the midi in samples'''
+		keep = self.midi.notes < self.lc_channels
+
+		def to_samples(ticks):
+			microseconds = self.midi.ticks_to_microseconds(ticks)
+			return np.round(microseconds * self.sample_rate / 1e6).astype(np.int64)
+
+		starts = to_samples(self.midi.start_ticks[keep])
+		ends = to_samples(self.midi.end_ticks[keep])
+
+		# no interval starting before start_sample - max_duration can reach start_sample
+		self.max_duration = int(np.max(ends - starts)) if len(starts) else 0
+
+		return (starts,
+				ends,
+				self.midi.notes[keep],
+				int(round(self.midi.length_microseconds * self.sample_rate / 1e6)))
 
 	
-	def upsample(self, start_sample = 0, end_sample = None):
-		
-		# stores the current state of the midi: ie. which notes are on 
-		note_state = []
+	def clip_intervals(self, start_sample, end_sample):
+		'''returns the notes sounding in the samples [start_sample, end_sample) as an
+			int32 (notes, 3) array of (start_row, end_row, note), where row 0 is start_sample.
+			Samples before the midi starts or after it ends have no notes'''
+		starts, ends, notes, _ = self.intervals
 
-		# input midi is the midi pattern, the output of read_midifile. Assume its format and get the first track of the midi
-		# This track is a list of events occurring in the midi
-		midi_track = self.midi[0]
-		
-		# First get the start and end times of the midi section to be extracted and upsampled
-		current_time = self.sample_to_microseconds(np.maximum(0,start_sample))
+		# the intervals are sorted by start, so only a slice of them can overlap the range
+		first = np.searchsorted(starts, start_sample - self.max_duration, side = 'left')
+		last = np.searchsorted(starts, end_sample, side = 'left')
+		starts, ends, notes = starts[first:last], ends[first:last], notes[first:last]
 
-		if end_sample is None:
-			end_time = float('inf')
-		else:
-			end_time = self.sample_to_microseconds(end_sample)
-		# print("Ending time for upsample is {}".format(end_time))
+		row_starts = np.maximum(starts, start_sample) - start_sample
+		row_ends = np.minimum(ends, end_sample) - start_sample
+		keep = row_starts < row_ends
 
-		counter = self.first_note_index
-		# print("First note index is {}".format(counter))
-		
-		while current_time < end_time:
-			# first get the current midi event
-			curr_event = midi_track[counter]
-			# print("Counter : {}".format(counter))
-			# print("Current event = {}".format(curr_event.name))
-			# extract the time tick deltas and the event types form the midi
-			delta_ticks = curr_event.tick
-			event_name  = curr_event.name
-			event_data  = curr_event.data
-			
-			if   event_name is midi.NoteOnEvent.name  and delta_ticks == 0:
-				note_state.append(event_data[0])
-				
-			elif event_name is midi.NoteOnEvent.name  and delta_ticks != 0:
-				self.enq_embeddings(delta_ticks, note_state)
-				note_state.append(event_data[0])
-				
-			elif event_name is midi.NoteOffEvent.name and delta_ticks == 0:
-				if event_data[0] in note_state:
-					note_state.remove(event_data[0])
-				
-			elif event_name is midi.NoteOffEvent.name and delta_ticks != 0:
-				self.enq_embeddings(delta_ticks, note_state)
-				if event_data[0] in note_state:
-					note_state.remove(event_data[0])
-				
-			elif event_name is midi.EndOfTrackEvent.name:
-				# warn if gap between midi and wav, then update time
-				# the embedding is already zero-padded, so no need to pad it
-				# get the bpm and find how many seconds for one beat and then half that
-				if (end_time - current_time) > (self.PPQN / 2):
-					# the MIDI ended, but the .wav sample hasn't reached its end
-					# print("The given .wav file is longer than the matching MIDI file. Please check that the MIDI and .wav line up correctly.")
-					break # to break outer while loop
-				else:
-					break # if not already, to break outer while loop
+		return np.stack([row_starts[keep], row_ends[keep], notes[keep]], axis = 1).astype(np.int32)
 
-			elif event_name is midi.SetTempoEvent.name and delta_ticks == 0:
-				# mid-song tempo change
-				# tempo is represented in microseconds per beat as tt tt tt - 24-bit (3-byte) hex
-				# convert first to binary string and then to a decimal number (microsec/beat)
-				tempo_binary = (format(curr_event.data[0], '08b')+
-								format(curr_event.data[1], '08b')+
-								format(curr_event.data[2], '08b'))
-				self.tempo = int(tempo_binary, 2)
-				
-			elif event_name is midi.SetTempoEvent.name and delta_ticks != 0:
-				self.enq_embeddings(delta_ticks, note_state)
-				tempo_binary = (format(curr_event.data[0], '08b')+
-								format(curr_event.data[1], '08b')+
-								format(curr_event.data[2], '08b'))
-				self.tempo = int(tempo_binary, 2)
-				
-				
-			else:
-				# We are ignoring events other than note on/off or tempo. Do nothing with these events.
-				print("Unrecognised MIDI event {}".format(event_name))
-				
 
-			# increment
-			current_time += self.tick_delta_to_microseconds(delta_ticks)
-			if (current_time < end_time):
-				counter += 1
-			# print("Current time is {}".format(current_time))
+	def upsample(self, start_sample = 0, end_sample = None, dtype = np.float32):
+		'''builds the piano roll of the midi for the samples [start_sample, end_sample)
+			as a (samples, lc_channels) matrix of dtype. A negative start_sample
+			prepends that many rows of zeros, and no end_sample runs to the end of the midi.
+			The work done is proportional to the number of notes, not samples'''
+		if end_sample is None:
+			end_sample = self.intervals[3]
 
+		num_rows = max(0, end_sample - start_sample)
+		embedding_vector = np.zeros(shape = (num_rows, self.lc_channels), dtype = dtype)
 
-		# save current midi track pointer in case the song is cunked up
-		self.first_note_index = counter
-		
-		# current_time = end_time, but the MIDI isn't at the end of the track yet
-		#if midi_track[counter].name is not "End of Track":
-		#	print("The given MIDI file is longer than the matching .wav file. Please check that the MIDI and .wav line up correctly.")
-			# then continue like it isn't our fault
+		# fill in every interval with one slice
+		for start, end, note in self.clip_intervals(start_sample, end_sample):
+			embedding_vector[start:end, note] = 1
 
-	
-		# now return all indicidual embeddings as one list
-		
-		num_embeddings = self.mapper_lc_q.qsize()
-		embedding_vector = np.zeros(shape = (self.mapper_lc_q.qsize(), self.lc_channels), dtype = np.float32)
-
-		for i in range(num_embeddings - 1):
-			embedding_vector[i] = self.mapper_lc_q.get()
-
-		# pack all individual embeddings along the 0th dimention into one tensor
-		# this is a colum vector of row vectors
-		# colum is num_embeddings rows tall
-		# each row in this column self.lc_channels float32s wide
-		if start_sample < 0:
-			padding = np.zeros(shape = (np.abs(start_sample), self.lc_channels), dtype = np.float32)
-			embedding_vector = np.concatenate((padding, embedding_vector), axis = 0)
-		 
 		return embedding_vector
+
+
+	def window(self, start_sample, end_sample):
+		'''builds only the piano roll rows [start_sample, end_sample), e.g. one training
+			chunk, so memory is bounded by the window and not the length of the midi.
+			Rows outside of the midi are zero'''
+		return self.upsample(start_sample, end_sample)
+
+
+class CachedPianoRoll():
+	'''Serves a piano roll loaded from the dataset cache through the same
+	upsample and clip_intervals calls as a MidiMapper'''
+
+	def __init__(self, roll):
+		# (samples, lc_channels) array, usually memory mapped
+		self.roll = roll
+
+
+	def upsample(self, start_sample = 0, end_sample = None):
+		'''returns rows [start_sample, end_sample) of the piano roll as float32,
+			with zero rows for samples outside of it'''
+		if end_sample is None:
+			end_sample = len(self.roll)
+		return read_rows(self.roll, start_sample, end_sample)
+
+
+	def window(self, start_sample, end_sample):
+		'''rows [start_sample, end_sample) of the piano roll, like MidiMapper.window.
+			Only these rows of the memory map are read'''
+		return self.upsample(start_sample, end_sample)
+
+
+	def clip_intervals(self, start_sample, end_sample):
+		'''returns the notes of rows [start_sample, end_sample) as (start_row, end_row, note)
+			intervals, like MidiMapper.clip_intervals'''
+		rows = self.upsample(start_sample, end_sample) > 0
+
+		# +1 where a note turns on and -1 where it turns off
+		changes = np.diff(np.pad(rows.astype(np.int8), [[1, 1], [0, 0]], 'constant'), axis = 0)
+		on_rows, on_notes = np.nonzero(changes == 1)
+		off_rows, off_notes = np.nonzero(changes == -1)
+
+		# ordering both by note and then time pairs every on with its off
+		on_order = np.lexsort((on_rows, on_notes))
+		off_order = np.lexsort((off_rows, off_notes))
+
+		return np.stack([on_rows[on_order], off_rows[off_order], on_notes[on_order]], axis = 1).astype(np.int32)
@@ -0,0 +1,257 @@
+import os
+import librosa
+import numpy as np
+import tensorflow as tf
+
+from .lc_audio_reader import (find_files, clean_midi_files, silence_bounds, build_cache, wait_for_cache,
+							  load_midi, MidiMapper, CachedPianoRoll, ReaderTimings, timestamp)
+
+# number of batches the pipeline prepares ahead of the training step
+PREFETCH_BATCHES = 2
+
+
+class LCDatasetReader():
+	'''Drop in replacement for LCAudioReader built on the tf.data API.
+
+	Files are decoded by parallel map calls, cut into receptive_field + sample_size
+	windows in-graph, shuffled and prefetched, so no Python thread has to feed
+	the chunks through the Session one at a time. The audio, GC and LC of a batch
+	come from the same dataset element, so they always line up.'''
+
+	def __init__(self,
+				data_dir,
+				coord,
+				receptive_field,
+				gc_enabled = False,
+				lc_enabled = False,
+				lc_channels = None,
+				lc_fileformat = None,
+				sample_rate = 16000,
+				sample_size = None,
+				silence_threshold = None,
+				q_size = 32,
+				sess = None,
+				cache_dir = None,
+				num_parallel_calls = 4,
+				length_buckets = None,
+				shard_index = 0,
+				num_shards = 1,
+				update_cache = True):
+		# Input member vars initialiations
+		self.data_dir = data_dir
+		self.coord = coord
+		self.sample_rate = sample_rate
+		self.gc_enabled = gc_enabled
+		self.lc_enabled = lc_enabled
+		self.lc_channels = lc_channels
+		self.lc_fileformat = lc_fileformat
+		self.receptive_field = receptive_field
+		self.sample_size = sample_size
+		self.silence_threshold = silence_threshold
+		self.q_size = q_size
+		self.sess = sess
+		self.cache_dir = cache_dir
+		self.num_parallel_calls = num_parallel_calls
+		self.length_buckets = sorted(length_buckets) if length_buckets else None
+		self.shard_index = shard_index
+		self.num_shards = num_shards
+		self.update_cache = update_cache
+
+		# Non-input member vars initialization
+		self.threads = []
+		self.batch_size = None
+		self.batch = None
+		self.iterator = None
+		self.stats = None
+
+		# decoding times of the map calls, see ReaderTimings
+		self.timings = ReaderTimings()
+
+		# now load in the files and see if they exist
+		audio_files = find_files(self.data_dir, '*.wav')
+		if not audio_files:
+			raise ValueError("No WAV files found in '{}'.".format(self.data_dir))
+
+		# if LC is enabled, check if local conditioning files exist
+		if self.lc_enabled:
+			lc_files = find_files(self.data_dir, self.lc_fileformat)
+			if not lc_files:
+				raise ValueError("No MIDI files found in '{}'".format(self.data_dir))
+			audio_files, _ = clean_midi_files(audio_files, lc_files)
+
+		# in distributed training every worker only reads its own shard of the dataset
+		# readers that share the cache with one that updates it only wait for it
+		if self.cache_dir is not None:
+			load_cache = build_cache if self.update_cache else wait_for_cache
+			self.cache_entries = load_cache(self.data_dir, self.cache_dir, self.sample_rate,
+											self.lc_enabled, self.lc_channels, self.lc_fileformat,
+											self.silence_threshold)[self.shard_index::self.num_shards]
+			self.num_files = len(self.cache_entries)
+		else:
+			self.audio_files = sorted(audio_files)[self.shard_index::self.num_shards]
+			self.num_files = len(self.audio_files)
+
+		if not self.num_files:
+			raise ValueError("Shard {} of {} has no files.".format(self.shard_index, self.num_shards))
+
+
+	def get_gc_cardinality(self):
+		'''ADAPT:
+			this is where we return the total number of unique GC embeddings
+			for now, we do not have any particular scheme for GC'''
+		return None
+
+
+	def dq_audio(self, num_elements):
+		'''Returns a batch of audio samples. Each element is an entire sample batch'''
+		return self.next_batch(num_elements)['audio']
+
+
+	def dq_gc(self, num_elements):
+		'''Returns the GC ids of the batch returned by dq_audio'''
+		return self.next_batch(num_elements)['gc']
+
+
+	def dq_lc(self, num_elements):
+		'''Returns the LC embeddings of the batch returned by dq_audio'''
+		return self.next_batch(num_elements)['lc']
+
+
+	def dq_length(self, num_elements):
+		'''Returns the unpadded lengths of the batch returned by dq_audio'''
+		return self.next_batch(num_elements)['length']
+
+
+	def next_batch(self, num_elements):
+		'''Builds the pipeline on first use and returns its batch tensors.
+			The seconds get_next waited go into self.stats and the summaries'''
+		if self.batch is None:
+			self.batch_size = num_elements
+			self.iterator = self.create_dataset(num_elements).make_initializable_iterator()
+			with tf.name_scope('reader'):
+				start = timestamp()
+				with tf.control_dependencies([start]):
+					self.batch = self.iterator.get_next()
+				with tf.control_dependencies(list(self.batch.values())):
+					dequeue_wait = timestamp() - start
+				self.stats = {'dequeue_wait' : dequeue_wait}
+				tf.summary.scalar('dequeue_wait', dequeue_wait)
+		elif num_elements != self.batch_size:
+			raise ValueError("All dequeues of a LCDatasetReader must use the same batch size, "
+							 "got {} and {}.".format(self.batch_size, num_elements))
+		return self.batch
+
+
+	def create_dataset(self, num_elements):
+		'''file indices -> decoded files -> windows -> shuffled, padded batches'''
+		dataset = tf.data.Dataset.from_tensor_slices(tf.range(self.num_files))
+		dataset = dataset.shuffle(self.num_files).repeat()
+		dataset = dataset.map(self.load_example, num_parallel_calls = self.num_parallel_calls)
+
+		# files that were trimmed away entirely are only padding
+		dataset = dataset.filter(lambda example: tf.shape(example['audio'])[0] > self.receptive_field)
+
+		# CHOP UP AUDIO
+		if self.sample_size:
+			dataset = dataset.flat_map(self.chunk_example)
+
+		padded_shapes = {'audio' : [None, 1], 'length' : []}
+		if self.gc_enabled:
+			padded_shapes['gc'] = [1]
+		if self.lc_enabled:
+			padded_shapes['lc'] = [None, self.lc_channels]
+
+		dataset = dataset.shuffle(self.q_size)
+		if self.length_buckets is None:
+			dataset = dataset.padded_batch(num_elements, padded_shapes = padded_shapes)
+		else:
+			# batches only hold windows of one length bucket, so they are only padded
+			# to the longest window of that bucket
+			boundaries = tf.constant(self.length_buckets, dtype = tf.int32)
+
+			def bucket_of(example):
+				return tf.reduce_sum(tf.cast(boundaries < example['length'], tf.int64))
+
+			def batch_bucket(bucket, windows):
+				return windows.padded_batch(num_elements, padded_shapes = padded_shapes)
+
+			dataset = dataset.apply(tf.contrib.data.group_by_window(bucket_of, batch_bucket,
+																	 window_size = num_elements))
+		return dataset.prefetch(PREFETCH_BATCHES)
+
+
+	def load_example(self, index):
+		'''decodes one file in a py_func and returns its tensors'''
+		dtypes = [tf.float32, tf.float32] if self.lc_enabled else [tf.float32]
+		outputs = tf.py_func(self.load_file, [index], dtypes)
+
+		example = {'audio' : outputs[0]}
+		example['audio'].set_shape([None, 1])
+		example['length'] = tf.shape(example['audio'])[0]
+
+		# ADAPT: This is where we get the GC ID mapping from audio
+		if self.gc_enabled:
+			example['gc'] = tf.zeros([1], dtype = tf.int32)
+
+		if self.lc_enabled:
+			example['lc'] = outputs[1]
+			example['lc'].set_shape([None, self.lc_channels])
+
+		return example
+
+
+	def load_file(self, index):
+		'''returns the receptive field padded audio of a file and its aligned piano roll'''
+		with self.timings.time('decode'):
+			return self.decode_file(index)
+
+
+	def decode_file(self, index):
+		# the midi sample of the first audio sample, the cache is already cut to match
+		trim_start = 0
+		if self.cache_dir is not None:
+			entry = self.cache_entries[index]
+			audio = np.load(os.path.join(self.cache_dir, entry['audio']), mmap_mode = 'r')
+			if self.lc_enabled:
+				lc_source = CachedPianoRoll(np.load(os.path.join(self.cache_dir, entry['lc']), mmap_mode = 'r'))
+		else:
+			filename = self.audio_files[index]
+			audio, _ = librosa.load(filename, sr = self.sample_rate, mono = True)
+			if self.silence_threshold is not None:
+				trim_start, trim_end = silence_bounds(audio, self.silence_threshold)
+				audio = audio[trim_start:trim_end]
+			audio = audio.reshape(-1, 1)
+			if self.lc_enabled:
+				lc_source = MidiMapper(sample_rate = self.sample_rate, lc_channels = self.lc_channels)
+				lc_source.set_midi(load_midi(os.path.splitext(filename)[0] + ".mid"))
+
+		audio = np.pad(audio, [[self.receptive_field, 0], [0, 0]], 'constant').astype(np.float32)
+		if not self.lc_enabled:
+			return [audio]
+
+		# the rows for the padding before the midi starts are zero
+		lc_embeddings = lc_source.upsample(start_sample = trim_start - self.receptive_field,
+										   end_sample = trim_start + len(audio) - self.receptive_field)
+		return [audio, lc_embeddings]
+
+
+	def chunk_example(self, example):
+		'''splits a file into receptive_field + sample_size windows that advance by sample_size'''
+		window = self.receptive_field + self.sample_size
+		offsets = tf.range(0, tf.shape(example['audio'])[0] - self.receptive_field, self.sample_size)
+
+		def piece(offset):
+			chunk = {key : value[offset:offset + window]
+					 for key, value in example.items() if key in ('audio', 'lc')}
+			if self.gc_enabled:
+				chunk['gc'] = example['gc']
+			chunk['length'] = tf.shape(chunk['audio'])[0]
+			return chunk
+
+		return tf.data.Dataset.from_tensor_slices(offsets).map(piece)
+
+
+	def start_threads(self, n_threads = 1):
+		'''Starts the pipeline. There are no feeder threads, the Session pulls the batches'''
+		self.sess.run(self.iterator.initializer)
+		return self.threads
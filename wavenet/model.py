@@ -1,7 +1,10 @@
+from contextlib import contextmanager
+
 import numpy as np
 import tensorflow as tf
 
-from .ops import causal_conv, mu_law_encode
+from .ops import (causal_conv, dilated_causal_conv, mu_law_encode, sample_categorical,
+				  average_gradients, unscale_gradients)
 
 
 def create_variable(name, shape):
@@ -28,6 +31,16 @@ def create_bias_variable(name, shape):
 	return tf.Variable(initializer(shape = shape), name)
 
 
+def cast_variables(variables, dtype):
+	'''Returns the nested dicts and lists of variables with every variable
+	cast to dtype.'''
+	if isinstance(variables, dict):
+		return {key : cast_variables(value, dtype) for key, value in variables.items()}
+	if isinstance(variables, list):
+		return [cast_variables(value, dtype) for value in variables]
+	return tf.cast(variables, dtype)
+
+
 class WaveNetModel(object):
 	'''Implements the WaveNet network for generative audio.
 
@@ -58,7 +71,11 @@ class WaveNetModel(object):
 				 gc_channels = None,
 				 gc_cardinality = None,
 				 initial_lc_channels = None,
-				 lc_channels = None):
+				 lc_channels = None,
+				 fused_conv = False,
+				 batched_lc = False,
+				 compute_dtype = tf.float32,
+				 gradient_checkpointing = False):
 		'''Initializes the WaveNet model.
 
 		Args:
@@ -102,6 +119,26 @@ class WaveNetModel(object):
 			# No cardinality - MIDI is already a vector. We are doing no 
 			#    transformation of the input as WaveNet does with GC cardinality's
 			#    embedding lookup.
+			fused_conv: Whether to compute the filter and gate of each dilated
+				layer with one atrous convolution over their concatenated
+				weights, instead of two time_to_batch based convolutions.
+				Uses the same variables, so checkpoints are interchangeable.
+				Default: False.
+			batched_lc: Whether to compute the LC filter and gate projections of
+				all dilated layers with one convolution over their concatenated
+				weights before the stack, instead of two convolutions of the
+				full LC batch per layer. Uses the same variables.
+				Default: False.
+			compute_dtype: Type of the convolutions and activations of the
+				training network, tf.float16 for mixed precision. The
+				variables stay float32 master weights and the softmax cross
+				entropy is computed in float32.
+				Default: tf.float32.
+			gradient_checkpointing: Whether to only keep the input of every
+				dilated layer for the backward pass and recompute the layer's
+				activations there. Saves the memory of all gate activations
+				at the cost of a second forward pass.
+				Default: False.
 
 		'''
 		self.batch_size = batch_size
@@ -120,6 +157,10 @@ class WaveNetModel(object):
 		# LOCAL CONDITION
 		self.initial_lc_channels = initial_lc_channels
 		self.lc_channels = lc_channels
+		self.fused_conv = fused_conv
+		self.batched_lc = batched_lc
+		self.compute_dtype = compute_dtype
+		self.gradient_checkpointing = gradient_checkpointing
 
 		self.receptive_field = WaveNetModel.calculate_receptive_field(self.filter_width,
 																	  self.dilations,
@@ -302,7 +343,8 @@ class WaveNetModel(object):
 							   dilation,
 							   gc_batch,
 							   output_width, 
-							   lc_batch = None):
+							   lc_batch = None,
+							   lc_projection = None):
 		# Need to determine how to input the lc_batch.
 		'''Creates a single causal dilated convolution layer.
 
@@ -315,6 +357,10 @@ class WaveNetModel(object):
 				 [batch size, 1, channels]. The 1 is for the axis
 				 corresponding to time so that the result is broadcast to
 				 all time steps.
+			 lc_batch: Output of the LC causal layer, or None.
+			 lc_projection: The [lc filter | lc gate] projection of lc_batch for
+				 this layer, computed by _create_lc_projections. Replaces the
+				 per-layer LC convolutions if given.
 
 		The layer contains a gated filter that connects to dense output
 		and to a skip connection:
@@ -336,8 +382,14 @@ class WaveNetModel(object):
 		weights_filter = variables['filter']
 		weights_gate = variables['gate']
 
-		conv_filter = causal_conv(input_batch, weights_filter, dilation)
-		conv_gate = causal_conv(input_batch, weights_gate, dilation)
+		if self.fused_conv:
+			# One convolution producing [filter | gate] channels
+			weights_fused = tf.concat([weights_filter, weights_gate], axis = 2)
+			conv_fused = dilated_causal_conv(input_batch, weights_fused, dilation)
+			conv_filter, conv_gate = tf.split(conv_fused, 2, axis = 2)
+		else:
+			conv_filter = causal_conv(input_batch, weights_filter, dilation)
+			conv_gate = causal_conv(input_batch, weights_gate, dilation)
 
 		if gc_batch is not None:
 			weights_gc_filter = variables['gc_filtweights']
@@ -360,7 +412,10 @@ class WaveNetModel(object):
 		# We also need to know how this param must be adjusted to accommodate a time series:
 		# y(t), convolved with lc_filter, will change at every step.
 		
-		if lc_batch is not None:
+		if lc_projection is not None:
+			conv_filter_lc, conv_gate_lc = tf.split(lc_projection, 2, axis = 2)
+
+		elif lc_batch is not None:
 			
 			
 			weights_lc_filter = variables['lc_filtweights']
@@ -369,6 +424,7 @@ class WaveNetModel(object):
 			weights_lc_gate = variables['lc_gateweights']
 			conv_gate_lc = causal_conv(lc_batch, weights_lc_gate, 1)
 			
+		if lc_batch is not None:
 
 			# This is Cutting the starting of the lc_batch to match the length of the input_batch
 			# Shortening the lc_batch
@@ -426,6 +482,59 @@ class WaveNetModel(object):
 
 		return skip_contribution, input_batch + transformed
 
+	def _create_checkpointed_layer(self,
+								   input_batch,
+								   layer_index,
+								   dilation,
+								   gc_batch,
+								   output_width,
+								   lc_batch = None,
+								   lc_projection = None):
+		'''Same as _create_dilation_layer, but the backward pass recomputes
+		the layer from its inputs instead of keeping its activations.
+
+		The weights of the layer are passed to the custom gradient as inputs
+		along with the tensors, so their gradients are returned explicitly.
+		'''
+		stack = self.variables['dilated_stack']
+		names = sorted(stack[layer_index])
+		tensors = [input_batch, gc_batch, lc_batch, lc_projection]
+		present = [index for index, tensor in enumerate(tensors) if tensor is not None]
+
+		def create_layer(args):
+			layer_tensors = [None] * len(tensors)
+			for index, tensor in zip(present, args):
+				layer_tensors[index] = tensor
+			layer_variables = dict(zip(names, args[len(present):]))
+
+			# build the layer on the given weights instead of those in self.variables
+			variables = self.variables
+			self.variables = dict(variables)
+			self.variables['dilated_stack'] = list(stack)
+			self.variables['dilated_stack'][layer_index] = layer_variables
+			try:
+				return self._create_dilation_layer(layer_tensors[0], layer_index, dilation,
+												   layer_tensors[1], output_width,
+												   layer_tensors[2], layer_tensors[3])
+			finally:
+				self.variables = variables
+
+		@tf.custom_gradient
+		def checkpointed_layer(*args):
+			outputs = create_layer(args)
+
+			def grad(*grad_outputs):
+				# recompute on copies that only exist once the output gradients do
+				with tf.control_dependencies(grad_outputs):
+					copies = [tf.identity(arg) for arg in args]
+				recomputed = create_layer(copies)
+				return tf.gradients(list(recomputed), copies, grad_ys = list(grad_outputs))
+
+			return outputs, grad
+
+		return checkpointed_layer(*([tensors[index] for index in present] +
+									[stack[layer_index][name] for name in names]))
+
 	def _generator_conv(self, input_batch, state_batch, weights):
 		'''Perform convolution for a single convolutional processing step.'''
 		# TODO generalize to filter_width > 2
@@ -467,7 +576,7 @@ class WaveNetModel(object):
 			input_batch, state_batch, weights_gate)
 
 		if gc_batch is not None:
-			gc_batch = tf.reshape(gc_batch, shape = (1, -1))
+			gc_batch = tf.reshape(gc_batch, shape = (self.batch_size, -1))
 			weights_gc_filter = variables['gc_filtweights']
 			weights_gc_filter = weights_gc_filter[0, :, :]
 			output_filter += tf.matmul(gc_batch,
@@ -508,6 +617,36 @@ class WaveNetModel(object):
 
 		return skip_contribution, input_batch + transformed
 
+	def _create_lc_projections(self, lc_batch):
+		'''Computes the LC filter and gate inputs of every dilated layer at once.
+
+		The LC batch is the same for all layers, so their [lc filter | lc gate]
+		weights are concatenated along the output channels and applied in a
+		single convolution. Returns one [batch, time, 2 * dilation_channels]
+		slice per layer.
+		'''
+		with tf.name_scope('lc_projections'):
+			stack = self.variables['dilated_stack']
+			weights = tf.concat([tf.concat([variables['lc_filtweights'], variables['lc_gateweights']], axis = 2)
+								 for variables in stack], axis = 2)
+			projections = causal_conv(lc_batch, weights, 1)
+			return tf.split(projections, len(stack), axis = 2)
+
+	@contextmanager
+	def _compute_variables(self):
+		'''Makes self.variables hold compute_dtype casts of the master weights
+		while a network is built.'''
+		if self.compute_dtype == tf.float32:
+			yield
+			return
+
+		master_variables = self.variables
+		self.variables = cast_variables(master_variables, self.compute_dtype)
+		try:
+			yield
+		finally:
+			self.variables = master_variables
+
 	def _create_network(self, input_batch, gc_batch, lc_batch):
 		
 #		input_batch = input_batch + lc_batch
@@ -521,19 +660,28 @@ class WaveNetModel(object):
 		else:
 			lc_batch_causaled = None
 
+		if lc_batch_causaled is not None and self.batched_lc:
+			lc_projections = self._create_lc_projections(lc_batch_causaled)
+		else:
+			lc_projections = [None] * len(self.dilations)
+
 		output_width = tf.shape(input_batch)[1] - self.receptive_field + 1
 
 		# Add all defined dilation layers.if lc_batch is not None:
 		
+		create_layer = (self._create_checkpointed_layer if self.gradient_checkpointing
+						else self._create_dilation_layer)
+
 		with tf.name_scope('dilated_stack'):
 			for layer_index, dilation in enumerate(self.dilations):
 				with tf.name_scope('layer{}'.format(layer_index)):
-					output, current_layer = self._create_dilation_layer(
+					output, current_layer = create_layer(
 						current_layer,
 						layer_index,
 						dilation,
 						gc_batch, output_width,
-						lc_batch_causaled)
+						lc_batch_causaled,
+						lc_projections[layer_index])
 					outputs.append(output)
 
 		with tf.name_scope('postprocessing'):
@@ -573,6 +721,8 @@ class WaveNetModel(object):
 		init_ops = []
 		push_ops = []
 		outputs = []
+		# every state queue, in the order _create_priming_ops computes their contents
+		state_queues = []
 
 		q_audio = tf.FIFOQueue(
 			1,
@@ -585,10 +735,13 @@ class WaveNetModel(object):
 		push_audio = q_audio.enqueue([input_batch])
 		init_ops.append(init_audio)
 		push_ops.append(push_audio)
+		state_queues.append(q_audio)
 
 		current_layer = self._generator_causal_layer(
 							input_batch, current_state)
 
+		lc_current_layer = None
+		current_lc_state = None
 		if lc_batch is not None:
 			q_lc = tf.FIFOQueue(
 				1,
@@ -602,9 +755,28 @@ class WaveNetModel(object):
 			push_lc = q_lc.enqueue([lc_batch])
 			init_ops.append(init_lc)
 			push_ops.append(push_lc)
+			state_queues.append(q_lc)
 
 			lc_current_layer = self._generator_causal_layer_lc(lc_batch, current_lc_state)
 
+			# The LC signal is the same for every layer, so instead of a queue per layer
+			# a single queue holds the state all layers share. The dilated layers
+			# convolve LC with dilation 1 in _create_dilation_layer, so that state is
+			# the LC layer output of the previous step regardless of the layer's dilation.
+			q_lc = tf.FIFOQueue(
+				1,
+				dtypes = tf.float32,
+				shapes = (self.batch_size, self.lc_channels))
+
+			init_lc = q_lc.enqueue_many(
+				tf.zeros((1, self.batch_size, self.lc_channels)))
+
+			current_lc_state = q_lc.dequeue()
+			push_lc = q_lc.enqueue([lc_current_layer])
+			init_ops.append(init_lc)
+			push_ops.append(push_lc)
+			state_queues.append(q_lc)
+
 		# Add all defined dilation layers.
 		with tf.name_scope('dilated_stack'):
 			for layer_index, dilation in enumerate(self.dilations):
@@ -622,27 +794,7 @@ class WaveNetModel(object):
 					push_audio = q_audio.enqueue([current_layer])
 					init_ops.append(init_audio)
 					push_ops.append(push_audio)
-
-
-					gc_batch = None
-
-					# if lc is enabled, set up the queues for lc
-					# TODO: this can be made more efficent as the lc convolution does not change as it goes through the layers
-					# ideally we would not need a queue at every layer for lc for this reason
-					# this is only a hack for now
-					if lc_batch is not None:
-						q_lc = tf.FIFOQueue(
-							dilation,
-							dtypes = tf.float32,
-							shapes = (self.batch_size, self.lc_channels))
-
-						init_lc = q_lc.enqueue_many(
-							tf.zeros((dilation, self.batch_size, self.lc_channels)))
-
-						current_lc_state = q_lc.dequeue()
-						push_lc = q_lc.enqueue([lc_current_layer])
-						init_ops.append(init_lc)
-						push_ops.append(push_lc)
+					state_queues.append(q_audio)
 
 					# now perform the convlution at the layer
 					output, current_layer = self._generator_dilation_layer(
@@ -652,7 +804,12 @@ class WaveNetModel(object):
 					outputs.append(output)
 		self.init_ops = init_ops
 		self.push_ops = push_ops
+		self.state_queues = state_queues
+
+		return self._generator_postprocess(outputs)
 
+	def _generator_postprocess(self, outputs):
+		'''Postprocesses the skip outputs of one incremental generation step.'''
 		with tf.name_scope('postprocessing'):
 			variables = self.variables['postprocessing']
 			# Perform (+) -> ReLU -> 1x1 conv -> ReLU -> 1x1 conv to
@@ -678,6 +835,57 @@ class WaveNetModel(object):
 
 		return conv2
 
+	def _create_priming_ops(self, encoded_audio, gc_batch, lc_batch):
+		'''Sets the generator state queues to what pushing every priming sample
+		one by one would leave in them, in a single graph execution.
+
+		The priming window runs through the parallel network, where each layer
+		input is left padded with the zeros the queues are initialized with, and
+		the last entries of every layer input are written to its queue.
+
+		Args:
+			encoded_audio: One hot priming samples, [batch, width, channels].
+			gc_batch: GC embedding of the generator, or None.
+			lc_batch: Priming LC frames, [batch, width, initial_lc_channels],
+				or None.
+		'''
+		states = []
+		# the audio queue holds the previous input sample
+		states.append(encoded_audio[:, -1:, :])
+		current_layer = self._create_causal_layer(
+			tf.pad(encoded_audio, [[0, 0], [1, 0], [0, 0]]))
+		width = tf.shape(current_layer)[1]
+
+		lc_current_layer = None
+		if lc_batch is not None:
+			# the LC queues hold the previous LC frame and LC layer output
+			states.append(lc_batch[:, -1:, :])
+			lc_causaled = self._create_causal_layer_lc(
+				tf.pad(lc_batch, [[0, 0], [1, 0], [0, 0]]))
+			states.append(lc_causaled[:, -1:, :])
+			lc_current_layer = tf.pad(lc_causaled, [[0, 0], [1, 0], [0, 0]])
+
+		if gc_batch is not None:
+			gc_batch = tf.reshape(gc_batch, [self.batch_size, 1, -1])
+
+		with tf.name_scope('dilated_stack'):
+			for layer_index, dilation in enumerate(self.dilations):
+				with tf.name_scope('layer{}'.format(layer_index)):
+					# each layer queue holds its last dilation inputs
+					padded_layer = tf.pad(current_layer, [[0, 0], [dilation, 0], [0, 0]])
+					states.append(padded_layer[:, -dilation:, :])
+					_, current_layer = self._create_dilation_layer(
+						padded_layer, layer_index, dilation,
+						gc_batch, width, lc_current_layer)
+
+		prime_ops = []
+		for q, state in zip(self.state_queues, states):
+			# drop whatever the queue holds, then fill it oldest first
+			clear = q.dequeue_many(q.size())
+			with tf.control_dependencies([clear]):
+				prime_ops.append(q.enqueue_many(tf.transpose(state, [1, 0, 2])))
+		return prime_ops
+
 	def _one_hot(self, input_batch):
 		'''One-hot encodes the waveform amplitudes.
 
@@ -744,7 +952,7 @@ class WaveNetModel(object):
 				encoded = self._one_hot(waveform)
 
 			gc_embedding = self._embed_gc(global_condition)
-			raw_output = self._create_network(encoded, gc_embedding)
+			raw_output = self._create_network(encoded, gc_embedding, local_condition)
 			out = tf.reshape(raw_output, [-1, self.quantization_channels])
 
 			# Cast to float64 to avoid bug in TensorFlow
@@ -757,33 +965,32 @@ class WaveNetModel(object):
 			return tf.reshape(last, [-1])
 
 	def predict_proba_incremental(self, waveform, gc_batch = None,
-								  lc_embedding = None, name = 'wavenet'):
+								  lc_embedding = None, priming_waveform = None,
+								  priming_lc = None, name = 'wavenet'):
 		'''Computes the probability distribution of the next sample
 		incrementally, based on a single sample and all previously passed
-		samples.'''
-		if self.filter_width > 2:
-			raise NotImplementedError("Incremental generation does not "
-									  "support filter_width > 2.")
-		if self.scalar_input:
-			raise NotImplementedError("Incremental generation does not "
-									  "support scalar input yet.")
+		samples.
+
+		With batch_size > 1 each batch row is an independent stream: waveform
+		holds one sample per stream, gc_batch one GC id per stream and
+		lc_embedding one LC frame per stream, and the result has shape
+		[batch_size, quantization_channels].
+
+		If priming_waveform ([batch_size, width] samples) is given, prime_ops
+		is created as well. Running it replaces the generator state with the
+		state left by pushing all priming samples, and priming_lc
+		([batch_size, width, initial_lc_channels]) if LC is enabled, one at a
+		time, so it can be used instead of init_ops and a priming loop.'''
 		with tf.name_scope(name):
-			# mu law encode first
-			encoded_audio = tf.one_hot(waveform, self.quantization_channels)
-			encoded_audio = tf.reshape(encoded_audio, [-1, self.quantization_channels])
-
-			# gc table lookup
-			gc_embedding = self._embed_gc(gc_batch)
-
-			# create generator
-			raw_output = self._create_generator(encoded_audio, gc_embedding, lc_embedding)
-
-			# output
-			out = tf.reshape(raw_output, [-1, self.quantization_channels])
+			out = self._logits_incremental(waveform, gc_batch, lc_embedding,
+										   priming_waveform, priming_lc)
 
 			# cast to float64 to avoid TF back end bugs
 			proba = tf.cast(tf.nn.softmax(tf.cast(out, tf.float64)), tf.float32)
-			
+
+			if self.batch_size > 1:
+				return proba
+
 			# last sample in the window is the generation
 			last = tf.slice(
 				proba,
@@ -791,15 +998,161 @@ class WaveNetModel(object):
 				[1, self.quantization_channels])
 			return tf.reshape(last, [-1])
 
+	def _logits_incremental(self, waveform, gc_batch, lc_embedding,
+							priming_waveform, priming_lc):
+		'''Creates the incremental generator and its priming ops, and returns
+		the logits of the next sample of every stream, see
+		predict_proba_incremental.'''
+		if self.filter_width > 2:
+			raise NotImplementedError("Incremental generation does not "
+									  "support filter_width > 2.")
+		if self.scalar_input:
+			raise NotImplementedError("Incremental generation does not "
+									  "support scalar input yet.")
+		# mu law encode first
+		encoded_audio = tf.one_hot(waveform, self.quantization_channels)
+		encoded_audio = tf.reshape(encoded_audio, [-1, self.quantization_channels])
+
+		# gc table lookup
+		gc_embedding = self._embed_gc(gc_batch)
+
+		# create generator
+		raw_output = self._create_generator(encoded_audio, gc_embedding, lc_embedding)
+
+		if priming_waveform is not None:
+			if lc_embedding is not None and priming_lc is None:
+				raise ValueError("Priming a locally conditioned generator "
+								 "requires priming_lc.")
+			with tf.name_scope('priming'):
+				encoded_priming = tf.reshape(
+					tf.one_hot(priming_waveform, self.quantization_channels),
+					[self.batch_size, -1, self.quantization_channels])
+				if priming_lc is not None:
+					priming_lc = tf.reshape(
+						tf.cast(priming_lc, tf.float32),
+						[self.batch_size, -1, self.initial_lc_channels])
+				self.prime_ops = self._create_priming_ops(
+					encoded_priming, gc_embedding, priming_lc)
+
+		# output
+		return tf.reshape(raw_output, [-1, self.quantization_channels])
+
+	def sample_incremental(self, waveform, temperature = 1.0, top_k = None,
+						   top_p = None, gc_batch = None, lc_embedding = None,
+						   priming_waveform = None, priming_lc = None,
+						   name = 'wavenet'):
+		'''Same as predict_proba_incremental, but samples the next sample in
+		the graph and returns its int32 id per stream, shape [batch_size].
+
+		temperature can be a scalar or one value per stream. top_k and top_p
+		restrict sampling to the top_k most likely values or to the nucleus
+		of probability top_p, see ops.sample_categorical. Samples from the
+		logits, like generate_incremental.'''
+		with tf.name_scope(name):
+			logits = self._logits_incremental(waveform, gc_batch, lc_embedding,
+											  priming_waveform, priming_lc)
+			return sample_categorical(tf.reshape(logits, [self.batch_size, self.quantization_channels]),
+									  temperature, top_k, top_p)
+
+	def generate_incremental(self, waveform, num_samples, temperature = 1.0,
+							 top_k = None, top_p = None, gc_batch = None,
+							 lc_embeddings = None, name = 'wavenet'):
+		'''Generates num_samples samples per stream in one graph execution.
+
+		A tf.while_loop runs the incremental generator step, samples in the
+		graph (see sample_incremental) and feeds the sample back as the next
+		input. The generator state is loaded from the state queues of
+		predict_proba_incremental when the loop starts and written back when
+		it ends, so predict_proba_incremental or sample_incremental has to be
+		created first, and init_ops, prime_ops and consecutive blocks work as
+		with the single step generator.
+
+		Args:
+			waveform: The last sample of every stream, shape [batch_size].
+			num_samples: Number of samples to generate, may be a tensor.
+			temperature, top_k, top_p: See sample_incremental.
+			gc_batch: GC ids of the streams, as for sample_incremental.
+			lc_embeddings: LC frames of the block,
+				[batch_size, num_samples, initial_lc_channels].
+
+		Returns:
+			int32 tensor of shape [batch_size, num_samples]. Its last column
+			is the input of the next block.
+		'''
+		if self.filter_width > 2:
+			raise NotImplementedError("Incremental generation does not "
+									  "support filter_width > 2.")
+		lc_enabled = lc_embeddings is not None
+		# queue contents are [capacity, batch, channels], see _create_generator
+		capacities = [1] + ([1, 1] if lc_enabled else []) + list(self.dilations)
+		if len(capacities) != len(self.state_queues):
+			raise ValueError("generate_incremental must be called with the same "
+							 "conditioning as predict_proba_incremental.")
+
+		with tf.name_scope(name):
+			gc_embedding = self._embed_gc(gc_batch)
+			if lc_enabled:
+				lc_embeddings = tf.cast(lc_embeddings, tf.float32)
+
+			states = []
+			for q, capacity in zip(self.state_queues, capacities):
+				state = q.dequeue_many(capacity)
+				state.set_shape([capacity] + q.shapes[0].as_list())
+				states.append(state)
+
+			def step(index, sample, states, generated):
+				encoded = tf.one_hot(sample, self.quantization_channels)
+				new_states = [tf.expand_dims(encoded, 0)]
+				current_layer = self._generator_causal_layer(encoded, states[0][0])
+
+				lc_current_layer = None
+				lc_state = None
+				if lc_enabled:
+					lc_frame = lc_embeddings[:, index, :]
+					lc_current_layer = self._generator_causal_layer_lc(lc_frame, states[1][0])
+					lc_state = states[2][0]
+					new_states += [tf.expand_dims(lc_frame, 0), tf.expand_dims(lc_current_layer, 0)]
+
+				outputs = []
+				layer_states = states[len(new_states):]
+				with tf.name_scope('dilated_stack'):
+					for layer_index, dilation in enumerate(self.dilations):
+						with tf.name_scope('layer{}'.format(layer_index)):
+							state = layer_states[layer_index]
+							# the state is a FIFO of the layer inputs, oldest first
+							new_states.append(tf.concat([state[1:], tf.expand_dims(current_layer, 0)], axis = 0))
+							output, current_layer = self._generator_dilation_layer(
+								current_layer, state[0], layer_index, dilation,
+								gc_embedding, lc_current_layer, lc_state)
+							outputs.append(output)
+
+				logits = self._generator_postprocess(outputs)
+				sample = sample_categorical(logits, temperature, top_k, top_p)
+				return index + 1, sample, new_states, generated.write(index, sample)
+
+			_, _, states, generated = tf.while_loop(
+				lambda index, sample, states, generated: index < num_samples,
+				step,
+				[tf.constant(0), tf.reshape(tf.cast(waveform, tf.int32), [self.batch_size]),
+				 states, tf.TensorArray(tf.int32, size = num_samples)])
+
+			# write the state back for the next block
+			push_ops = [q.enqueue_many(state) for q, state in zip(self.state_queues, states)]
+			with tf.control_dependencies(push_ops):
+				return tf.transpose(generated.stack(), [1, 0])
+
 	def loss(self,
 			 input_batch,
 			 gc_batch = None,
 			 lc_encoded_batch = None,
 			 l2_regularization_strength = None,
+			 lengths = None,
 			 name = 'wavenet'):
 		'''Creates a WaveNet network and returns the autoencoding loss.
 
 		The variables are all scoped to the given name.
+		lengths holds the unpadded length of every example of a padded batch,
+		predictions of the padding after it are left out of the loss.
 		'''
 		with tf.name_scope(name):
 			# We mu-law encode and quantize the input audioform.
@@ -828,8 +1181,16 @@ class WaveNetModel(object):
 				lc_encoded_batch = tf.slice(lc_encoded_batch, [0, 0, 0],
 											[-1, lc_batch_width, -1])
 
-						
-			raw_output = self._create_network(network_input, gc_embedding, lc_encoded_batch)
+			# in mixed precision the network runs in compute_dtype on casts of the weights
+			# and the logits go back to float32 for the softmax
+			with self._compute_variables():
+				network_input = tf.cast(network_input, self.compute_dtype)
+				if gc_embedding is not None:
+					gc_embedding = tf.cast(gc_embedding, self.compute_dtype)
+				if lc_encoded_batch is not None:
+					lc_encoded_batch = tf.cast(lc_encoded_batch, self.compute_dtype)
+				raw_output = self._create_network(network_input, gc_embedding, lc_encoded_batch)
+			raw_output = tf.cast(raw_output, tf.float32)
 
 			with tf.name_scope('loss'):
 				# Cut off the samples corresponding to the receptive field
@@ -845,8 +1206,18 @@ class WaveNetModel(object):
 				prediction = tf.reshape(raw_output, [-1, self.quantization_channels])
 
 				loss = tf.nn.softmax_cross_entropy_with_logits(logits = prediction, labels = target_output)
-				
-				reduced_loss = tf.reduce_mean(loss)
+
+				if lengths is None:
+					reduced_loss = tf.reduce_mean(loss)
+				else:
+					# the targets start after the receptive field, so an example of length n
+					# has n - receptive_field of them
+					num_targets = tf.shape(encoded)[1] - self.receptive_field
+					mask = tf.sequence_mask(tf.reshape(lengths, [-1]) - self.receptive_field,
+											maxlen = num_targets, dtype = tf.float32)
+					mask = tf.reshape(mask, [-1])
+					reduced_loss = (tf.reduce_sum(loss * mask) /
+									tf.maximum(tf.reduce_sum(mask), 1.0))
 
 				tf.summary.scalar('loss', reduced_loss)
 
@@ -865,3 +1236,47 @@ class WaveNetModel(object):
 					tf.summary.scalar('l2_loss', l2_loss)
 					
 					return total_loss
+
+	def tower_gradients(self,
+						optimizer,
+						devices,
+						input_batch,
+						gc_batch = None,
+						lc_encoded_batch = None,
+						l2_regularization_strength = None,
+						lengths = None,
+						var_list = None,
+						loss_scale = None,
+						name = 'wavenet'):
+		'''Splits a batch evenly between one replica of the network per device
+		and returns their mean loss and averaged gradients.
+
+		All replicas share self.variables, so applying the gradients is a
+		single optimizer update. self.batch_size is the batch size of one
+		replica, the batch holds len(devices) times as many examples.
+		With a loss_scale the gradients are taken of the scaled loss and
+		divided by it again, see unscale_gradients.
+		'''
+		num_towers = len(devices)
+		splits = [tf.split(batch, num_towers, axis = 0) if batch is not None else [None] * num_towers
+				  for batch in (input_batch, gc_batch, lc_encoded_batch, lengths)]
+
+		losses = []
+		tower_grads = []
+		for index, (device, audio, gc, lc, tower_lengths) in enumerate(zip(devices, *splits)):
+			with tf.device(device), tf.name_scope('tower_{}'.format(index)):
+				loss = self.loss(input_batch = audio,
+								 gc_batch = gc,
+								 lc_encoded_batch = lc,
+								 l2_regularization_strength = l2_regularization_strength,
+								 lengths = tower_lengths,
+								 name = name)
+				losses.append(loss)
+				scaled_loss = loss * loss_scale if loss_scale else loss
+				tower_grads.append(optimizer.compute_gradients(scaled_loss, var_list = var_list,
+															   colocate_gradients_with_ops = True))
+
+		grads_and_vars = average_gradients(tower_grads)
+		if loss_scale:
+			grads_and_vars = unscale_gradients(grads_and_vars, loss_scale)
+		return tf.add_n(losses) / num_towers, grads_and_vars
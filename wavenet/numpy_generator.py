@@ -0,0 +1,279 @@
+import numpy as np
+
+
+def _sigmoid(x):
+	# Written in terms of tanh so that large negative inputs do not overflow.
+	return 0.5 * (np.tanh(0.5 * x) + 1.0)
+
+
+def _softmax(logits):
+	# Computed in float64 to match the cast in predict_proba_incremental.
+	logits = logits.astype(np.float64)
+	logits -= np.max(logits, axis = 1, keepdims = True)
+	proba = np.exp(logits)
+	proba /= np.sum(proba, axis = 1, keepdims = True)
+	return proba.astype(np.float32)
+
+
+def sample_categorical_numpy(proba, temperature = 1.0, top_k = None, top_p = None):
+	'''Draws one sample per row of proba with the Gumbel-max trick. NumPy
+	version of ops.sample_categorical for the NumPy and naive generators.
+
+	Args:
+		proba: Distributions of shape [batch, channels].
+		temperature: Scalar or per row [batch] sampling temperature.
+		top_k: If given, only the top_k most likely channels are sampled.
+		top_p: If given, only the smallest set of most likely channels whose
+			probability adds up to top_p is sampled.
+
+	Returns:
+		int32 array of shape [batch].
+	'''
+	proba = np.atleast_2d(proba)
+	with np.errstate(divide = 'ignore'):
+		logits = np.log(proba)
+	logits = logits / np.reshape(temperature, [-1, 1])
+
+	if top_k is not None:
+		kth_largest = -np.partition(-logits, top_k - 1, axis = 1)[:, top_k - 1:top_k]
+		logits = np.where(logits < kth_largest, -np.inf, logits)
+
+	if top_p is not None:
+		sorted_logits = -np.sort(-logits, axis = 1)
+		sorted_proba = _softmax(sorted_logits)
+		cumulative = np.cumsum(sorted_proba, axis = 1) - sorted_proba
+		cutoff = np.min(np.where(cumulative < top_p, sorted_logits, np.inf),
+						axis = 1, keepdims = True)
+		logits = np.where(logits < cutoff, -np.inf, logits)
+
+	uniform = np.random.uniform(1e-20, 1.0, size = logits.shape)
+	return np.argmax(logits - np.log(-np.log(uniform)), axis = 1).astype(np.int32)
+
+
+class NumpyGenerator(object):
+	'''Runs WaveNet incremental generation in NumPy, outside of the TF graph.
+
+	This mirrors the queue based generator built by
+	WaveNetModel._create_generator, but keeps the per-layer state in circular
+	buffers and evaluates each dilated layer with one matmul for filter and
+	gate together, and one for the dense and skip outputs together. Without
+	the Session dispatch per sample this is much faster on CPU.
+
+	Usage:
+		net = WaveNetModel(...)
+		saver.restore(sess, checkpoint)
+		generator = NumpyGenerator.from_session(sess, net)
+		generator.reset()
+		proba = generator.step(sample)
+	'''
+
+	def __init__(self, net, weights, batch_size = None):
+		'''Initializes the generator.
+
+		Args:
+			net: The WaveNetModel whose hyperparameters are mirrored.
+			weights: Nested structure of NumPy arrays laid out exactly like
+				net.variables, e.g. the result of sess.run(net.variables).
+			batch_size: Number of independent streams generated per step.
+				Default: net.batch_size.
+		'''
+		if net.filter_width > 2:
+			raise NotImplementedError("Incremental generation does not "
+									  "support filter_width > 2.")
+		if net.scalar_input:
+			raise NotImplementedError("Incremental generation does not "
+									  "support scalar input yet.")
+
+		self.batch_size = batch_size if batch_size is not None else net.batch_size
+		self.dilations = list(net.dilations)
+		self.quantization_channels = net.quantization_channels
+		self.residual_channels = net.residual_channels
+		self.dilation_channels = net.dilation_channels
+		self.skip_channels = net.skip_channels
+		self.use_biases = net.use_biases
+		self.gc_channels = net.gc_channels
+		self.gc_cardinality = net.gc_cardinality
+		self.initial_lc_channels = net.initial_lc_channels
+		self.lc_channels = net.lc_channels
+		self.lc_enabled = net.lc_channels is not None
+
+		self._load_weights(weights)
+		self.reset()
+
+	@classmethod
+	def from_session(cls, sess, net, batch_size = None):
+		'''Creates a generator from the variable values held by a session,
+		typically right after restoring a checkpoint.'''
+		return cls(net, sess.run(net.variables), batch_size)
+
+	def _load_weights(self, weights):
+		'''Packs the per-layer weights into contiguous fused matrices.'''
+		def pack(value):
+			return np.ascontiguousarray(value, dtype = np.float32)
+
+		R = self.residual_channels
+		D = self.dilation_channels
+		S = self.skip_channels
+
+		causal = weights['causal_layer']
+		# One-hot input times a matrix is a row lookup.
+		self._audio_past = pack(causal['filter_audio'][0])
+		self._audio_curr = pack(causal['filter_audio'][1])
+
+		if self.lc_enabled:
+			self._lc_causal = pack(np.concatenate(
+				[causal['filter_lc'][0], causal['filter_lc'][1]], axis = 0))
+
+		if self.gc_cardinality is not None:
+			self._gc_embedding = pack(weights['embeddings']['gc_embedding'])
+
+		# Per layer the fused input is [state, current, lc_state, lc_current]
+		# and the fused output columns are [filter, gate].
+		self._w_in = []
+		self._b_in = []
+		self._w_gc = []
+		self._w_out = []
+		self._b_out = []
+		for layer in weights['dilated_stack']:
+			filter_rows = [layer['filter'][0], layer['filter'][1]]
+			gate_rows = [layer['gate'][0], layer['gate'][1]]
+			if self.lc_enabled:
+				filter_rows += [layer['lc_filtweights'][0], layer['lc_filtweights'][1]]
+				gate_rows += [layer['lc_gateweights'][0], layer['lc_gateweights'][1]]
+			self._w_in.append(pack(np.concatenate(
+				[np.concatenate(filter_rows, axis = 0),
+				 np.concatenate(gate_rows, axis = 0)], axis = 1)))
+
+			self._w_out.append(pack(np.concatenate(
+				[layer['dense'][0], layer['skip'][0]], axis = 1)))
+
+			if self.gc_channels is not None:
+				self._w_gc.append(pack(np.concatenate(
+					[layer['gc_filtweights'][0], layer['gc_gateweights'][0]],
+					axis = 1)))
+
+			if self.use_biases:
+				self._b_in.append(pack(np.concatenate(
+					[layer['filter_bias'], layer['gate_bias']])))
+				self._b_out.append(pack(np.concatenate(
+					[layer['dense_bias'], layer['skip_bias']])))
+			else:
+				self._b_in.append(np.zeros(2 * D, dtype = np.float32))
+				self._b_out.append(np.zeros(R + S, dtype = np.float32))
+
+		post = weights['postprocessing']
+		self._w_post1 = pack(post['postprocess1'][0])
+		self._w_post2 = pack(post['postprocess2'][0])
+		if self.use_biases:
+			self._b_post1 = pack(post['postprocess1_bias'])
+			self._b_post2 = pack(post['postprocess2_bias'])
+		else:
+			self._b_post1 = np.zeros(S, dtype = np.float32)
+			self._b_post2 = np.zeros(self.quantization_channels, dtype = np.float32)
+
+	def reset(self, global_condition = None):
+		'''Clears all generation state, which is the equivalent of running
+		net.init_ops.
+
+		Args:
+			global_condition: Per stream GC category ids of shape
+				[batch_size] if gc_cardinality is set, otherwise embeddings
+				of shape [batch_size, gc_channels]. Ignored if the model is
+				not globally conditioned.
+		'''
+		B = self.batch_size
+		R = self.residual_channels
+		L = self.lc_channels if self.lc_enabled else 0
+
+		# The first step sees an all-zero one-hot as its past input.
+		self._prev_samples = None
+		self._rings = [np.zeros((dilation, B, R), dtype = np.float32)
+					   for dilation in self.dilations]
+		self._pointers = [0] * len(self.dilations)
+		self._inputs = [np.zeros((B, 2 * R + 2 * L), dtype = np.float32)
+						for _ in self.dilations]
+
+		if self.lc_enabled:
+			IL = self.initial_lc_channels
+			self._lc_input = np.zeros((B, 2 * IL), dtype = np.float32)
+			# The LC signal is the same for every layer and is convolved with
+			# dilation 1, so all layers share the previous LC frame as state.
+			self._lc_previous = np.zeros((B, L), dtype = np.float32)
+
+		self._gc_in = None
+		if self.gc_channels is not None and global_condition is not None:
+			if self.gc_cardinality is not None:
+				ids = np.reshape(global_condition, [-1]).astype(np.int64)
+				embedding = self._gc_embedding[ids]
+			else:
+				embedding = np.asarray(global_condition, dtype = np.float32)
+			embedding = np.broadcast_to(
+				np.reshape(embedding, [-1, self.gc_channels]),
+				(B, self.gc_channels))
+			self._gc_in = [embedding.dot(w_gc) for w_gc in self._w_gc]
+
+	def step(self, samples, local_condition = None):
+		'''Advances every stream by one sample.
+
+		Args:
+			samples: Quantized input sample per stream, shape [batch_size].
+			local_condition: Upsampled LC frame per stream, shape
+				[batch_size, initial_lc_channels]. Required if the model is
+				locally conditioned.
+
+		Returns:
+			The next sample distribution per stream, shape
+			[batch_size, quantization_channels].
+		'''
+		B = self.batch_size
+		R = self.residual_channels
+		D = self.dilation_channels
+
+		samples = np.reshape(samples, [B]).astype(np.int64)
+		if self._prev_samples is None:
+			past = np.zeros((B, R), dtype = np.float32)
+		else:
+			past = self._audio_past[self._prev_samples]
+		current = past + self._audio_curr[samples]
+		self._prev_samples = samples
+
+		if self.lc_enabled:
+			if local_condition is None:
+				raise ValueError("Local conditioning enabled but no LC frame "
+								 "was given.")
+			IL = self.initial_lc_channels
+			L = self.lc_channels
+			self._lc_input[:, :IL] = self._lc_input[:, IL:]
+			self._lc_input[:, IL:] = np.reshape(local_condition, (B, IL))
+			lc_current = self._lc_input.dot(self._lc_causal)
+
+		skip_total = np.zeros((B, self.skip_channels), dtype = np.float32)
+		for i, dilation in enumerate(self.dilations):
+			inputs = self._inputs[i]
+			ring = self._rings[i]
+			pointer = self._pointers[i]
+
+			inputs[:, :R] = ring[pointer]
+			inputs[:, R:2 * R] = current
+			ring[pointer] = current
+			self._pointers[i] = (pointer + 1) % dilation
+
+			if self.lc_enabled:
+				inputs[:, 2 * R:2 * R + L] = self._lc_previous
+				inputs[:, 2 * R + L:] = lc_current
+
+			conv = inputs.dot(self._w_in[i]) + self._b_in[i]
+			if self._gc_in is not None:
+				conv += self._gc_in[i]
+
+			out = np.tanh(conv[:, :D]) * _sigmoid(conv[:, D:])
+			transformed = out.dot(self._w_out[i]) + self._b_out[i]
+			current = current + transformed[:, :R]
+			skip_total += transformed[:, R:]
+
+		if self.lc_enabled:
+			self._lc_previous = lc_current
+
+		conv1 = np.maximum(skip_total, 0).dot(self._w_post1) + self._b_post1
+		conv2 = np.maximum(conv1, 0).dot(self._w_post2) + self._b_post2
+		return _softmax(conv2)
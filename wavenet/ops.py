@@ -24,6 +24,76 @@ optimizer_factory = {'adam': create_adam_optimizer,
                      'rmsprop': create_rmsprop_optimizer}
 
 
+def average_gradients(tower_grads):
+    '''Averages the gradient of every variable over the towers.
+
+    tower_grads holds one list of (gradient, variable) pairs per tower, as
+    returned by Optimizer.compute_gradients for the same var_list.
+    '''
+    averaged = []
+    for grads_and_vars in zip(*tower_grads):
+        variable = grads_and_vars[0][1]
+        grads = [grad for grad, _ in grads_and_vars if grad is not None]
+        if not grads:
+            averaged.append((None, variable))
+            continue
+        # Sparse gradients of embedding lookups are densified to add them.
+        grads = [tf.convert_to_tensor(grad) for grad in grads]
+        averaged.append((tf.add_n(grads) / len(grads), variable))
+    return averaged
+
+
+def unscale_gradients(grads_and_vars, loss_scale):
+    '''Divides the gradients of a loss multiplied by loss_scale by it again.
+
+    Scaling the loss up keeps the small float16 gradients of mixed precision
+    training from flushing to zero on the way back through the network.
+    '''
+    unscaled = []
+    for grad, variable in grads_and_vars:
+        if isinstance(grad, tf.IndexedSlices):
+            grad = tf.IndexedSlices(grad.values / loss_scale, grad.indices,
+                                    grad.dense_shape)
+        elif grad is not None:
+            grad = grad / loss_scale
+        unscaled.append((grad, variable))
+    return unscaled
+
+
+def accumulate_gradients(optimizer, grads_and_vars, num_steps,
+                         global_step=None):
+    '''Sums the gradients of num_steps microbatches before one update.
+
+    Returns an op adding grads_and_vars to a buffer per variable, and an op
+    applying the mean of the buffers with the optimizer and clearing them.
+    The update increments global_step if given. The buffers are local
+    variables, so they are neither checkpointed nor shared between workers.
+    '''
+    accumulate_ops = []
+    buffers = []
+    for grad, variable in grads_and_vars:
+        if grad is None:
+            continue
+        buffer = tf.Variable(tf.zeros(variable.get_shape(),
+                                      dtype=variable.dtype.base_dtype),
+                             trainable=False,
+                             collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                             name=variable.op.name.replace('/', '_') +
+                             '_accumulator')
+        # Sparse gradients of embedding lookups are densified to add them.
+        accumulate_ops.append(
+            buffer.assign_add(tf.convert_to_tensor(grad)))
+        buffers.append((buffer, variable))
+
+    apply_op = optimizer.apply_gradients(
+        [(buffer / num_steps, variable) for buffer, variable in buffers],
+        global_step=global_step)
+    with tf.control_dependencies([apply_op]):
+        clear_ops = [buffer.assign(tf.zeros_like(buffer))
+                     for buffer, _ in buffers]
+    return tf.group(*accumulate_ops), tf.group(*clear_ops)
+
+
 def time_to_batch(value, dilation, name=None):
     with tf.name_scope('time_to_batch'):
         shape = tf.shape(value)
@@ -61,6 +131,26 @@ def causal_conv(value, filter_, dilation, name='causal_conv'):
         return result
 
 
+def dilated_causal_conv(value, filter_, dilation,
+                        name='dilated_causal_conv'):
+    '''Same result as causal_conv, computed by tf.nn.convolution with a
+    dilation_rate.
+
+    For dilation > 1 TensorFlow still lowers this to SpaceToBatchND, a
+    regular convolution and BatchToSpaceND, the same scheme as
+    time_to_batch / batch_to_time, only as single ops instead of the pad,
+    reshape and transpose ops of causal_conv. Whether that is faster depends
+    on the device, CausalConvBenchmark in test/test_causal_conv.py compares
+    both.
+    '''
+    with tf.name_scope(name):
+        # A VALID convolution only produces outputs that have all of their
+        # (filter_width - 1) * dilation past samples, which is causal_conv's
+        # output with the excess elements removed.
+        return tf.nn.convolution(value, filter_, padding='VALID',
+                                 dilation_rate=[dilation])
+
+
 def mu_law_encode(audio, quantization_channels):
     '''Quantizes waveform amplitudes.'''
     with tf.name_scope('encode'):
@@ -84,3 +174,88 @@ def mu_law_decode(output, quantization_channels):
         # Perform inverse of mu-law transformation.
         magnitude = (1 / mu) * ((1 + mu)**abs(signal) - 1)
         return tf.sign(signal) * magnitude
+
+
+def sample_categorical(logits, temperature=1.0, top_k=None, top_p=None,
+                       name='sample_categorical'):
+    '''Draws one sample per row of logits with the Gumbel-max trick.
+
+    Args:
+        logits: float tensor of shape [batch, channels]. Log probabilities
+            work as well, zero probabilities may be -inf.
+        temperature: Scalar or per row [batch] sampling temperature.
+        top_k: If given, only the top_k most likely channels are sampled.
+        top_p: If given, only the smallest set of most likely channels whose
+            probability adds up to top_p is sampled (nucleus sampling).
+
+    Returns:
+        int32 tensor of shape [batch] holding the sampled channels.
+    '''
+    with tf.name_scope(name):
+        logits = tf.convert_to_tensor(logits, dtype=tf.float32)
+        temperature = tf.reshape(tf.cast(temperature, tf.float32), [-1, 1])
+        logits = logits / temperature
+        excluded = tf.fill(tf.shape(logits), -float('inf'))
+
+        if top_k is not None:
+            kth_largest = tf.nn.top_k(logits, k=top_k).values[:, -1:]
+            logits = tf.where(logits < kth_largest, excluded, logits)
+
+        if top_p is not None:
+            sorted_logits = tf.nn.top_k(logits, k=tf.shape(logits)[1]).values
+            # Keep a channel while the channels more likely than it add up
+            # to less than top_p, which always keeps the most likely one.
+            cumulative = tf.cumsum(tf.nn.softmax(sorted_logits), axis=1,
+                                   exclusive=True)
+            cutoff = tf.reduce_min(
+                tf.where(cumulative < top_p, sorted_logits,
+                         tf.fill(tf.shape(sorted_logits), float('inf'))),
+                axis=1, keep_dims=True)
+            logits = tf.where(logits < cutoff, excluded, logits)
+
+        # argmax of logits plus Gumbel noise is a sample of softmax(logits)
+        uniform = tf.random_uniform(tf.shape(logits), minval=1e-20, maxval=1.0)
+        gumbel = -tf.log(-tf.log(uniform))
+        return tf.to_int32(tf.argmax(logits + gumbel, axis=1))
+
+
+def expand_lc_intervals(intervals, lengths, lc_channels,
+                        name='expand_lc_intervals'):
+    '''Expands note intervals into a dense piano roll.
+
+    Args:
+        intervals: int32 tensor of shape [batch, notes, 3] holding
+            (start, end, note) rows, padded with all-zero rows.
+        lengths: int32 tensor of shape [batch] with the number of samples
+            of each batch element.
+        lc_channels: Number of notes in the piano roll.
+
+    Returns:
+        float32 tensor of shape [batch, max(lengths), lc_channels].
+    '''
+    with tf.name_scope(name):
+        batch_size = tf.shape(intervals)[0]
+        num_notes = tf.shape(intervals)[1]
+        width = tf.reduce_max(lengths)
+
+        batch_index = tf.tile(tf.expand_dims(tf.range(batch_size), 1),
+                              [1, num_notes])
+        starts = intervals[:, :, 0]
+        ends = intervals[:, :, 1]
+        notes = intervals[:, :, 2]
+
+        # Mark +1 where a note starts and -1 where it ends. The running sum
+        # over time is then positive exactly while the note sounds. The
+        # padding rows add and remove the same element and cancel out.
+        indices = tf.concat([tf.stack([batch_index, starts, notes], axis=2),
+                             tf.stack([batch_index, ends, notes], axis=2)],
+                            axis=1)
+        updates = tf.concat([tf.ones_like(starts), -tf.ones_like(ends)],
+                            axis=1)
+        deltas = tf.scatter_nd(tf.reshape(indices, [-1, 3]),
+                               tf.reshape(updates, [-1]),
+                               tf.stack([batch_size, width + 1, lc_channels]))
+        roll = tf.cumsum(deltas, axis=1)[:, :width, :]
+        roll = tf.to_float(roll > 0)
+        roll.set_shape([None, None, lc_channels])
+        return roll
@@ -0,0 +1,66 @@
+from __future__ import division
+
+import wave
+
+import numpy as np
+
+
+def mu_law_decode_numpy(output, quantization_channels):
+	'''Recovers waveform from quantized values, same as ops.mu_law_decode.'''
+	mu = quantization_channels - 1
+	# Map values back to [-1, 1].
+	signal = 2 * (np.asarray(output, dtype = np.float32) / mu) - 1
+	# Perform inverse of mu-law transformation.
+	magnitude = (1 / mu) * ((1 + mu)**np.abs(signal) - 1)
+	return np.sign(signal) * magnitude
+
+
+class WavWriter(object):
+	'''Appends generated samples to a 16 bit mono WAV file as they come in.
+
+	Samples are buffered and written in blocks of buffer_size. Every write
+	patches the RIFF and data sizes in the header, so the file on disk is a
+	valid WAV file holding everything flushed so far, and a long generation
+	never has to decode or rewrite what it already saved.
+
+	Usage:
+		writer = WavWriter(path, sample_rate, quantization_channels)
+		writer.write(samples)
+		writer.close()
+	'''
+
+	def __init__(self, filename, sample_rate, quantization_channels,
+				 buffer_size = 16000):
+		self.filename = filename
+		self.quantization_channels = quantization_channels
+		self.buffer_size = buffer_size
+		self.buffer = []
+
+		self.file = open(filename, 'wb')
+		self.wav = wave.open(self.file, 'wb')
+		self.wav.setnchannels(1)
+		self.wav.setsampwidth(2)
+		self.wav.setframerate(sample_rate)
+
+	def write(self, samples):
+		'''Queues quantized samples and flushes once buffer_size are pending.'''
+		self.buffer.extend(samples)
+		if len(self.buffer) >= self.buffer_size:
+			self.flush()
+
+	def flush(self):
+		'''Decodes the pending samples and appends them to the file.'''
+		if not self.buffer:
+			return
+		audio = mu_law_decode_numpy(self.buffer, self.quantization_channels)
+		pcm = np.clip(np.round(audio * 32767), -32768, 32767).astype('<i2')
+		# writeframes patches the header sizes after appending
+		self.wav.writeframes(pcm.tobytes())
+		self.file.flush()
+		self.buffer = []
+		print('Updated wav file at {}'.format(self.filename))
+
+	def close(self):
+		self.flush()
+		self.wav.close()
+		self.file.close()